@@ -0,0 +1,63 @@
+"""Load tests the connector's gRPC server by running several Update streams
+at once, each syncing its own account brand from a local fake API with
+request latency, for a single worker and for one worker per stream.
+
+Requires the generated `sdk_pb2` modules (see build.sh). Run from the
+repository root with `python -m benchmarks.concurrent_updates [streams]
+[waves] [latency seconds]`.
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+
+from benchmarks.fake_api import FakeTracksuitApi
+from benchmarks.fetch_concurrency import wave_dates
+from main import create_server
+
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), 'sdk_pb2'))
+
+from sdk_pb2 import connector_sdk_pb2, connector_sdk_pb2_grpc  # noqa: E402
+
+
+def update(stub, token, account_brand_id):
+    request = connector_sdk_pb2.UpdateRequest(configuration={
+        "jwt": token, "account_brand_ids": str(account_brand_id), "filters": "All", "response_cache": "off"})
+    return sum(1 for response in stub.Update(request) if response.operation.HasField("record"))
+
+
+def update_seconds(api, streams, max_workers):
+    server, port = create_server('127.0.0.1:0', max_workers)
+    server.start()
+    try:
+        with grpc.insecure_channel(f'127.0.0.1:{port}') as channel, ThreadPoolExecutor(streams) as clients:
+            stub = connector_sdk_pb2_grpc.ConnectorStub(channel)
+            start = time.perf_counter()
+            rows = sum(clients.map(lambda account_brand_id: update(stub, api.token, account_brand_id),
+                                   api.account_brand_ids))
+            elapsed = time.perf_counter() - start
+    finally:
+        server.stop(None)
+
+    return elapsed, rows
+
+
+def main():
+    streams = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    waves = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+
+    with FakeTracksuitApi(account_brand_ids=range(1, streams + 1), wave_dates=wave_dates(waves),
+                          rows_per_wave=200, latency=latency) as api:
+        os.environ["TRACKSUIT_API_URL"] = api.base_url
+        for max_workers in [1, streams]:
+            seconds, rows = update_seconds(api, streams, max_workers)
+            print(
+                f"{streams} Update streams on {max_workers:>2} worker(s): {seconds:.2f}s for {rows} rows")
+
+
+if __name__ == '__main__':
+    main()
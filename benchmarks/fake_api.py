@@ -0,0 +1,138 @@
+"""A local stand-in for the Tracksuit API that serves synthetic funnel
+metrics from `/funnel/filters` and `/bulk/funnel/{id}`."""
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import jwt
+
+from benchmarks.synthetic import synthetic_metrics
+
+
+def fake_jwt(account_brand_ids):
+    return jwt.encode({"accountBrands": list(account_brand_ids)}, "fake-api-secret", algorithm="HS256")
+
+
+class FakeTracksuitApi:
+    def __init__(self, account_brand_ids=(1,), wave_dates=("2023-01-01",), rows_per_wave=100, latency=0.0,
+                 error_rate=0.0, seed=0):
+        self.account_brand_ids = list(account_brand_ids)
+        self.wave_dates = sorted(wave_dates)
+        self.rows_per_wave = rows_per_wave
+        self.latency = latency
+        # the fraction of requests that fail with a 503, picked by a seeded random so runs are repeatable
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = []
+        self.failures = deque()
+        self.lock = threading.Lock()
+        self.__bodies = {}
+        self.__server = None
+
+    @property
+    def base_url(self):
+        host, port = self.__server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def token(self):
+        return fake_jwt(self.account_brand_ids)
+
+    def __enter__(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                api.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, kwargs={"poll_interval": 0.05},
+                         daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def inject(self, status=None, headers=None, delay=0.0, count=1, truncate=False):
+        """Makes the next `count` requests wait `delay` seconds and, when
+        `status` is given, fail with it instead of being served. With
+        `truncate` they are served but the connection is closed half way
+        through the body."""
+        with self.lock:
+            self.failures.extend([(status, headers or {}, delay, truncate)] * count)
+
+    def metrics(self, account_brand_id, wave_date):
+        key = (account_brand_id, wave_date)
+        with self.lock:
+            if key not in self.__bodies:
+                self.__bodies[key] = synthetic_metrics(
+                    self.rows_per_wave, account_brand_id, (wave_date,), seed=f"{account_brand_id}:{wave_date}")
+            return self.__bodies[key]
+
+    def respond(self, handler, path, query):
+        if path == "/v1/funnel/filters":
+            etag = f'"{len(self.wave_dates)}-{self.wave_dates[-1] if self.wave_dates else ""}"'
+            if handler.headers.get("If-None-Match") == etag:
+                return 304, {"ETag": etag}, None
+            return 200, {"ETag": etag}, {"waveDates": self.wave_dates}
+
+        if path.startswith("/v1/bulk/funnel/"):
+            account_brand_id = int(path.rsplit("/", 1)[1])
+            if account_brand_id not in self.account_brand_ids:
+                return 404, {}, {"error": "not found"}
+
+            start_date, end_date = query["waveStartDate"][0], query["waveEndDate"][0]
+            # only filterType is filtered on, like the API the other selections are left to the connector
+            filter_type = query.get("filterType", [None])[0]
+            metrics = [
+                metric
+                for wave_date in self.wave_dates if start_date <= wave_date <= end_date
+                for metric in self.metrics(account_brand_id, wave_date)
+                if filter_type is None or metric["filterType"] == filter_type
+            ]
+            return 200, {}, {"accountBrandId": account_brand_id, "metrics": metrics}
+
+        return 404, {}, {"error": "not found"}
+
+    def handle(self, handler):
+        url = urlparse(handler.path)
+        query = parse_qs(url.query)
+        with self.lock:
+            self.requests.append(handler.path)
+            failure = self.failures.popleft() if self.failures else None
+            if failure is None and self.error_rate > 0 and self.random.random() < self.error_rate:
+                failure = (503, {}, 0.0, False)
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if failure is not None and failure[2] > 0:
+            time.sleep(failure[2])
+
+        if failure is not None and failure[0] is not None:
+            status, headers, body = failure[0], failure[1], {"error": "injected failure"}
+        else:
+            status, headers, body = self.respond(handler, url.path, query)
+        encoded = json.dumps(body).encode() if body is not None else b""
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(encoded)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        if failure is not None and failure[3]:
+            handler.wfile.write(encoded[:len(encoded) // 2])
+            handler.close_connection = True
+            return
+        handler.wfile.write(encoded)
@@ -0,0 +1,45 @@
+"""Measures how long MetricFetcher takes to fetch every wave of many account
+brands from a local fake API that adds latency to each request.
+
+Run from the repository root with `python -m benchmarks.fetch_concurrency
+[account brands] [waves] [latency seconds]`.
+"""
+import sys
+import time
+
+from benchmarks.fake_api import FakeTracksuitApi
+from metric_fetcher import MetricFetcher, MetricFetcherRepo
+
+
+def wave_dates(waves):
+    return [f"{2020 + month // 12}-{month % 12 + 1:02d}-01" for month in range(waves)]
+
+
+def fetch_seconds(api, concurrent_requests):
+    repo = MetricFetcherRepo(api.token, concurrent_requests=concurrent_requests,
+                             base_url=api.base_url)
+    start = time.perf_counter()
+    with MetricFetcher(repo, concurrent_requests=concurrent_requests) as fetcher:
+        account_brand_ids = fetcher.account_brand_ids_to_sync(None)
+        wave_ranges = fetcher.wave_ranges_to_sync(account_brand_ids, {})
+        rows = sum(len(list(window.metrics))
+                   for window in fetcher.fetch_windows(wave_ranges, "All"))
+
+    return time.perf_counter() - start, rows
+
+
+def main():
+    account_brands = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    waves = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+
+    with FakeTracksuitApi(account_brand_ids=range(1, account_brands + 1), wave_dates=wave_dates(waves),
+                          rows_per_wave=200, latency=latency) as api:
+        for concurrent_requests in [1, 4, 10, 32]:
+            seconds, rows = fetch_seconds(api, concurrent_requests)
+            print(
+                f"{concurrent_requests:>3} concurrent requests: {seconds:.2f}s for {rows} rows")
+
+
+if __name__ == '__main__':
+    main()
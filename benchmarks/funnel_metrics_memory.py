@@ -0,0 +1,81 @@
+"""Measures the memory held per parsed FunnelMetrics row.
+
+Run from the repository root with `python -m benchmarks.funnel_metrics_memory [rows]`.
+"""
+import gc
+import json
+import sys
+import tracemalloc
+from dataclasses import dataclass
+
+from benchmarks.synthetic import synthetic_metrics
+from data_classes import iter_funnel_metrics
+
+
+@dataclass
+class DictFunnelMetrics:
+    """FunnelMetrics before slots and interning, kept as the baseline."""
+    id: str
+    account_brand_id: int
+    brand_id: int
+    brand_name: str
+    filter: str
+    filter_type: str
+    wave_date: str
+    category_name: str
+    geography_name: str
+    base: int
+    weight: float
+    base_weight: float
+    percentage: float
+    question_type: str
+
+
+def as_dict_funnel_metrics(metric):
+    # copies the strings so they are not shared, as they were before interning
+    return DictFunnelMetrics(
+        id=metric.id,
+        account_brand_id=metric.account_brand_id,
+        brand_id=metric.brand_id,
+        brand_name=metric.brand_name[:1] + metric.brand_name[1:],
+        filter=metric.filter[:1] + metric.filter[1:],
+        filter_type=metric.filter_type[:1] + metric.filter_type[1:],
+        wave_date=metric.wave_date[:1] + metric.wave_date[1:],
+        category_name=metric.category_name[:1] + metric.category_name[1:],
+        geography_name=metric.geography_name[:1] + metric.geography_name[1:],
+        base=metric.base,
+        weight=metric.weight,
+        base_weight=metric.base_weight,
+        percentage=metric.percentage,
+        question_type=metric.question_type[:1] + metric.question_type[1:],
+    )
+
+
+def bytes_per_row(build, rows):
+    gc.collect()
+    tracemalloc.start()
+    metrics = build()
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(metrics) == rows
+    return held / rows
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    body = json.dumps({"accountBrandId": 1, "metrics": synthetic_metrics(
+        rows, wave_dates=("2023-01-01", "2023-02-01"))}).encode()
+
+    def parse():
+        return iter_funnel_metrics([body], 1)
+
+    before = bytes_per_row(
+        lambda: [as_dict_funnel_metrics(metric) for metric in parse()], rows)
+    after = bytes_per_row(lambda: list(parse()), rows)
+
+    print(f"before: {before:.0f} bytes per row")
+    print(f" after: {after:.0f} bytes per row")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Measures how long importing `main` takes with `python -X importtime`,
+the time a new connector process spends before its server can start, and
+lists the slowest imports. With `--check` it fails when the import takes
+longer than the budget or pulls in a module that is meant to be imported
+by the first RPC that needs it.
+
+Requires the generated `sdk_pb2` modules (see build.sh). Run from the
+repository root with `python -m benchmarks.import_time [--check]
+[--budget-ms ms] [--runs runs]`.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# milliseconds, grpc and the sdk modules take most of it
+DEFAULT_BUDGET_MS = 150
+# imported by the RPCs that fetch and sync, never at start up
+DEFERRED_MODULES = ["requests", "jwt", "dateutil", "dotenv", "metric_fetcher", "metric_syncer", "response_cache",
+                    "wave_index", "logger"]
+
+
+def import_times(module="main"):
+    """Returns the cumulative microseconds of `module` and of every module
+    it imported in a fresh interpreter, keyed by module name."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # the modules a module imports are listed before it, indented a level deeper
+        if not name.startswith("  ") and name.strip() != module:
+            times = {}
+            continue
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check", action="store_true",
+                        help="exit with an error if the import is over budget or imports a deferred module")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    runs = [import_times() for _ in range(args.runs)]
+    milliseconds = statistics.median(times["main"] for times in runs) / 1000
+    print(f"import main: {milliseconds:.1f}ms, median of {args.runs} runs, budget {args.budget_ms:.0f}ms")
+    slowest = sorted(runs[-1].items(), key=lambda item: item[1], reverse=True)
+    for name, microseconds in [item for item in slowest if item[0] != "main"][:10]:
+        print(f"{microseconds / 1000:>8.1f}ms {name}")
+
+    deferred = [module for module in DEFERRED_MODULES if module in runs[-1]]
+    if len(deferred) > 0:
+        print(f"imported at start up: {', '.join(deferred)}")
+
+    if args.check and (milliseconds > args.budget_ms or len(deferred) > 0):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""Measures how fast each JSON decoder turns synthetic bulk funnel response
+bodies into FunnelMetrics rows, in rows and megabytes per second, for each
+id mode. Decoders whose package isn't installed are skipped.
+
+Run from the repository root with `python -m benchmarks.json_decoding
+[responses] [rows per response]`.
+"""
+import json
+import sys
+import time
+
+from benchmarks.synthetic import synthetic_metrics
+from data_classes import ID_MODES, funnel_metric_rows
+from json_decoders import DECODERS, available
+
+
+def bodies(responses, rows):
+    return [json.dumps({"accountBrandId": i, "metrics": synthetic_metrics(rows, i, seed=i)}).encode()
+            for i in range(responses)]
+
+
+def throughput(payloads, id_mode, decoder):
+    start = time.perf_counter()
+    rows = sum(len(funnel_metric_rows(body, account_brand_id, id_mode, decoder=decoder))
+               for account_brand_id, body in enumerate(payloads))
+    elapsed = time.perf_counter() - start
+    return rows / elapsed, sum(len(body) for body in payloads) / elapsed / 1_000_000
+
+
+def main():
+    responses = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+    payloads = bodies(responses, rows)
+
+    for id_mode in ID_MODES:
+        for decoder in DECODERS:
+            if not available(decoder):
+                print(f"{id_mode:>7} {decoder:>7}: not installed")
+                continue
+
+            rows_per_second, mb_per_second = throughput(payloads, id_mode, decoder)
+            print(f"{id_mode:>7} {decoder:>7}: {rows_per_second:,.0f} rows/sec, {mb_per_second:.1f} MB/sec")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Measures how parsing synthetic bulk funnel responses scales with cores,
+parsing them on fetch threads and in 1 to N worker processes.
+
+Run from the repository root with `python -m benchmarks.parse_scaling
+[responses] [rows per response] [max processes]`.
+"""
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.synthetic import synthetic_metrics
+from data_classes import ID_MODE_SHA256, FunnelMetrics, funnel_metric_rows, iter_funnel_metrics
+from metric_fetcher import DEFAULT_CONCURRENT_REQUESTS, shared_parse_pool
+
+
+def bodies(responses, rows):
+    return [json.dumps({"accountBrandId": i, "metrics": synthetic_metrics(rows, i, seed=i)}).encode()
+            for i in range(responses)]
+
+
+def parse_on_threads(body, account_brand_id):
+    return len(list(iter_funnel_metrics([body], account_brand_id, ID_MODE_SHA256)))
+
+
+def threaded_rows_per_second(payloads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(DEFAULT_CONCURRENT_REQUESTS) as threads:
+        rows = sum(threads.map(parse_on_threads,
+                   payloads, range(len(payloads))))
+    return rows / (time.perf_counter() - start)
+
+
+def process_rows_per_second(payloads, processes):
+    parse_pool = shared_parse_pool(processes)
+    # starts the worker processes so their start up isn't measured
+    list(parse_pool.map(funnel_metric_rows, payloads[:processes], range(processes)))
+
+    def parse_in_pool(body, account_brand_id):
+        rows = parse_pool.submit(
+            funnel_metric_rows, body, account_brand_id, ID_MODE_SHA256).result()
+        return len([FunnelMetrics(*row) for row in rows])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(DEFAULT_CONCURRENT_REQUESTS) as threads:
+        rows = sum(threads.map(parse_in_pool, payloads, range(len(payloads))))
+    return rows / (time.perf_counter() - start)
+
+
+def main():
+    responses = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 5_000
+    max_processes = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    payloads = bodies(responses, rows)
+
+    print(f"{DEFAULT_CONCURRENT_REQUESTS} fetch threads: {threaded_rows_per_second(payloads):,.0f} rows/sec")
+    processes = 1
+    while processes <= max_processes:
+        print(f"{processes:>2} parse processes: {process_rows_per_second(payloads, processes):,.0f} rows/sec")
+        processes *= 2
+
+
+if __name__ == '__main__':
+    main()
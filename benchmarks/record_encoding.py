@@ -0,0 +1,55 @@
+"""Measures how many records per second MetricSyncerRepo encodes into
+UpdateResponses, against the encoding it replaced.
+
+Requires the generated `sdk_pb2` modules (see build.sh). Run from the
+repository root with `python -m benchmarks.record_encoding [rows]`.
+"""
+import os
+import sys
+import time
+
+from data_classes import mock_funnel_metric
+from metric_syncer import MetricSyncerRepo
+
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), 'sdk_pb2'))
+
+from sdk_pb2 import common_pb2, connector_sdk_pb2  # noqa: E402
+
+
+def copied_syncable_metric(metric):
+    """The encoding before the values were written in place, kept as the baseline."""
+    operation = connector_sdk_pb2.Operation()
+    record = connector_sdk_pb2.Record()
+    record.type = common_pb2.OpType.UPSERT
+    record.table_name = "funnel_metrics"
+    for name, value_field in MetricSyncerRepo(common_pb2, connector_sdk_pb2, None).columns:
+        value = common_pb2.ValueType()
+        setattr(value, value_field, getattr(metric, name))
+        record.data[name].CopyFrom(value)
+
+    operation.record.CopyFrom(record)
+    return connector_sdk_pb2.UpdateResponse(operation=operation)
+
+
+def records_per_second(encode, metrics):
+    start = time.perf_counter()
+    for metric in metrics:
+        encode(metric).SerializeToString()
+    return len(metrics) / (time.perf_counter() - start)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    metrics = [mock_funnel_metric(id=f"{i:064x}", base=i, weight=i / 3)
+               for i in range(rows)]
+    repo = MetricSyncerRepo(common_pb2, connector_sdk_pb2, None)
+
+    assert copied_syncable_metric(metrics[0]) == repo.get_syncable_metric(metrics[0])
+
+    print(f"before: {records_per_second(copied_syncable_metric, metrics):,.0f} records/sec")
+    print(f" after: {records_per_second(repo.get_syncable_metric, metrics):,.0f} records/sec")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+"""Compares the cost of deriving record ids in each id mode.
+
+Run from the repository root with `python -m benchmarks.row_ids [rows]`.
+"""
+import sys
+import time
+
+from benchmarks.synthetic import synthetic_metrics
+from data_classes import ID_BATCH_SIZE, ID_MODES, metric_ids
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    metrics = synthetic_metrics(rows)
+
+    for id_mode in ID_MODES:
+        start = time.perf_counter()
+        for offset in range(0, rows, ID_BATCH_SIZE):
+            metric_ids(metrics[offset:offset + ID_BATCH_SIZE], 1, id_mode)
+        elapsed = time.perf_counter() - start
+
+        print(
+            f"{id_mode:>8}: {elapsed:.2f}s for {rows} rows, {rows / elapsed:,.0f} rows/sec")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import random
+
+BRANDS = ["Coke", "Pepsi", "Sprite", "Fanta", "Dr Pepper", "7 Up", "Mountain Dew", "Lift"]
+FILTERS = {
+    "Total": ["Total"],
+    "Age": ["18-24", "25-34", "35-44", "45-54", "55+"],
+    "Gender": ["Male", "Female", "Non-binary"],
+}
+CATEGORIES = ["Soft drinks", "Energy drinks", "Sparkling water"]
+GEOGRAPHIES = ["New Zealand", "Australia", "United Kingdom", "United States"]
+QUESTION_TYPES = ["PROMPTED_AWARENESS", "UNPROMPTED_AWARENESS",
+                  "CONSIDERATION", "PREFERENCE", "INVESTIGATION"]
+
+
+def synthetic_metrics(count, account_brand_id=1, wave_dates=("2023-01-01",), seed=0):
+    """Returns `count` metrics shaped like the `metrics` of a /bulk/funnel
+    response, cycling through the filters, categories and geographies of a
+    brand the way a real response repeats them."""
+    rng = random.Random(seed)
+    filters = [(filter_type, filter) for filter_type,
+               values in FILTERS.items() for filter in values]
+    metrics = []
+    for i in range(count):
+        filter_type, filter = filters[i % len(filters)]
+        metrics.append({
+            "accountBrandId": account_brand_id,
+            "brandId": i % len(BRANDS) + 1,
+            "brandName": BRANDS[i % len(BRANDS)],
+            "filter": filter,
+            "filterType": filter_type,
+            "waveDate": wave_dates[i % len(wave_dates)],
+            "questionType": QUESTION_TYPES[i % len(QUESTION_TYPES)],
+            "category": CATEGORIES[i // len(filters) % len(CATEGORIES)],
+            "geography": GEOGRAPHIES[i // (len(filters) * len(CATEGORIES)) % len(GEOGRAPHIES)],
+            "base": rng.randint(50, 2000),
+            "weight": rng.random() * 2,
+            "baseWeight": rng.random() * 2,
+            "percentage": rng.random(),
+        })
+
+    return metrics
@@ -0,0 +1,135 @@
+"""Runs ConnectorService.Update end to end against the local fake API for a
+set of production shaped scenarios, reporting records per second, time to
+first record and peak memory, and compares them with stored baselines.
+
+Each scenario runs in its own process so its peak memory is its own. The
+baselines in `baselines.json` were recorded on one machine, re-record them
+with `--update-baselines` before comparing runs on another.
+
+Requires the generated `sdk_pb2` modules (see build.sh). Run from the
+repository root with `python -m benchmarks.update_scenarios [--check]
+[--update-baselines] [scenario ...]`.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+from benchmarks.fake_api import FakeTracksuitApi
+from benchmarks.fetch_concurrency import wave_dates
+
+BASELINES = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "baselines.json")
+
+SCENARIOS = {
+    "small": {"account_brands": 3, "waves": 6, "rows_per_wave": 500},
+    "large_brand": {"account_brands": 1, "waves": 12, "rows_per_wave": 5_000},
+    "many_brands": {"account_brands": 20, "waves": 3, "rows_per_wave": 200, "latency": 0.02},
+    "many_brands_unordered": {"account_brands": 20, "waves": 3, "rows_per_wave": 200, "latency": 0.02,
+                              "emission_order": "unordered"},
+    "flaky_api": {"account_brands": 5, "waves": 6, "rows_per_wave": 500, "error_rate": 0.1},
+}
+
+# how much worse than its baseline a scenario may get before --check fails it
+TOLERANCE = 0.3
+
+
+def run_scenario(account_brands, waves, rows_per_wave, latency=0.0, error_rate=0.0, emission_order="ordered"):
+    import grpc
+    from main import create_server
+
+    sys.path.append(os.path.join(os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__))), 'sdk_pb2'))
+    from sdk_pb2 import connector_sdk_pb2, connector_sdk_pb2_grpc
+
+    with FakeTracksuitApi(account_brand_ids=range(1, account_brands + 1), wave_dates=wave_dates(waves),
+                          rows_per_wave=rows_per_wave, latency=latency, error_rate=error_rate) as api:
+        os.environ["TRACKSUIT_API_URL"] = api.base_url
+        server, port = create_server('127.0.0.1:0')
+        server.start()
+        try:
+            with grpc.insecure_channel(f'127.0.0.1:{port}') as channel:
+                stub = connector_sdk_pb2_grpc.ConnectorStub(channel)
+                request = connector_sdk_pb2.UpdateRequest(
+                    configuration={"jwt": api.token, "filters": "All", "response_cache": "off",
+                                   "emission_order": emission_order})
+                records = 0
+                first_record_seconds = None
+                start = time.perf_counter()
+                for response in stub.Update(request):
+                    if response.operation.HasField("record"):
+                        records += 1
+                        if first_record_seconds is None:
+                            first_record_seconds = time.perf_counter() - start
+                elapsed = time.perf_counter() - start
+        finally:
+            server.stop(None)
+
+    assert records == account_brands * waves * rows_per_wave
+    return {
+        "records_per_second": records / elapsed,
+        "first_record_seconds": first_record_seconds,
+        # kilobytes on linux
+        "peak_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_isolated(scenario):
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(run_scenario, kwds=SCENARIOS[scenario])
+
+
+def regressions(result, baseline):
+    found = []
+    if result["records_per_second"] < baseline["records_per_second"] * (1 - TOLERANCE):
+        found.append("records_per_second")
+    for lower_is_better in ["first_record_seconds", "peak_mib"]:
+        if result[lower_is_better] > baseline[lower_is_better] * (1 + TOLERANCE):
+            found.append(lower_is_better)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS))
+    parser.add_argument("--check", action="store_true",
+                        help="exit with an error if a scenario regressed from its baseline")
+    parser.add_argument("--update-baselines", action="store_true",
+                        help="store the results as the new baselines")
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as file:
+            baselines = json.load(file)
+
+    failed = False
+    for scenario in args.scenarios:
+        result = run_isolated(scenario)
+        line = (f"{scenario:>12}: {result['records_per_second']:,.0f} records/sec, "
+                f"first record after {result['first_record_seconds']:.3f}s, peak {result['peak_mib']:.0f} MiB")
+        if scenario in baselines:
+            found = regressions(result, baselines[scenario])
+            line += f", regressed {', '.join(found)}" if found else ", within baseline"
+            failed = failed or len(found) > 0
+        print(line)
+
+        if args.update_baselines:
+            baselines[scenario] = {name: round(value, 4)
+                                   for name, value in result.items()}
+
+    if args.update_baselines:
+        with open(BASELINES, "w") as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+            file.write("\n")
+
+    if args.check and failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
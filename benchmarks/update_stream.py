@@ -0,0 +1,70 @@
+"""Measures Update stream throughput over a local gRPC channel with and
+without the ResponseBatcher between the syncer and the stream.
+
+Requires the generated `sdk_pb2` modules (see build.sh). Run from the
+repository root with `python -m benchmarks.update_stream [rows]`.
+"""
+import os
+import sys
+import time
+from concurrent import futures
+
+import grpc
+
+from data_classes import mock_funnel_metric
+from metric_syncer import MetricSyncer, MetricSyncerRepo
+from response_batcher import ResponseBatcher
+
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))), 'sdk_pb2'))
+
+from sdk_pb2 import common_pb2, connector_sdk_pb2, connector_sdk_pb2_grpc  # noqa: E402
+
+
+class SyntheticConnector(connector_sdk_pb2_grpc.ConnectorServicer):
+    def __init__(self, rows, batched):
+        self.rows = rows
+        self.batched = batched
+
+    def Update(self, request, context):
+        metrics = (mock_funnel_metric(id=f"{i:064x}", base=i, weight=i / 3)
+                   for i in range(self.rows))
+        syncer = MetricSyncer(MetricSyncerRepo(
+            common_pb2, connector_sdk_pb2, None))
+        responses = syncer.sync(
+            metrics, {}, {1: {"from": "2020-01-01", "to": "2020-01-01"}}, "All")
+        if self.batched:
+            responses = ResponseBatcher().stream(responses)
+
+        yield from responses
+
+
+def records_per_second(rows, batched):
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
+    connector_sdk_pb2_grpc.add_ConnectorServicer_to_server(
+        SyntheticConnector(rows, batched), server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    try:
+        with grpc.insecure_channel(f'127.0.0.1:{port}') as channel:
+            stub = connector_sdk_pb2_grpc.ConnectorStub(channel)
+            start = time.perf_counter()
+            received = sum(1 for response in stub.Update(
+                connector_sdk_pb2.UpdateRequest()) if response.operation.HasField("record"))
+            elapsed = time.perf_counter() - start
+    finally:
+        server.stop(None)
+
+    assert received == rows
+    return rows / elapsed
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+
+    print(f"unbatched: {records_per_second(rows, False):,.0f} records/sec")
+    print(f"  batched: {records_per_second(rows, True):,.0f} records/sec")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,59 @@
-from typing import List
+from typing import Iterator, List, NamedTuple
 from dataclasses import dataclass
 from uuid import uuid4
-from hashlib import sha256
+from hashlib import blake2b, sha256
+from itertools import islice, repeat
+from operator import attrgetter
 from json import dumps
+from sys import intern
+from json_stream import iter_array_items
+from json_decoders import DECODER_STREAM, METRIC_FIELDS, decode_columns, decode_metrics
+
+# ids are the sha256 of the metric's sorted JSON, kept for destinations synced before the fast ids
+ID_MODE_SHA256 = "sha256"
+# ids are the blake2b of a fixed tuple of the metric's fields
+ID_MODE_BLAKE2B = "blake2b"
+ID_MODES = [ID_MODE_SHA256, ID_MODE_BLAKE2B]
+
+ID_FIELDS = METRIC_FIELDS
+# the fields interned when a metric becomes FunnelMetrics
+CATEGORICAL_FIELDS = ('brandName', 'filter', 'filterType', 'waveDate', 'category', 'geography',
+                      'questionType')
+
+ID_BATCH_SIZE = 1000
+
+# the filter type selection that syncs every filter type
+FILTER_TYPE_ALL = "All"
+# the filter types the API groups funnel metrics by
+FILTER_TYPES = ("Total", "Age", "Gender")
+
+FUNNEL_METRICS_TABLE = "funnel_metrics"
+# (column name, fivetran data type), the column names match the FunnelMetrics attributes
+FUNNEL_METRICS_COLUMNS = [
+    ("id", "STRING"),
+    ("account_brand_id", "INT"),
+    ("brand_id", "INT"),
+    ("brand_name", "STRING"),
+    ("filter", "STRING"),
+    ("filter_type", "STRING"),
+    ("wave_date", "STRING"),
+    ("category_name", "STRING"),
+    ("geography_name", "STRING"),
+    ("base", "INT"),
+    ("weight", "DOUBLE"),
+    ("base_weight", "DOUBLE"),
+    ("percentage", "DOUBLE"),
+    ("question_type", "STRING"),
+]
+FUNNEL_METRICS_PRIMARY_KEY = "id"
 
 
 @dataclass
 class FunnelMetrics:
+    # millions of these are held while a window is sorted, slots keep each one small
+    __slots__ = ('id', 'account_brand_id', 'brand_id', 'brand_name', 'filter', 'filter_type', 'wave_date',
+                 'category_name', 'geography_name', 'base', 'weight', 'base_weight', 'percentage', 'question_type')
+
     id: uuid4
     account_brand_id: int
     brand_id: int
@@ -23,28 +70,250 @@ class FunnelMetrics:
     question_type: str
 
 
-def json_to_funnel_metrics(json) -> List[FunnelMetrics]:
-    funnel_metrics = []
-    for metric in json['metrics']:
-        id = sha256(dumps(metric, sort_keys=True).encode()).hexdigest()
-        funnel_metrics.append(FunnelMetrics(
-            id=id,
-            account_brand_id=json['accountBrandId'],
-            brand_id=metric['brandId'],
-            brand_name=metric['brandName'],
-            filter=metric['filter'],
-            filter_type=metric['filterType'],
-            wave_date=metric['waveDate'],
-            category_name=metric['category'],
-            geography_name=metric['geography'],
-            base=metric['base'],
-            weight=metric['weight'],
-            base_weight=metric['baseWeight'],
-            percentage=metric['percentage'],
-            question_type=metric['questionType']
-        ))
-
-    return funnel_metrics
+@dataclass
+class DeletedFunnelMetrics:
+    """A previously synced metric that is no longer part of its wave."""
+    __slots__ = ('id', 'account_brand_id', 'wave_date')
+
+    id: str
+    account_brand_id: int
+    wave_date: str
+
+
+def selection(values, all_value=None):
+    """Parses a comma separated selection from the configuration into a
+    sorted tuple, an empty tuple selects every value."""
+    if isinstance(values, str):
+        values = values.split(",")
+    values = {value.strip() for value in values if value.strip() != ""}
+    if all_value is not None and all_value in values:
+        return ()
+
+    return tuple(sorted(values))
+
+
+def filter_type_selection(values):
+    """Parses a comma separated selection of filter types like `selection`,
+    matching them case-insensitively and keeping their canonical spelling.
+    Raises a ValueError for a filter type the API doesn't have, it would
+    otherwise sync no metrics while recording its waves as synced."""
+    canonical = {filter_type.lower(): filter_type for filter_type in FILTER_TYPES + (FILTER_TYPE_ALL,)}
+    unknown = [value for value in selection(values) if value.lower() not in canonical]
+    if len(unknown) > 0:
+        raise ValueError(
+            f"unknown filter type(s) {', '.join(unknown)}, expected {', '.join(FILTER_TYPES)} or {FILTER_TYPE_ALL}")
+
+    return selection([canonical[value.lower()] for value in selection(values)], FILTER_TYPE_ALL)
+
+
+class MetricFilter(NamedTuple):
+    """The funnel metrics a connection syncs, an empty selection keeps every
+    value. Filter types are requested one at a time with the API's
+    filterType parameter, the other selections are passed along as query
+    parameters and checked again while parsing so rows the API didn't
+    filter out never become FunnelMetrics."""
+    filter_types: tuple = ()
+    geographies: tuple = ()
+    categories: tuple = ()
+    question_types: tuple = ()
+
+    @classmethod
+    def of(cls, filter_type):
+        """Returns `filter_type` as a MetricFilter, it may be one already or a
+        comma separated selection of filter types."""
+        if isinstance(filter_type, MetricFilter):
+            return filter_type
+
+        return cls(filter_types=filter_type_selection(filter_type))
+
+    @property
+    def key(self):
+        """The key the filter's progress is kept under in the state, the
+        filter type itself for a single filter type so existing states carry
+        on."""
+        key = ",".join(self.filter_types) or FILTER_TYPE_ALL
+        for name, values in [("geography", self.geographies), ("category", self.categories),
+                             ("questionType", self.question_types)]:
+            if len(values) > 0:
+                key += f";{name}={','.join(values)}"
+        return key
+
+    @property
+    def request_filter_types(self):
+        """The filterType of each request made for a wave range, None requests every filter type at once."""
+        return self.filter_types or (None,)
+
+    def query_params(self, filter_type):
+        params = {}
+        if filter_type is not None:
+            params["filterType"] = filter_type
+        for name, values in [("geography", self.geographies), ("category", self.categories),
+                             ("questionType", self.question_types)]:
+            if len(values) > 0:
+                params[name] = list(values)
+        return params
+
+    @property
+    def selects_rows(self):
+        return any(len(values) > 0 for values in self)
+
+    def accepts(self, metric):
+        """Whether the raw `metric` of a bulk funnel response is selected."""
+        return ((len(self.filter_types) == 0 or metric['filterType'] in self.filter_types)
+                and (len(self.geographies) == 0 or metric['geography'] in self.geographies)
+                and (len(self.categories) == 0 or metric['category'] in self.categories)
+                and (len(self.question_types) == 0 or metric['questionType'] in self.question_types))
+
+    def select_columns(self, columns):
+        """Returns the selected metrics of `columns`, metrics decoded into a
+        list of values per field."""
+        selections = [(columns[field], values) for field, values in [('filterType', self.filter_types),
+                                                                     ('geography', self.geographies),
+                                                                     ('category', self.categories),
+                                                                     ('questionType', self.question_types)]
+                      if len(values) > 0]
+        rows = [row for row in range(len(columns[ID_FIELDS[0]]))
+                if all(column[row] in values for column, values in selections)]
+        return {field: [column[row] for row in rows] for field, column in columns.items()}
+
+
+def sha256_metric_ids(metrics, account_brand_id) -> List[str]:
+    return [
+        sha256(dumps(metric, sort_keys=True).encode()).hexdigest()
+        for metric in metrics
+    ]
+
+
+def blake2b_metric_ids(metrics, account_brand_id) -> List[str]:
+    prefix = f"{account_brand_id}\x1f"
+    return [
+        blake2b((prefix + "\x1f".join([str(metric[field]) for field in ID_FIELDS])).encode(),
+                digest_size=16).hexdigest()
+        for metric in metrics
+    ]
+
+
+def blake2b_column_ids(columns, account_brand_id) -> List[str]:
+    """The blake2b ids of metrics decoded into a list of values per field."""
+    prefix = f"{account_brand_id}\x1f"
+    return [
+        blake2b((prefix + "\x1f".join(map(str, values))).encode(),
+                digest_size=16).hexdigest()
+        for values in zip(*[columns[field] for field in ID_FIELDS])
+    ]
+
+
+METRIC_ID_FUNCTIONS = {
+    ID_MODE_SHA256: sha256_metric_ids,
+    ID_MODE_BLAKE2B: blake2b_metric_ids,
+}
+
+
+def metric_ids(metrics, account_brand_id, id_mode=ID_MODE_SHA256) -> List[str]:
+    if id_mode not in METRIC_ID_FUNCTIONS:
+        raise ValueError(
+            f"unknown id mode {id_mode}, expected one of {ID_MODES}")
+
+    return METRIC_ID_FUNCTIONS[id_mode](metrics, account_brand_id)
+
+
+def metric_to_funnel_metrics(metric, account_brand_id, id=None) -> FunnelMetrics:
+    if id is None:
+        id = metric_ids([metric], account_brand_id)[0]
+
+    # the categorical columns repeat across every row, interning shares one copy of each value
+    return FunnelMetrics(
+        id=id,
+        account_brand_id=account_brand_id,
+        brand_id=metric['brandId'],
+        brand_name=intern(metric['brandName']),
+        filter=intern(metric['filter']),
+        filter_type=intern(metric['filterType']),
+        wave_date=intern(metric['waveDate']),
+        category_name=intern(metric['category']),
+        geography_name=intern(metric['geography']),
+        base=metric['base'],
+        weight=metric['weight'],
+        base_weight=metric['baseWeight'],
+        percentage=metric['percentage'],
+        question_type=intern(metric['questionType'])
+    )
+
+
+def json_to_funnel_metrics(json, id_mode=ID_MODE_SHA256) -> List[FunnelMetrics]:
+    account_brand_id = json['accountBrandId']
+    ids = metric_ids(json['metrics'], account_brand_id, id_mode)
+    return [
+        metric_to_funnel_metrics(metric, account_brand_id, id)
+        for metric, id in zip(json['metrics'], ids)
+    ]
+
+
+def iter_funnel_metrics(chunks, account_brand_id, id_mode=ID_MODE_SHA256, stats=None,
+                        metric_filter=None) -> Iterator[FunnelMetrics]:
+    """Parses a bulk funnel response body a batch of metrics at a time, so a
+    response never has to be held in memory as a whole. Metrics not
+    selected by `metric_filter` are dropped before their ids are derived.
+    The time spent deriving ids is added to `stats` when it is passed in."""
+    metrics = iter_array_items(chunks, 'metrics')
+    if metric_filter is not None and metric_filter.selects_rows:
+        metrics = filter(metric_filter.accepts, metrics)
+    while True:
+        batch = list(islice(metrics, ID_BATCH_SIZE))
+        if len(batch) == 0:
+            return
+
+        if stats is not None:
+            with stats.timed("ids"):
+                ids = metric_ids(batch, account_brand_id, id_mode)
+        else:
+            ids = metric_ids(batch, account_brand_id, id_mode)
+        for metric, id in zip(batch, ids):
+            yield metric_to_funnel_metrics(metric, account_brand_id, id)
+
+
+def funnel_metric_rows(body, account_brand_id, id_mode=ID_MODE_SHA256, metric_filter=None,
+                       decoder=DECODER_STREAM) -> List[tuple]:
+    """Parses a whole bulk funnel response body into rows of FunnelMetrics
+    fields. Meant to run in a worker process: rows are cheaper to send back
+    than the metrics, and the interned strings they share are pickled once.
+
+    Any `decoder` but the streaming one decodes the body in one go. With
+    blake2b ids the metrics are decoded into columns, filtered and hashed
+    column by column, sha256 ids hash the whole metric so they still need
+    one dict per metric."""
+    selects_rows = metric_filter is not None and metric_filter.selects_rows
+    if decoder != DECODER_STREAM and id_mode == ID_MODE_BLAKE2B:
+        columns = decode_columns(body, decoder)
+        if selects_rows:
+            columns = metric_filter.select_columns(columns)
+        ids = blake2b_column_ids(columns, account_brand_id)
+        for field in CATEGORICAL_FIELDS:
+            columns[field] = list(map(intern, columns[field]))
+        return list(zip(ids, repeat(account_brand_id), *[columns[field] for field in ID_FIELDS]))
+
+    row = attrgetter(*FunnelMetrics.__slots__)
+    if decoder == DECODER_STREAM:
+        return [row(metric) for metric in iter_funnel_metrics([body], account_brand_id, id_mode, metric_filter=metric_filter)]
+
+    metrics = decode_metrics(body, decoder)
+    if selects_rows:
+        metrics = list(filter(metric_filter.accepts, metrics))
+    ids = metric_ids(metrics, account_brand_id, id_mode)
+    return [row(metric_to_funnel_metrics(metric, account_brand_id, id)) for metric, id in zip(metrics, ids)]
+
+
+def wave_fingerprint(ids) -> str:
+    """Returns a compact fingerprint of a wave's record ids that does not
+    depend on their order, so two downloads of a wave can be compared
+    without keeping the ids."""
+    count = 0
+    total = 0
+    for id in ids:
+        count += 1
+        total += int.from_bytes(blake2b(id.encode(), digest_size=8).digest(), 'big')
+
+    return f"{count}-{total & 0xFFFFFFFFFFFFFFFF:016x}"
 
 
 def mock_funnel_metric(
@@ -1,5 +1,10 @@
 import pytest
-from data_classes import json_to_funnel_metrics
+import json
+from hashlib import sha256
+import pickle
+from data_classes import ID_MODE_BLAKE2B, ID_MODES, FunnelMetrics, MetricFilter, funnel_metric_rows, json_to_funnel_metrics, iter_funnel_metrics, metric_ids, \
+    wave_fingerprint
+from json_decoders import DECODERS, DECODER_STREAM, available
 
 sample_json = {
     "accountBrandId": 123,
@@ -48,3 +53,132 @@ def test_json_to_funnel_metrics():
     assert (metric.weight == 1.5)
     assert (metric.base_weight == 1.0)
     assert (metric.percentage == 50.0)
+
+
+def test_iter_funnel_metrics_parses_a_chunked_response():
+    body = json.dumps(sample_json).encode()
+    chunks = [body[i:i + 16] for i in range(0, len(body), 16)]
+
+    result = list(iter_funnel_metrics(chunks, 123))
+
+    assert result == json_to_funnel_metrics(sample_json)
+
+
+def test_funnel_metric_rows_survive_being_sent_between_processes():
+    rows = pickle.loads(pickle.dumps(funnel_metric_rows(
+        json.dumps(sample_json).encode(), 123, ID_MODE_BLAKE2B)))
+
+    assert [FunnelMetrics(*row) for row in rows] == json_to_funnel_metrics(
+        sample_json, ID_MODE_BLAKE2B)
+
+
+def test_sha256_ids_are_the_hash_of_the_sorted_metric_json():
+    metric = sample_json["metrics"][0]
+
+    result = json_to_funnel_metrics(sample_json)
+
+    assert result[0].id == sha256(json.dumps(
+        metric, sort_keys=True).encode()).hexdigest()
+
+
+def test_blake2b_ids_are_stable_and_depend_on_every_id_field():
+    metric = sample_json["metrics"][0]
+
+    ids = metric_ids([metric, dict(metric), dict(metric, percentage=51.0)],
+                     123, ID_MODE_BLAKE2B)
+
+    assert len(ids[0]) == 32
+    assert ids[0] == ids[1]
+    assert ids[0] != ids[2]
+
+
+def test_blake2b_ids_depend_on_the_account_brand():
+    metric = sample_json["metrics"][0]
+
+    assert metric_ids([metric], 1, ID_MODE_BLAKE2B) != metric_ids(
+        [metric], 2, ID_MODE_BLAKE2B)
+
+
+def test_raises_for_an_unknown_id_mode():
+    with pytest.raises(ValueError, match="unknown id mode"):
+        metric_ids(sample_json["metrics"], 123, "md5")
+
+
+def test_funnel_metrics_share_their_categorical_strings():
+    body = json.dumps(dict(sample_json, metrics=sample_json["metrics"] * 2))
+
+    first, second = iter_funnel_metrics([body.encode()], 123)
+
+    assert not hasattr(first, "__dict__")
+    assert first.brand_name is second.brand_name
+    assert first.question_type is second.question_type
+
+
+def test_wave_fingerprints_ignore_order_but_not_content():
+    assert wave_fingerprint(["a", "b", "c"]) == wave_fingerprint(["c", "a", "b"])
+    assert wave_fingerprint(["a", "b", "c"]) != wave_fingerprint(["a", "b", "d"])
+    assert wave_fingerprint(["a", "b"]) != wave_fingerprint(["a", "b", "b"])
+
+
+def test_metric_filters_parse_comma_separated_filter_types():
+    assert MetricFilter.of(" Gender,Age ,") == MetricFilter(filter_types=("Age", "Gender"))
+    assert MetricFilter.of("All") == MetricFilter()
+    assert MetricFilter.of("Age,All") == MetricFilter()
+    assert MetricFilter.of("") == MetricFilter()
+
+
+def test_metric_filters_match_filter_types_whatever_their_case():
+    assert MetricFilter.of("age, GENDER") == MetricFilter(filter_types=("Age", "Gender"))
+    assert MetricFilter.of("total").key == "Total"
+    assert MetricFilter.of("all") == MetricFilter()
+
+
+def test_metric_filters_raise_for_an_unknown_filter_type():
+    # an unknown filter type would sync no metrics and still record its waves as synced
+    with pytest.raises(ValueError, match="unknown filter type\\(s\\) Region"):
+        MetricFilter.of("Age,Region")
+
+
+def test_metric_filters_keep_the_state_key_of_a_single_filter_type():
+    assert MetricFilter.of("Total").key == "Total"
+    assert MetricFilter.of("All").key == "All"
+    assert MetricFilter(filter_types=("Age", "Gender"), geographies=("Australia",)).key == \
+        "Age,Gender;geography=Australia"
+
+
+def test_metric_filters_request_each_filter_type_with_the_other_selections():
+    metric_filter = MetricFilter(filter_types=("Age", "Gender"), categories=("Beverages",))
+
+    assert metric_filter.request_filter_types == ("Age", "Gender")
+    assert metric_filter.query_params("Age") == {"filterType": "Age", "category": ["Beverages"]}
+    assert MetricFilter().request_filter_types == (None,)
+    assert MetricFilter().query_params(None) == {}
+
+
+def test_iter_funnel_metrics_drops_metrics_the_filter_does_not_select():
+    metric = sample_json["metrics"][0]
+    other_geography = {**metric, "geography": "Elsewhere"}
+    body = json.dumps({"accountBrandId": 123, "metrics": [metric, other_geography]}).encode()
+
+    result = list(iter_funnel_metrics([body], 123, metric_filter=MetricFilter(
+        geographies=(metric["geography"],))))
+
+    assert [metric.geography_name for metric in result] == [metric["geography"]]
+
+
+@pytest.mark.parametrize("decoder", [decoder for decoder in DECODERS if decoder != DECODER_STREAM])
+@pytest.mark.parametrize("id_mode", ID_MODES)
+def test_funnel_metric_rows_decoded_in_one_go_match_the_streamed_rows(decoder, id_mode):
+    if not available(decoder):
+        pytest.skip(f"{decoder} is not installed")
+    metric = sample_json["metrics"][0]
+    metrics = [metric, {**metric, "geography": "Elsewhere", "base": 7.0},
+               {**metric, "brandName": "Pepsi", "filterType": "Age"}]
+    body = json.dumps({"accountBrandId": 123, "metrics": metrics}).encode()
+    metric_filter = MetricFilter(geographies=(metric["geography"],))
+
+    for selected in [None, metric_filter]:
+        rows = funnel_metric_rows(body, 123, id_mode, selected, decoder)
+
+        assert rows == funnel_metric_rows(body, 123, id_mode, selected)
+    assert len(rows) == 2
@@ -0,0 +1,89 @@
+import json
+from operator import attrgetter
+from typing import List, Union
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# the body is parsed a batch of metrics at a time as it downloads, see json_stream
+DECODER_STREAM = "stream"
+# the whole body is decoded at once, the rest decode a downloaded body faster with more memory
+DECODER_STDLIB = "stdlib"
+DECODER_ORJSON = "orjson"
+# decodes the metrics straight into typed structs rather than dicts
+DECODER_MSGSPEC = "msgspec"
+DECODERS = [DECODER_STREAM, DECODER_STDLIB, DECODER_ORJSON, DECODER_MSGSPEC]
+
+# the fields of a bulk funnel metric, in the order they are hashed into blake2b ids
+METRIC_FIELDS = ('brandId', 'brandName', 'filter', 'filterType', 'waveDate', 'category',
+                 'geography', 'base', 'weight', 'baseWeight', 'percentage', 'questionType')
+
+if msgspec is not None:
+    # numbers keep the type they were sent with, an id hashes 1 and 1.0 differently
+    class _Metric(msgspec.Struct):
+        brandId: int
+        brandName: str
+        filter: str
+        filterType: str
+        waveDate: str
+        category: str
+        geography: str
+        base: Union[int, float]
+        weight: Union[int, float]
+        baseWeight: Union[int, float]
+        percentage: Union[int, float]
+        questionType: str
+
+    class _BulkFunnel(msgspec.Struct):
+        metrics: List[_Metric]
+
+    _bulk_funnel_decoder = msgspec.json.Decoder(_BulkFunnel)
+    _metrics_decoder = msgspec.json.Decoder()
+
+
+def available(decoder):
+    return (decoder in (DECODER_STREAM, DECODER_STDLIB)
+            or (decoder == DECODER_ORJSON and orjson is not None)
+            or (decoder == DECODER_MSGSPEC and msgspec is not None))
+
+
+def resolve(decoder):
+    """Returns `decoder`, or the stdlib decoder if its package isn't installed."""
+    if decoder not in DECODERS:
+        raise ValueError(
+            f"unknown JSON decoder {decoder}, expected one of {DECODERS}")
+
+    if not available(decoder):
+        print(f"{decoder} is not installed, decoding JSON with {DECODER_STDLIB}")
+        return DECODER_STDLIB
+
+    return decoder
+
+
+def decode_metrics(body, decoder=DECODER_STDLIB):
+    """Returns the metrics of a whole bulk funnel response body as dicts."""
+    if decoder == DECODER_ORJSON:
+        return orjson.loads(body)['metrics']
+    if decoder == DECODER_MSGSPEC:
+        return _metrics_decoder.decode(body)['metrics']
+
+    return json.loads(body)['metrics']
+
+
+def decode_columns(body, decoder=DECODER_STDLIB):
+    """Returns the metrics of a whole bulk funnel response body as a list of
+    values per field, keyed by field. msgspec decodes them without building
+    a dict per metric."""
+    if decoder == DECODER_MSGSPEC:
+        metrics = _bulk_funnel_decoder.decode(body).metrics
+        return {field: list(map(attrgetter(field), metrics)) for field in METRIC_FIELDS}
+
+    metrics = decode_metrics(body, decoder)
+    return {field: [metric[field] for metric in metrics] for field in METRIC_FIELDS}
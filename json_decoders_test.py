@@ -0,0 +1,52 @@
+import json
+import pytest
+import json_decoders
+from json_decoders import DECODERS, DECODER_MSGSPEC, DECODER_ORJSON, DECODER_STDLIB, DECODER_STREAM, METRIC_FIELDS, \
+    available, decode_columns, decode_metrics, resolve
+
+metrics = [
+    {"accountBrandId": 123, "brandId": 456, "brandName": "Coke", "filter": "All", "filterType": "None",
+     "waveDate": "2023-08-01", "questionType": "Preference", "category": "Beverages", "geography": "USA",
+     "base": 100, "weight": 1.5, "baseWeight": 1, "percentage": 50.0},
+    {"accountBrandId": 123, "brandId": 789, "brandName": "Pepsi", "filter": "18-24", "filterType": "Age",
+     "waveDate": "2023-09-01", "questionType": "Awareness", "category": "Beverages", "geography": "USA",
+     "base": 80, "weight": 0.5, "baseWeight": 2.0, "percentage": 12.5},
+]
+body = json.dumps({"accountBrandId": 123, "metrics": metrics}).encode()
+
+whole_body_decoders = [decoder for decoder in DECODERS if decoder != DECODER_STREAM]
+
+
+@pytest.mark.parametrize("decoder", whole_body_decoders)
+def test_decodes_the_metrics_of_a_body(decoder):
+    if not available(decoder):
+        pytest.skip(f"{decoder} is not installed")
+
+    assert decode_metrics(body, decoder) == metrics
+
+
+@pytest.mark.parametrize("decoder", whole_body_decoders)
+def test_decodes_a_body_into_columns_that_keep_each_number_type(decoder):
+    if not available(decoder):
+        pytest.skip(f"{decoder} is not installed")
+
+    columns = decode_columns(body, decoder)
+
+    assert list(columns) == list(METRIC_FIELDS)
+    assert columns["brandName"] == ["Coke", "Pepsi"]
+    assert [str(value) for value in columns["baseWeight"]] == ["1", "2.0"]
+
+
+def test_resolves_a_decoder_that_is_not_installed_to_stdlib(monkeypatch, capsys):
+    monkeypatch.setattr(json_decoders, "msgspec", None)
+    monkeypatch.setattr(json_decoders, "orjson", None)
+
+    assert resolve(DECODER_MSGSPEC) == DECODER_STDLIB
+    assert resolve(DECODER_ORJSON) == DECODER_STDLIB
+    assert resolve(DECODER_STREAM) == DECODER_STREAM
+    assert "msgspec is not installed" in capsys.readouterr().out
+
+
+def test_raises_for_an_unknown_decoder():
+    with pytest.raises(ValueError, match="unknown JSON decoder"):
+        resolve("simdjson")
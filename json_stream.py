@@ -0,0 +1,110 @@
+import codecs
+import json
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+class _IncompleteValue(Exception):
+    pass
+
+
+class _Buffer:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+
+        if self.pos > 0:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+
+        for chunk in self.chunks:
+            if not chunk:
+                continue
+            self.text += self.text_decoder.decode(chunk)
+            return True
+
+        self.text += self.text_decoder.decode(b"", final=True)
+        self.eof = True
+        return True
+
+    def skip_whitespace(self):
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text) or not self.fill():
+                return
+
+    def peek(self):
+        self.skip_whitespace()
+        if self.pos >= len(self.text):
+            raise ValueError("unexpected end of JSON document")
+        return self.text[self.pos]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(
+                f"expected {char!r} at position {self.pos} of JSON document")
+        self.pos += 1
+
+    def value(self):
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = self.__decode()
+                self.pos = end
+                return value
+            except _IncompleteValue:
+                if not self.fill():
+                    raise ValueError("unexpected end of JSON document")
+
+    def __decode(self):
+        try:
+            value, end = _decoder.raw_decode(self.text, self.pos)
+        except json.JSONDecodeError:
+            if self.eof:
+                raise
+            raise _IncompleteValue()
+
+        # a number at the end of the buffer may continue in the next chunk
+        if end == len(self.text) and not self.eof:
+            raise _IncompleteValue()
+
+        return value, end
+
+
+def iter_array_items(chunks, key):
+    """Yields the items of the top level array `key` of a JSON object one at a
+    time, reading `chunks` of bytes only as far as needed."""
+    buffer = _Buffer(chunks)
+    buffer.expect("{")
+    if buffer.peek() == "}":
+        raise ValueError(f"key {key!r} not found in JSON document")
+
+    while True:
+        name = buffer.value()
+        buffer.expect(":")
+        if name == key:
+            break
+
+        buffer.value()
+        if buffer.peek() == "}":
+            raise ValueError(f"key {key!r} not found in JSON document")
+        buffer.expect(",")
+
+    buffer.expect("[")
+    if buffer.peek() == "]":
+        return
+
+    while True:
+        yield buffer.value()
+        if buffer.peek() == "]":
+            return
+        buffer.expect(",")
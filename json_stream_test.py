@@ -0,0 +1,49 @@
+import json
+import pytest
+from json_stream import iter_array_items
+
+
+def chunked(document, size):
+    encoded = document.encode()
+    return [encoded[i:i + size] for i in range(0, len(encoded), size)]
+
+
+sample_document = json.dumps({
+    "accountBrandId": 123,
+    "category": {"id": 1, "name": "Beverages, \"fizzy\" [all]"},
+    "metrics": [
+        {"brandName": "Coke", "base": 100, "weight": 1.5},
+        {"brandName": "Pepsi ✓", "base": 12345, "weight": 0.25},
+    ],
+    "geography": {"id": 10, "name": "USA"},
+}, indent=2)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64, 4096])
+def test_yields_every_item_of_the_array_regardless_of_chunk_size(chunk_size):
+    result = list(iter_array_items(
+        chunked(sample_document, chunk_size), "metrics"))
+
+    assert result == json.loads(sample_document)["metrics"]
+
+
+def test_yields_nothing_for_an_empty_array():
+    assert list(iter_array_items([b'{"metrics": []}'], "metrics")) == []
+
+
+def test_does_not_read_past_the_end_of_the_array():
+    def chunks():
+        yield b'{"metrics": [1, 2]'
+        raise AssertionError("read past the end of the array")
+
+    assert list(iter_array_items(chunks(), "metrics")) == [1, 2]
+
+
+def test_raises_if_the_key_is_missing():
+    with pytest.raises(ValueError, match="not found"):
+        list(iter_array_items([b'{"other": [1]}'], "metrics"))
+
+
+def test_raises_if_the_document_is_truncated():
+    with pytest.raises(ValueError):
+        list(iter_array_items([b'{"metrics": [{"base": 1}, {"ba'], "metrics"))
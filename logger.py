@@ -1,30 +1,137 @@
 import logging
-import requests
+import os
+import queue
+import threading
+import time
 
 
-SUMO_LOGIC_URL = "https://collectors.au.sumologic.com/receiver/v1/http/ZaVnC4dhaV2TQKUB12dUiOO7DEirKLsOU4U6jUJRY9XIz4Bskyo4Dp6jqIy9ck6Dbk_AaS3tFqcPagLjvZQ4W5KXkn5YxRJakgF7W-D7pCznCtIkkejjvw=="
+SUMO_LOGIC_URL = os.getenv(
+    "SUMO_LOGIC_URL", "https://collectors.au.sumologic.com/receiver/v1/http/ZaVnC4dhaV2TQKUB12dUiOO7DEirKLsOU4U6jUJRY9XIz4Bskyo4Dp6jqIy9ck6Dbk_AaS3tFqcPagLjvZQ4W5KXkn5YxRJakgF7W-D7pCznCtIkkejjvw==")
+
+_FLUSH = object()
+_CLOSE = object()
 
 
 class SumoLogger(logging.Handler):
-    def __init__(self, endpoint_url):
+    """Ships log records to a Sumo Logic HTTP collector without blocking the
+    thread that logs.
+
+    Records are queued and posted by a background thread, `batch_size` at a
+    time or every `flush_interval` seconds, over one pooled session. When
+    `max_queued` records are already waiting new ones are dropped and
+    counted instead of stalling the caller. Closing the handler, which
+    logging does at exit, ships what is left.
+
+    Nothing is set up until the first record is logged, so importing the
+    module stays cheap and a process that never logs never starts the
+    thread or imports requests."""
+
+    def __init__(self, endpoint_url, batch_size=100, flush_interval=5.0, max_queued=10000, timeout=(5.0, 10.0)):
         super().__init__()
         self.endpoint_url = endpoint_url
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.session = None
+        self.records = queue.Queue(maxsize=max_queued)
+        self.dropped = 0
+        # not the handler's own lock, logging holds that while it flushes
+        self.dropped_lock = threading.Lock()
+        self.shipper = None
+        self.shipper_lock = threading.Lock()
+
+    def __start(self):
+        with self.shipper_lock:
+            if self.shipper is not None:
+                return
+
+            import requests
+
+            self.session = requests.Session()
+            self.shipper = threading.Thread(
+                target=self.__ship, name="sumo-logger", daemon=True)
+            self.shipper.start()
 
     def emit(self, record):
-        log_entry = self.format(record)
         try:
-            print(log_entry.encode('utf-8'))
-            response = requests.post(
-                self.endpoint_url, data=log_entry.encode('utf-8'))
-            response.raise_for_status()
+            log_entry = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        print(log_entry)
+        if self.shipper is None:
+            self.__start()
+        try:
+            self.records.put_nowait(log_entry)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
 
+    def flush(self):
+        """Waits until every record queued so far has been shipped."""
+        if self.shipper is None or not self.shipper.is_alive():
+            return
+
+        flushed = threading.Event()
+        self.records.put((_FLUSH, flushed))
+        flushed.wait()
+
+    def close(self):
+        if self.shipper is not None and self.shipper.is_alive():
+            self.records.put((_CLOSE, None))
+            self.shipper.join()
+        if self.session is not None:
+            self.session.close()
+        super().close()
+
+    def __ship(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self.records.get(
+                    timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, str):
+                batch.append(item)
+                if len(batch) < self.batch_size:
+                    continue
+            self.__post(batch)
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+
+            if isinstance(item, tuple):
+                control, flushed = item
+                if control is _CLOSE:
+                    return
+                flushed.set()
+
+    def __post(self, batch):
+        import requests
+
+        with self.dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped > 0:
+            batch.append(
+                f"{dropped} log records were dropped, the log queue was full")
+        if len(batch) == 0:
+            return
+
+        try:
+            response = self.session.post(
+                self.endpoint_url, data="\n".join(batch).encode('utf-8'), timeout=self.timeout)
+            response.raise_for_status()
         except requests.exceptions.RequestException as e:
             print(f"Failed to send log to Sumo Logic: {e}")
 
 
 logger = logging.getLogger('sumo_logger')
 logger.setLevel(logging.DEBUG)
-sumo_handler = SumoLogger(SUMO_LOGIC_URL)
-sumo_handler.setLevel(logging.DEBUG)
+if SUMO_LOGIC_URL:
+    sumo_handler = SumoLogger(SUMO_LOGIC_URL)
+    sumo_handler.setLevel(logging.DEBUG)
 
-logger.addHandler(sumo_handler)
+    logger.addHandler(sumo_handler)
@@ -0,0 +1,142 @@
+import logging
+import os
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from logger import SumoLogger
+
+
+class Collector:
+    """A local stand-in for a Sumo Logic HTTP collector."""
+
+    def __init__(self, delay=None):
+        self.bodies = []
+        self.delay = delay
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if collector.delay is not None:
+                    collector.delay.wait()
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                collector.bodies.append(body.decode())
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05},
+                         daemon=True).start()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/receiver"
+
+    @property
+    def lines(self):
+        return [line for body in self.bodies for line in body.split("\n")]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def collector():
+    collector = Collector()
+    yield collector
+    collector.close()
+
+
+def sumo_logger(handler):
+    logger = logging.getLogger(f"sumo_logger_test_{id(handler)}")
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(handler)
+    return logger
+
+
+def test_ships_records_in_batches(collector):
+    handler = SumoLogger(collector.url, batch_size=2, flush_interval=60)
+    logger = sumo_logger(handler)
+
+    for i in range(5):
+        logger.error("record %s", i)
+    handler.close()
+
+    assert collector.bodies == ["record 0\nrecord 1", "record 2\nrecord 3", "record 4"]
+
+
+def test_ships_a_partial_batch_once_the_flush_interval_passes(collector):
+    handler = SumoLogger(collector.url, batch_size=100, flush_interval=0.05)
+    sumo_logger(handler).error("record")
+
+    for _ in range(100):
+        if len(collector.bodies) > 0:
+            break
+        threading.Event().wait(0.02)
+    handler.close()
+
+    assert collector.lines == ["record"]
+
+
+def test_flush_waits_until_queued_records_are_shipped(collector):
+    handler = SumoLogger(collector.url, batch_size=100, flush_interval=60)
+    logger = sumo_logger(handler)
+
+    logger.error("record")
+    handler.flush()
+
+    assert collector.lines == ["record"]
+    handler.close()
+
+
+def test_drops_records_instead_of_blocking_when_the_queue_is_full():
+    delay = threading.Event()
+    collector = Collector(delay)
+    handler = SumoLogger(collector.url, batch_size=1,
+                         flush_interval=60, max_queued=2)
+    logger = sumo_logger(handler)
+
+    for i in range(10):
+        logger.error("record %s", i)
+    delay.set()
+    handler.close()
+    collector.close()
+
+    shipped = [line for line in collector.lines if line.startswith("record")]
+    dropped = [line for line in collector.lines if line.endswith(
+        "log records were dropped, the log queue was full")]
+    assert len(dropped) == 1
+    assert len(shipped) + int(dropped[0].split()[0]) == 10
+
+
+def test_does_not_raise_if_the_collector_is_unreachable(collector):
+    handler = SumoLogger("http://127.0.0.1:1/receiver", timeout=(0.1, 0.1))
+
+    sumo_logger(handler).error("record")
+    handler.close()
+
+
+def test_importing_the_logger_does_not_start_shipping():
+    result = subprocess.run(
+        [sys.executable, "-c", "import sys, threading, logger; print('requests' in sys.modules, threading.active_count())"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True)
+
+    assert result.stdout.split() == ["False", "1"]
+
+
+def test_closes_a_handler_that_never_logged(collector):
+    handler = SumoLogger(collector.url)
+
+    handler.flush()
+    handler.close()
+
+    assert handler.shipper is None
+    assert collector.bodies == []
@@ -1,13 +1,9 @@
-from metric_fetcher import MetricFetcher, MetricFetcherRepo
-from metric_syncer import MetricSyncer, MetricSyncerRepo
 import grpc
 from concurrent import futures
 import json
 import sys
 import argparse
-from dotenv import load_dotenv
 import os
-from logger import logger
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 target_path = os.path.join(script_dir, 'sdk_pb2')
@@ -15,11 +11,20 @@ sys.path.append(target_path)
 
 from sdk_pb2 import connector_sdk_pb2, common_pb2, connector_sdk_pb2_grpc  # noqa: E402
 
-load_dotenv()
+# RPCs served at once, every Update stream holds a worker for as long as it syncs
+DEFAULT_MAX_WORKERS = 10
+
+# the fetch and sync modules, and requests, jwt and dateutil with them, are imported by the first RPC that needs
+# them rather than at start up, so a new server is listening as soon as grpc and the sdk are loaded
 
 
 class ConnectorService(connector_sdk_pb2_grpc.ConnectorServicer):
     def ConfigurationForm(self, request, context):
+        from data_classes import ID_MODES
+        from json_decoders import DECODERS
+        from metric_fetcher import DEFAULT_CONCURRENT_REQUESTS, EMISSION_ORDERS
+        from metric_syncer import DEFAULT_CHECKPOINT_BYTES, DEFAULT_CHECKPOINT_RECORDS, DEFAULT_CHECKPOINT_SECONDS
+
         form_fields = common_pb2.ConfigurationFormResponse(schema_selection_supported=False,
                                                            table_selection_supported=False)
         form_fields.fields.add(name="jwt",
@@ -38,16 +43,121 @@ class ConnectorService(connector_sdk_pb2_grpc.ConnectorServicer):
                                )
         form_fields.fields.add(name="filters",
                                label="Filters",
-                               description="""Filters the funnel metrics category of funnel metrics returned.
+                               description="""Filters the funnel metrics category of funnel metrics returned, one or more of Total, Age and Gender
+                                            seperated by a comma \\(,\\).
                                                 Note: Total is the metrics with no filters applied,
-                                                All will return all possible results for every filter""",
+                                                All or nothing will return all possible results for every filter""",
+                               required=False,
+                               text_field=common_pb2.TextField.PlainText
+                               )
+        form_fields.fields.add(name="geographies",
+                               label="Geographies",
+                               description="""Geographies to sync, seperated by a comma \\(,\\).
+                                            Note: putting nothing in this field will sync every geography""",
+                               required=False,
+                               text_field=common_pb2.TextField.PlainText
+                               )
+        form_fields.fields.add(name="categories",
+                               label="Categories",
+                               description="""Categories to sync, seperated by a comma \\(,\\).
+                                            Note: putting nothing in this field will sync every category""",
+                               required=False,
+                               text_field=common_pb2.TextField.PlainText
+                               )
+        form_fields.fields.add(name="question_types",
+                               label="Question types",
+                               description="""Question types to sync, for example PROMPTED_AWARENESS, seperated by a comma \\(,\\).
+                                            Note: putting nothing in this field will sync every question type""",
+                               required=False,
+                               text_field=common_pb2.TextField.PlainText
+                               )
+        form_fields.fields.add(name="wave_window_months",
+                               label="Wave window (months)",
+                               description="""The number of monthly waves requested from Tracksuit at a time.
+                                                Smaller windows checkpoint more often, larger windows make fewer requests""",
+                               required=False,
+                               dropdown_field=common_pb2.DropdownField(
+                                   dropdown_field=["1", "3", "6", "12"])
+                               )
+        form_fields.fields.add(name="id_mode",
+                               label="Record ID format",
+                               description="""How the id of each funnel metric is derived.
+                                                sha256 matches connections created before blake2b was available and is the default,
+                                                blake2b is faster. Changing this on an existing connection will duplicate its records""",
+                               required=False,
+                               dropdown_field=common_pb2.DropdownField(
+                                   dropdown_field=ID_MODES)
+                               )
+        form_fields.fields.add(name="lookback_waves",
+                               label="Lookback waves",
+                               description="""The number of already synced waves re-checked for corrections on every sync, defaults to 0.
+                                                Only waves whose records have changed are synced again""",
+                               required=False,
+                               text_field=common_pb2.TextField.PlainText
+                               )
+        form_fields.fields.add(name="concurrent_requests",
+                               label="Concurrent requests",
+                               description=f"""The number of requests made to Tracksuit at once, defaults to {DEFAULT_CONCURRENT_REQUESTS}""",
+                               required=False,
+                               text_field=common_pb2.TextField.PlainText
+                               )
+        form_fields.fields.add(name="checkpoint_records",
+                               label="Checkpoint records",
+                               description=f"""The number of records synced between checkpoints, defaults to {DEFAULT_CHECKPOINT_RECORDS}.
+                                                A checkpoint is also taken after the checkpoint bytes or seconds, whichever comes first""",
+                               required=False,
+                               text_field=common_pb2.TextField.PlainText
+                               )
+        form_fields.fields.add(name="checkpoint_bytes",
+                               label="Checkpoint bytes",
+                               description=f"""The bytes of encoded records synced between checkpoints, defaults to {DEFAULT_CHECKPOINT_BYTES}""",
+                               required=False,
+                               text_field=common_pb2.TextField.PlainText
+                               )
+        form_fields.fields.add(name="checkpoint_seconds",
+                               label="Checkpoint seconds",
+                               description=f"""The seconds between checkpoints, defaults to {DEFAULT_CHECKPOINT_SECONDS}.
+                                                Fewer checkpoints sync faster, more checkpoints redo less of an interrupted sync""",
+                               required=False,
+                               text_field=common_pb2.TextField.PlainText
+                               )
+        form_fields.fields.add(name="parse_processes",
+                               label="Parse processes",
+                               description="""The number of worker processes that parse responses from Tracksuit, defaults to 0.
+                                                0 parses them in the fetch threads, more processes use more cores for large account brands""",
+                               required=False,
+                               text_field=common_pb2.TextField.PlainText
+                               )
+        form_fields.fields.add(name="response_cache",
+                               label="Response cache",
+                               description="""Keeps the responses downloaded from Tracksuit on disk for a day, defaults to on.
+                                                A retried sync replays them instead of downloading them again, off always downloads them""",
+                               required=False,
+                               dropdown_field=common_pb2.DropdownField(
+                                   dropdown_field=["on", "off"])
+                               )
+        form_fields.fields.add(name="json_decoder",
+                               label="JSON decoder",
+                               description="""How responses from Tracksuit are decoded, defaults to stream.
+                                                stream parses a response as it downloads, the others decode whole responses faster with more memory.
+                                                orjson and msgspec fall back to stdlib when they are not installed""",
+                               required=False,
+                               dropdown_field=common_pb2.DropdownField(
+                                   dropdown_field=DECODERS)
+                               )
+        form_fields.fields.add(name="emission_order",
+                               label="Record order",
+                               description="""The order records are sent in, defaults to ordered.
+                                                ordered sends each wave window in wave date order once every account brand in it has been fetched,
+                                                unordered sends each account brand's records as soon as they have been fetched""",
                                required=False,
                                dropdown_field=common_pb2.DropdownField(
-                                   dropdown_field=["All", "Total", "Age", "Gender"])
+                                   dropdown_field=EMISSION_ORDERS)
                                )
 
         # used for testing the connection locally
         form_fields.tests.add(name="connection_test", label="Tests connection")
+        form_fields.tests.add(name="sync_plan", label="Plans a full sync")
 
         return form_fields
 
@@ -55,11 +165,16 @@ class ConnectorService(connector_sdk_pb2_grpc.ConnectorServicer):
         test_name = request.name
         print("Test name: ", test_name)
         if test_name == "connection_test":
+            from metric_fetcher import MetricFetcher, MetricFetcherRepo
+
             try:
                 jwt_token = request.configuration.get("jwt", "")
                 account_brand_ids_requested = self.account_brand_ids_requested(request.configuration.get(
                     "account_brand_ids", ''))
-                fetcherRepo = MetricFetcherRepo(jwt_token)
+                # a selection the API doesn't have fails the test rather than every sync after it
+                self.metric_filter(request.configuration)
+                fetcherRepo = MetricFetcherRepo(
+                    jwt_token, base_url=os.getenv("TRACKSUIT_API_URL"))
                 fetcher = MetricFetcher(fetcherRepo)
 
                 fetcher.account_brand_ids_to_sync(
@@ -68,26 +183,39 @@ class ConnectorService(connector_sdk_pb2_grpc.ConnectorServicer):
                 return common_pb2.TestResponse(success=True)
             except Exception as e:
                 return common_pb2.TestResponse(success=False, failure=str(e))
+        if test_name == "sync_plan":
+            from metric_fetcher import PARTITION_SIZES, MetricFetcher, MetricFetcherRepo
+
+            try:
+                fetcher_repo = MetricFetcherRepo(
+                    request.configuration.get("jwt", ""), base_url=os.getenv("TRACKSUIT_API_URL"))
+                with MetricFetcher(fetcher_repo, self.wave_window_months(request.configuration.get("wave_window_months", "")),
+                                   self.concurrent_requests(request.configuration.get("concurrent_requests", ""))) as fetcher:
+                    account_brand_ids = fetcher.account_brand_ids_to_sync(self.account_brand_ids_requested(
+                        request.configuration.get("account_brand_ids", '')))
+                    wave_ranges = fetcher.wave_ranges_to_sync(account_brand_ids, {})
+                    if wave_ranges is None:
+                        return common_pb2.TestResponse(success=False, failure="there is nothing to sync")
+
+                    # sized by the last sync of the configuration this server ran, if any
+                    sizes = PARTITION_SIZES.lookup(
+                        (fetcher_repo.base_url, fetcher_repo.subject, self.metric_filter(request.configuration).key))
+                    plan = fetcher.plan(wave_ranges, sizes=sizes[0] if sizes is not None else None)
+
+                print(f"Sync plan: {plan.describe()}")
+                return common_pb2.TestResponse(success=True)
+            except Exception as e:
+                return common_pb2.TestResponse(success=False, failure=str(e))
 
     def Schema(self, request, context):
+        from data_classes import FUNNEL_METRICS_COLUMNS, FUNNEL_METRICS_PRIMARY_KEY, FUNNEL_METRICS_TABLE
+
         table_list = common_pb2.TableList()
 
-        t1 = table_list.tables.add(name="funnel_metrics")
-        t1.columns.add(name="id", type=common_pb2.DataType.STRING,
-                       primary_key=True)
-        t1.columns.add(name="account_brand_id", type=common_pb2.DataType.INT)
-        t1.columns.add(name="brand_id", type=common_pb2.DataType.INT)
-        t1.columns.add(name="brand_name", type=common_pb2.DataType.STRING)
-        t1.columns.add(name="filter", type=common_pb2.DataType.STRING)
-        t1.columns.add(name="filter_type", type=common_pb2.DataType.STRING)
-        t1.columns.add(name="wave_date", type=common_pb2.DataType.STRING)
-        t1.columns.add(name="category_name", type=common_pb2.DataType.STRING)
-        t1.columns.add(name="geography_name", type=common_pb2.DataType.STRING)
-        t1.columns.add(name="base", type=common_pb2.DataType.INT)
-        t1.columns.add(name="weight", type=common_pb2.DataType.DOUBLE)
-        t1.columns.add(name="base_weight", type=common_pb2.DataType.DOUBLE)
-        t1.columns.add(name="percentage", type=common_pb2.DataType.DOUBLE)
-        t1.columns.add(name="question_type", type=common_pb2.DataType.STRING)
+        t1 = table_list.tables.add(name=FUNNEL_METRICS_TABLE)
+        for name, data_type in FUNNEL_METRICS_COLUMNS:
+            t1.columns.add(name=name, type=common_pb2.DataType.Value(data_type),
+                           primary_key=name == FUNNEL_METRICS_PRIMARY_KEY)
 
         return connector_sdk_pb2.SchemaResponse(without_schema=table_list)
 
@@ -97,7 +225,62 @@ class ConnectorService(connector_sdk_pb2_grpc.ConnectorServicer):
 
         return account_brand_ids.split(",")
 
+    def wave_window_months(self, wave_window_months):
+        if wave_window_months == "":
+            return 1
+
+        return int(wave_window_months)
+
+    def metric_filter(self, configuration):
+        from data_classes import MetricFilter, filter_type_selection, selection
+
+        return MetricFilter(filter_types=filter_type_selection(configuration.get("filters", "")),
+                            geographies=selection(
+                                configuration.get("geographies", "")),
+                            categories=selection(
+                                configuration.get("categories", "")),
+                            question_types=selection(configuration.get("question_types", "")))
+
+    def lookback_waves(self, lookback_waves):
+        if lookback_waves.strip() == "":
+            return 0
+
+        return int(lookback_waves)
+
+    def concurrent_requests(self, concurrent_requests):
+        from metric_fetcher import DEFAULT_CONCURRENT_REQUESTS
+
+        if concurrent_requests.strip() == "":
+            return DEFAULT_CONCURRENT_REQUESTS
+
+        return int(concurrent_requests)
+
+    def checkpoint_limit(self, limit, default, parse=int):
+        if limit.strip() == "":
+            return default
+
+        return parse(limit)
+
+    def parse_processes(self, parse_processes):
+        if parse_processes.strip() == "":
+            return 0
+
+        return int(parse_processes)
+
     def Update(self, request, context):
+        from data_classes import ID_MODE_SHA256
+        from json_decoders import DECODER_STREAM
+        from metric_fetcher import EMISSION_UNORDERED, PARTITION_SIZES, WAVE_DATES, MetricFetcher, MetricFetcherRepo, \
+            shared_parse_pool
+        from metric_syncer import DEFAULT_CHECKPOINT_BYTES, DEFAULT_CHECKPOINT_RECORDS, DEFAULT_CHECKPOINT_SECONDS, \
+            CheckpointPolicy, MetricSyncer, MetricSyncerRepo
+        from response_batcher import ResponseBatcher
+        from response_cache import DEFAULT_DIRECTORY as RESPONSE_CACHE_DIRECTORY, \
+            DEFAULT_MAX_BYTES as RESPONSE_CACHE_MAX_BYTES, shared_response_cache
+        from sync_stats import PROCESS_STATS, SyncStats
+        from wave_index import DEFAULT_DIRECTORY as WAVE_INDEX_DIRECTORY, WaveIndex
+
+        fetcher = None
         try:
             state = {}
             if request.HasField('state_json'):
@@ -110,53 +293,127 @@ class ConnectorService(connector_sdk_pb2_grpc.ConnectorServicer):
 
             print(account_brand_ids_requested)
 
-            filters = request.configuration.get("filters", None)
+            metric_filter = self.metric_filter(request.configuration)
+            # the state keeps each filter's progress under its key
+            filters = metric_filter.key
+
+            cursor = state.get("cursor", None)
+            synced_windows = state.get("synced_windows", None)
+
+            id_mode = request.configuration.get(
+                "id_mode", "") or ID_MODE_SHA256
+
+            concurrent_requests = self.concurrent_requests(
+                request.configuration.get("concurrent_requests", ""))
+
+            stats = SyncStats(parent=PROCESS_STATS)
+
+            parse_processes = self.parse_processes(
+                request.configuration.get("parse_processes", ""))
 
-            last_known_synced_record = state.get(
-                "last_known_synced_record", None)
-            last_date_synced_to = state.get(
-                "last_date_synced_to", None)
+            response_cache = None
+            if request.configuration.get("response_cache", "") != "off":
+                response_cache = shared_response_cache(os.getenv("RESPONSE_CACHE_DIR", RESPONSE_CACHE_DIRECTORY),
+                                                       int(os.getenv("RESPONSE_CACHE_MAX_BYTES", RESPONSE_CACHE_MAX_BYTES)))
 
-            fetcher_repo = MetricFetcherRepo(jwt_token)
-            fetcher = MetricFetcher(fetcher_repo)
+            fetcher_repo = MetricFetcherRepo(
+                jwt_token, id_mode, concurrent_requests, os.getenv("TRACKSUIT_API_URL"),
+                parse_pool=shared_parse_pool(parse_processes) if parse_processes > 0 else None, stats=stats,
+                response_cache=response_cache,
+                decoder=request.configuration.get("json_decoder", "") or DECODER_STREAM)
+            lookback_waves = self.lookback_waves(
+                request.configuration.get("lookback_waves", ""))
+            # the ids of re-checked waves are indexed so their corrections can be synced as upserts and deletes
+            wave_index = WaveIndex(os.getenv("WAVE_INDEX_DIR", WAVE_INDEX_DIRECTORY)
+                                   ) if lookback_waves > 0 else None
+            fetcher = MetricFetcher(fetcher_repo, self.wave_window_months(
+                request.configuration.get("wave_window_months", "")), concurrent_requests, lookback_waves, wave_index,
+                stats)
 
             operation = connector_sdk_pb2.Operation()
             syncer_repo = MetricSyncerRepo(
                 common_pb2, connector_sdk_pb2, operation)
-            syncer = MetricSyncer(syncer_repo)
+            checkpoint_policy = CheckpointPolicy(
+                max_records=self.checkpoint_limit(request.configuration.get(
+                    "checkpoint_records", ""), DEFAULT_CHECKPOINT_RECORDS),
+                max_bytes=self.checkpoint_limit(request.configuration.get(
+                    "checkpoint_bytes", ""), DEFAULT_CHECKPOINT_BYTES),
+                max_seconds=self.checkpoint_limit(request.configuration.get(
+                    "checkpoint_seconds", ""), DEFAULT_CHECKPOINT_SECONDS, float))
+            syncer = MetricSyncer(syncer_repo, checkpoint_policy, wave_index, stats)
 
             account_brand_ids = fetcher.account_brand_ids_to_sync(
                 account_brand_ids_requested)
 
-            wave_range = fetcher.wave_range_to_sync(
-                account_brand_ids, last_date_synced_to)
+            synced_to = MetricSyncer.synced_to(
+                state, filters, account_brand_ids)
+            # only an interrupted sync replays its cached responses, a new sync must see the API's corrections
+            if response_cache is not None and (cursor is not None or synced_windows is not None):
+                fetcher_repo.resume(synced_to)
+            wave_ranges = fetcher.wave_ranges_to_sync(
+                account_brand_ids, synced_to)
+            print("Wave date cache: ", WAVE_DATES.stats())
 
-            if wave_range is None:
+            if wave_ranges is None:
                 return
 
-            print("Wave Range to sync: ", wave_range)
+            print("Wave ranges to sync: ", wave_ranges)
 
-            funnel_metrics = fetcher.fetch_for(
-                account_brand_ids, wave_range["from"], wave_range["to"], filters)
+            fingerprints = MetricSyncer.fingerprints(
+                state, filters) if lookback_waves > 0 else None
+            # unordered syncs emit each partition as it arrives instead of waiting for its whole window
+            unordered = request.configuration.get("emission_order", "") == EMISSION_UNORDERED
+            fetch = fetcher.fetch_partitions if unordered else fetcher.fetch_windows
+            windows = fetch(wave_ranges, metric_filter, synced_windows, cursor, fingerprints,
+                            MetricSyncer.partition_sizes(state, filters))
 
-            yield from syncer.sync(funnel_metrics, state, last_known_synced_record, wave_range["to"])
+            yield from ResponseBatcher(stats=stats).stream(
+                syncer.sync_windows(windows, state, wave_ranges, filters, unordered))
+            PARTITION_SIZES.put((fetcher_repo.base_url, fetcher_repo.subject, filters),
+                                MetricSyncer.partition_sizes(state, filters))
         except Exception as e:
+            from logger import logger
+
             logger.error(
                 f"Error occurred while syncing metrics %s, account brand ids requested: %s", e, account_brand_ids_requested)
             raise e
+        finally:
+            if fetcher is not None:
+                fetcher.close()
+
+
+def create_server(address, max_workers=DEFAULT_MAX_WORKERS):
+    """Returns the connector's server bound to `address` and the port it is
+    bound to. Each RPC runs on its own worker, so up to `max_workers`
+    Update streams, Tests and Schema calls are served at once."""
+    server = grpc.server(futures.ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix="connector-rpc"))
+    connector_sdk_pb2_grpc.add_ConnectorServicer_to_server(
+        ConnectorService(), server)
+    port = server.add_insecure_port(address)
+    return server, port
 
 
 def start_server():
+    from dotenv import load_dotenv
+
+    load_dotenv()
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, default=50051,
                         help="The server port")
+    parser.add_argument("--max-workers", type=int, default=int(os.getenv("MAX_WORKERS", DEFAULT_MAX_WORKERS)),
+                        help="The number of RPCs served at once")
+    parser.add_argument("--metrics-port", type=int, default=int(os.getenv("METRICS_PORT", 0)),
+                        help="Serves Prometheus metrics of every sync on this local port when set")
     args = parser.parse_args()
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
-    connector_sdk_pb2_grpc.add_ConnectorServicer_to_server(
-        ConnectorService(), server)
-    server.add_insecure_port(f'[::]:{args.port}')
+    if args.metrics_port:
+        from sync_stats import PROCESS_STATS, serve_prometheus
+
+        serve_prometheus(PROCESS_STATS, args.metrics_port)
+        print(f"Serving metrics at http://127.0.0.1:{args.metrics_port}/metrics")
+    server, _ = create_server(f'[::]:{args.port}', args.max_workers)
     server.start()
-    print(f"Server started at port {args.port}...")
+    print(f"Server started at port {args.port} with {args.max_workers} workers...")
     server.wait_for_termination()
     print("Server terminated.")
 
@@ -1,13 +1,73 @@
 import concurrent
+import heapq
+import multiprocessing
 import requests
+from requests.adapters import HTTPAdapter
+from collections import deque
+from itertools import groupby
+from typing import NamedTuple
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
 import jwt
 import os
-from data_classes import json_to_funnel_metrics
+import threading
+from hashlib import sha256
+from data_classes import ID_MODE_SHA256, FunnelMetrics, MetricFilter, funnel_metric_rows, iter_funnel_metrics, wave_fingerprint
+from request_scheduler import RequestFailed, RequestScheduler, TokenBucket
+from sync_stats import SyncStats
+from response_cache import cache_key
+from json_decoders import DECODER_STREAM, resolve
+from ttl_cache import TTLCache
+from sync_planner import SyncPlan, WorkUnit, estimate, largest_first, partition_size, waves_between
 import warnings
 
+# minimum number of wave windows fetched ahead of the window currently being synced
+WINDOWS_IN_FLIGHT = 2
+# records are emitted in (wave_date, id) order a window at a time, see MetricFetcher.fetch_windows
+EMISSION_ORDERED = "ordered"
+# each partition's records are emitted as soon as it has been fetched, see MetricFetcher.fetch_partitions
+EMISSION_UNORDERED = "unordered"
+EMISSION_ORDERS = [EMISSION_ORDERED, EMISSION_UNORDERED]
+DEFAULT_CONCURRENT_REQUESTS = 10
+# requests a second made to the API across every worker
+DEFAULT_RATE_LIMIT = 20
+# the errors of a body whose connection broke or timed out part way through, the body is requested again
+RETRYABLE_READ_ERRORS = (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError,
+                         requests.exceptions.Timeout)
+
+# shared by every sync and test run by this process
+DECODED_TOKENS = TTLCache(max_entries=256, ttl=3600)
+# keyed by (api url, token subject, account brand id)
+WAVE_DATES = TTLCache(max_entries=4096, ttl=900)
+# the partition sizes of the last sync of each (api url, token subject, filter key), planned with by the sync_plan test
+PARTITION_SIZES = TTLCache(max_entries=256, ttl=7 * 24 * 3600)
+# keyed by (api url, token subject), so the syncs running at once for a token stay under its rate limit together
+RATE_LIMITERS = {}
+RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def shared_rate_limiter(key, rate_limit):
+    with RATE_LIMITERS_LOCK:
+        if key not in RATE_LIMITERS:
+            RATE_LIMITERS[key] = TokenBucket(rate_limit)
+        return RATE_LIMITERS[key]
+
+
+# keyed by number of processes, started once and shared by every sync that parses in worker processes
+PARSE_POOLS = {}
+PARSE_POOLS_LOCK = threading.Lock()
+
+
+def shared_parse_pool(processes):
+    with PARSE_POOLS_LOCK:
+        if processes not in PARSE_POOLS:
+            # spawned rather than forked, forking a process running gRPC and fetch threads isn't safe
+            PARSE_POOLS[processes] = ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        return PARSE_POOLS[processes]
+
 
 def decode_jwt(token):
     try:
@@ -19,22 +79,79 @@ def decode_jwt(token):
         return {}
 
 
+class FunnelData:
+    """The metrics returned by `MetricFetcherRepo.fetch_funnel_data`,
+    `replayed` once any of them have been replayed from the response cache."""
+
+    def __init__(self):
+        self.metrics = iter(())
+        self.replayed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.metrics)
+
+    def close(self):
+        self.metrics.close()
+
+
 class MetricFetcherRepo:
-    def __init__(self, jwt_token):
+    def __init__(self, jwt_token, id_mode=ID_MODE_SHA256, concurrent_requests=DEFAULT_CONCURRENT_REQUESTS, base_url=None,
+                 rate_limit=DEFAULT_RATE_LIMIT, parse_pool=None, stats=None, response_cache=None,
+                 decoder=DECODER_STREAM):
         self.session = requests.Session()
-        self.token = decode_jwt(jwt_token)
-        if os.getenv("ENV") == "local":
+        self.stats = stats or SyncStats()
+        # one connection per concurrent request, blocking caps the requests open against the API at once
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=concurrent_requests, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.token = DECODED_TOKENS.get(
+            jwt_token, lambda: decode_jwt(jwt_token))
+        self.subject = self.token.get('sub') or sha256(
+            jwt_token.encode()).hexdigest()
+        self.id_mode = id_mode
+        # an executor of worker processes that parse response bodies off the GIL, parsed in the fetch thread when None
+        self.parse_pool = parse_pool
+        # a ResponseCache that bulk responses are stored in, every request goes to the API when None
+        self.response_cache = response_cache
+        # {account brand id: last synced wave} of the interrupted sync being resumed, see resume
+        self.replay_after = None
+        # how response bodies are decoded, see json_decoders, anything but streaming holds a whole body in memory
+        self.decoder = resolve(decoder)
+        if base_url is not None:
+            self.base_url = base_url
+        elif os.getenv("ENV") == "local":
             print("Using local environment")
             self.base_url = "https://dev.api.gotracksuit.com/v1"
         else:
             print("Using prod environment")
             self.base_url = "https://api.gotracksuit.com/v1"
+        self.scheduler = RequestScheduler(
+            self.session, shared_rate_limiter((self.base_url, self.subject), rate_limit) if rate_limit else None)
 
         self.session.headers.update({
             'Authorization': f'Bearer {jwt_token}',
             'Content-Type': 'application/json',
         })
 
+    def resume(self, synced_to):
+        """Replays the cached responses of an interrupted sync that is being
+        resumed, for the wave ranges after each account brand's last synced
+        wave in `synced_to`. Responses are only ever stored otherwise: a new
+        sync, and the waves it re-checks for corrections, must see what the
+        API serves now."""
+        self.replay_after = synced_to
+
+    def __replayable(self, account_brand_id, start_date):
+        if self.replay_after is None:
+            return False
+
+        synced_to = self.replay_after.get(str(account_brand_id))
+        return synced_to is None or start_date > synced_to
+
     def fetch_account_brand_ids_for_client(self):
         return self.token.get('accountBrands', [])
 
@@ -43,48 +160,204 @@ class MetricFetcherRepo:
             f"Fetching available wave dates for {account_brand_id}"
         )
 
-        filter_response = self.session.get(
-            f"{self.base_url}/funnel/filters?accountBrandId={account_brand_id}&includeIncompleteMonths=false"
+        key = (self.base_url, self.subject, str(account_brand_id))
+        cached = WAVE_DATES.lookup(key)
+        if cached is not None and cached[2]:
+            return list(cached[0])
+
+        headers = {}
+        if cached is not None and cached[1] is not None:
+            headers['If-None-Match'] = cached[1]
+
+        filter_response = self.scheduler.get(
+            f"{self.base_url}/funnel/filters?accountBrandId={account_brand_id}&includeIncompleteMonths=false",
+            headers=headers
         )
-        filter_response.raise_for_status()
+        if filter_response.status_code == 304 and cached is not None:
+            WAVE_DATES.revalidated(key)
+            return list(cached[0])
+
         wave_dates = filter_response.json().get('waveDates', [])
+        WAVE_DATES.put(key, list(wave_dates),
+                       filter_response.headers.get('ETag'))
 
         return wave_dates
 
     def fetch_funnel_data(self, account_brand_id, start_date, end_date, filter_type):
+        """Returns the metrics of an account brand between the wave dates
+        selected by `filter_type`, a MetricFilter or a filter type. Each
+        filter type selected is requested once the metrics of the one before
+        it have been read.
+
+        A body whose connection breaks or times out while it is read is
+        requested again through the scheduler, with the same backoff and
+        attempts as the request itself, and the metrics already returned
+        from it are left out by id."""
+        metric_filter = MetricFilter.of(filter_type)
+        # the first request is made straight away so a failing API fails the fetch
+        body = self.__open_funnel_data(account_brand_id, start_date, end_date, metric_filter,
+                                       metric_filter.request_filter_types[0])
+        data = FunnelData()
+        data.metrics = self.__read_bodies(
+            body, data, account_brand_id, start_date, end_date, metric_filter)
+        return data
+
+    def __open_funnel_data(self, account_brand_id, start_date, end_date, metric_filter, filter_type):
+        """Returns the (response, chunks, cache writer) of a request, the
+        response and writer are None when the body is replayed from the
+        response cache."""
+        url = f"{self.base_url}/bulk/funnel/{account_brand_id}"
+        params = {"waveStartDate": start_date, "waveEndDate": end_date,
+                  **metric_filter.query_params(filter_type)}
+        key = None
+        if self.response_cache is not None:
+            key = cache_key(self.base_url, self.subject,
+                            str(account_brand_id), params)
+            cached = self.response_cache.open(key) if self.__replayable(
+                account_brand_id, start_date) else None
+            if cached is not None:
+                print(
+                    f"Replaying cached data for {account_brand_id} between {start_date}--{end_date}"
+                )
+                self.stats.add("responses_replayed")
+                return None, cached, None
+
         print(
             f"Fetching data for {account_brand_id} between {start_date}--{end_date}"
         )
-        filter_query_param = f"&filterType={filter_type}" if filter_type != "All" else ""
-        url = f"{self.base_url}/bulk/funnel/{account_brand_id}?waveStartDate={start_date}&waveEndDate={end_date}{filter_query_param}"
-        response = self.session.get(url)
-
         try:
-            response.raise_for_status()
-        except TimeoutError:
-            raise TimeoutError(
-                "request timed out, the sync has been aborted. If the issue persists, please try again later")
-        except Exception:
-            print(
-                f"failed to retrieve data for {account_brand_id} between {start_date}--{end_date}, sync has been skipped")
-            return []
+            response = self.scheduler.get(url, params=params, stream=True)
+        except (RequestFailed, requests.exceptions.HTTPError) as e:
+            raise RequestFailed(
+                f"failed to retrieve data for {account_brand_id} between {start_date}--{end_date}, the sync has been aborted. "
+                f"If the issue persists, please try again later: {e}") from e
+
+        chunks = self.__counted(response.iter_content(chunk_size=64 * 1024))
+        writer = None
+        if key is not None:
+            writer = self.response_cache.writer(key)
+            chunks = writer.tee(chunks)
+        return response, chunks, writer
+
+    def __read_bodies(self, first_body, data, account_brand_id, start_date, end_date, metric_filter):
+        for index, filter_type in enumerate(metric_filter.request_filter_types):
+            body = first_body if index == 0 else self.__open_funnel_data(
+                account_brand_id, start_date, end_date, metric_filter, filter_type)
+            # the ids read from this filter type's body, a body requested again only adds the metrics that weren't
+            read = set()
+            for attempt in range(self.scheduler.max_attempts):
+                if attempt > 0:
+                    body = self.__open_funnel_data(
+                        account_brand_id, start_date, end_date, metric_filter, filter_type)
+                response, _, _ = body
+                if response is None:
+                    data.replayed = True
+                try:
+                    for metric in self.__read_funnel_data(body, account_brand_id, start_date, end_date, metric_filter):
+                        if attempt > 0 and metric.id in read:
+                            continue
+                        read.add(metric.id)
+                        yield metric
+                    break
+                except requests.exceptions.RequestException as e:
+                    if not isinstance(e, RETRYABLE_READ_ERRORS) or attempt == self.scheduler.max_attempts - 1:
+                        raise RequestFailed(
+                            f"failed to read data for {account_brand_id} between {start_date}--{end_date}, the sync has been aborted: {e}") from e
+                    self.scheduler.wait_to_retry(
+                        f"{self.base_url}/bulk/funnel/{account_brand_id}", attempt, f"reading its body failed: {e}")
+
+    def __read_funnel_data(self, body, account_brand_id, start_date, end_date, metric_filter):
+        response, chunks, writer = body
+        try:
+            with response or nullcontext():
+                if self.parse_pool is not None:
+                    rows = self.parse_pool.submit(
+                        funnel_metric_rows, b"".join(chunks), int(account_brand_id), self.id_mode,
+                        metric_filter, self.decoder).result()
+                    metrics = (FunnelMetrics(*row) for row in rows)
+                elif self.decoder != DECODER_STREAM:
+                    body = b"".join(chunks)
+                    with self.stats.timed("decode"):
+                        rows = funnel_metric_rows(
+                            body, int(account_brand_id), self.id_mode, metric_filter, self.decoder)
+                    metrics = (FunnelMetrics(*row) for row in rows)
+                else:
+                    metrics = iter_funnel_metrics(
+                        chunks, int(account_brand_id), self.id_mode, self.stats, metric_filter)
+                yield from metrics
+                # only a body that was read in full is cached
+                if writer is not None:
+                    writer.commit()
+        finally:
+            if writer is not None:
+                writer.close()
 
         print(
             f"Data fetched for {account_brand_id} between {start_date}--{end_date}"
         )
 
-        return json_to_funnel_metrics(response.json())
+    def __counted(self, chunks):
+        for chunk in chunks:
+            self.stats.add("bytes_downloaded", len(chunk))
+            yield chunk
+
+
+def window_key(start_date, end_date):
+    return f"{start_date}:{end_date}"
+
+
+class Window(NamedTuple):
+    key: str
+    account_brand_ids: list
+    # merged into (wave_date, id) order
+    metrics: object
+    # {account brand id: {wave date: fingerprint}} of the waves fetched, empty unless fingerprinting
+    fingerprints: dict
+    # {account brand id: per wave rows and seconds} of the partitions fetched, replayed partitions are left out
+    sizes: dict = {}
 
 
 class MetricFetcher:
-    def __init__(self, repo: MetricFetcherRepo):
+    def __init__(self, repo: MetricFetcherRepo, window_months=1, concurrent_requests=DEFAULT_CONCURRENT_REQUESTS,
+                 lookback_waves=0, wave_index=None, stats=None):
+        if window_months < 1:
+            raise ValueError("window_months must be at least 1")
+        if concurrent_requests < 1:
+            raise ValueError("concurrent_requests must be at least 1")
+
         self.repo = repo
+        self.window_months = window_months
+        self.concurrent_requests = concurrent_requests
+        self.lookback_waves = lookback_waves
+        # a WaveIndex lets changed waves be synced as the ids added and deleted since they were last synced
+        self.wave_index = wave_index
+        self.stats = stats or SyncStats()
+        self.__executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def executor(self):
+        """The worker pool shared by every request this fetcher makes."""
+        if self.__executor is None:
+            self.__executor = ThreadPoolExecutor(
+                max_workers=self.concurrent_requests, thread_name_prefix="metric-fetcher")
+        return self.__executor
+
+    def close(self):
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True, cancel_futures=True)
+            self.__executor = None
 
     @staticmethod
-    def __add_one_month(date):
-        month_added = datetime.strptime(
-            date, "%Y-%m-%d") + relativedelta(months=1)
-        return month_added.strftime("%Y-%m-%d")
+    def __add_months(date, months):
+        months_added = datetime.strptime(
+            date, "%Y-%m-%d") + relativedelta(months=months)
+        return months_added.strftime("%Y-%m-%d")
 
     def account_brand_ids_to_sync(self, account_brand_ids):
         account_brand_ids_for_client = self.repo.fetch_account_brand_ids_for_client()
@@ -106,71 +379,328 @@ class MetricFetcher:
         print(f"valid account brands {valid_accounts_to_sync}")
         return valid_accounts_to_sync
 
-    def wave_range_to_sync(self, account_brand_ids, last_synced_date):
-        results = []
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = {
-                executor.submit(
-                    self.repo.fetch_available_dates,
-                    account_brand_id,
-                ): account_brand_id
-                for account_brand_id in account_brand_ids}
-
-            for future in concurrent.futures.as_completed(futures):
-                result = future.result()
-                results.append(result)
-
-        sorted_dates = sorted([
-            date for result in results
-            for date in result
-        ])
-
-        if len(sorted_dates) == 0:
-            warnings.warn(
-                f"there is no data for any of the account brands {account_brand_ids} seleceted, try again later"
-            )
-            return None
+    def wave_ranges_to_sync(self, account_brand_ids, synced_to):
+        """Returns the {"from", "to"} range of waves each account brand has
+        published since the wave recorded for it in `synced_to`, keyed by
+        account brand id. Account brands missing from `synced_to` are
+        backfilled from their first wave and account brands with nothing new
+        are left out. Returns None if no account brand has anything to sync.
+
+        With `lookback_waves`, the ranges also start that many already synced
+        waves back so late corrections to them are picked up."""
+        futures = {
+            self.executor.submit(
+                self.repo.fetch_available_dates,
+                account_brand_id,
+            ): account_brand_id
+            for account_brand_id in account_brand_ids}
+
+        wave_dates = {}
+        for future in concurrent.futures.as_completed(futures):
+            wave_dates[futures[future]] = future.result()
+
+        wave_ranges = {}
+        for account_brand_id in account_brand_ids:
+            last_synced_date = synced_to.get(str(account_brand_id))
+            dates = sorted(wave_dates[account_brand_id])
+            dates_to_sync = [
+                date for date in dates
+                if last_synced_date is None or date > last_synced_date
+            ]
+            if last_synced_date is not None and self.lookback_waves > 0:
+                synced_dates = [
+                    date for date in dates if date <= last_synced_date]
+                dates_to_sync = synced_dates[-self.lookback_waves:] + \
+                    dates_to_sync
+            if len(dates_to_sync) == 0:
+                print(
+                    f"skipping account brand {account_brand_id} as it does not have data since the last sync on {last_synced_date}")
+                continue
 
-        if last_synced_date is None:
-            return {"from": sorted_dates[0], "to": sorted_dates[-1]}
+            wave_ranges[account_brand_id] = {
+                "from": dates_to_sync[0], "to": dates_to_sync[-1]}
 
-        if not any(date > last_synced_date for date in sorted_dates):
+        if len(wave_ranges) == 0:
             warnings.warn(
-                f"skipping sync for account brands {account_brand_ids} as it does not have data since the last sync on {last_synced_date}"
+                f"there is no new data for any of the account brands {account_brand_ids} seleceted, try again later"
             )
             return None
 
-        return {"from": self.__add_one_month(last_synced_date), "to": sorted_dates[-1]}
+        return wave_ranges
 
-    def fetch_for(self, account_brand_ids, from_date, to_date, filter_type):
+    @staticmethod
+    def sort_key(metric):
+        return (metric.wave_date, metric.id)
+
+    def wave_windows(self, from_date, to_date):
+        """Splits the wave range into windows of `window_months` waves, each
+        returned as an inclusive (start, end) pair."""
+        windows = []
+        start = from_date
+        while start <= to_date:
+            end = min(self.__add_months(start, self.window_months - 1), to_date)
+            windows.append((start, end))
+            start = self.__add_months(start, self.window_months)
+
+        return windows
+
+    @classmethod
+    def seek(cls, metrics, resume_key):
+        """Returns the index of the first metric in the sorted `metrics` that
+        comes after `resume_key`."""
+        low, high = 0, len(metrics)
+        while low < high:
+            middle = (low + high) // 2
+            if cls.sort_key(metrics[middle]) <= resume_key:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def __fetch_partition(self, account_brand_id, start_date, end_date, filter_type, resume_key, synced_fingerprints):
+        started_at = self.stats.clock()
+        with self.stats.timed("fetch", account_brand_id=str(account_brand_id)):
+            data = self.repo.fetch_funnel_data(
+                account_brand_id, start_date, end_date, filter_type)
+            metrics = list(data or [])
+        filter_key = MetricFilter.of(filter_type).key
+        self.stats.add("rows_parsed", len(metrics))
+        with self.stats.timed("sort"):
+            metrics.sort(key=self.sort_key)
+        # a replayed partition takes next to no time, its size would have it planned as the smallest
+        size = None
+        if not (isinstance(data, FunnelData) and data.replayed):
+            size = partition_size(len(metrics), self.stats.clock() - started_at,
+                                  waves_between(start_date, end_date))
+
+        fingerprints = {}
+        if synced_fingerprints is not None:
+            changed = []
+            for wave_date, wave in groupby(metrics, key=lambda metric: metric.wave_date):
+                wave = list(wave)
+                fingerprint = wave_fingerprint(metric.id for metric in wave)
+                fingerprints[wave_date] = fingerprint
+                if self.wave_index is not None and not self.wave_index.has(filter_key, account_brand_id, wave_date, fingerprint):
+                    self.wave_index.write(filter_key, account_brand_id, wave_date, fingerprint,
+                                          (metric.id for metric in wave))
+
+                synced_fingerprint = synced_fingerprints.get(wave_date)
+                if synced_fingerprint == fingerprint:
+                    print(
+                        f"Skipping wave {wave_date} for {account_brand_id}, it has not changed since it was synced")
+                    continue
+
+                if self.wave_index is not None and synced_fingerprint is not None:
+                    diff = self.wave_index.diff(
+                        filter_key, account_brand_id, wave_date, synced_fingerprint, wave)
+                    if diff is not None:
+                        changed.extend(diff)
+                        continue
+                    print(
+                        f"No index of the synced ids of wave {wave_date} for {account_brand_id}, syncing all of it again")
+                changed.extend(wave)
+            metrics = changed
+
+        if resume_key is not None:
+            del metrics[:self.seek(metrics, resume_key)]
+
+        return metrics, fingerprints, size
+
+    def plan(self, wave_ranges, synced_windows=None, cursor=None, sizes=None):
+        """Splits the sync of `wave_ranges` into a WorkUnit per (account
+        brand, wave window) left to sync and returns them as a SyncPlan.
+
+        Windows are synced in order, so each window's units are ordered
+        longest processing time first, estimated from the per wave `sizes`
+        recorded by earlier syncs keyed by account brand id. The largest
+        partition of a window starts first rather than last and the smaller
+        ones fill the workers around it.
+
+        `synced_windows` and `cursor` are as for `fetch_windows`, a cursor
+        checkpointed by an unordered sync only resumes its own account
+        brand's unit."""
+        from_date = min(wave_range["from"] for wave_range in wave_ranges.values())
+        to_date = max(wave_range["to"] for wave_range in wave_ranges.values())
+        synced_windows = synced_windows or {}
+        sizes = sizes or {}
+        windows = []
+        for start_date, end_date in self.wave_windows(from_date, to_date):
+            key = window_key(start_date, end_date)
+            synced = synced_windows.get(key, [])
+
+            window_resume_key = None
+            if cursor is not None and cursor.get("window") == key:
+                print(
+                    f"Resuming window {key} after {cursor['wave_date']} {cursor['id']}")
+                window_resume_key = (cursor["wave_date"], cursor["id"])
+
+            units = []
+            for account_brand_id, wave_range in wave_ranges.items():
+                if str(account_brand_id) in synced:
+                    continue
+
+                # a cursor checkpointed by an unordered sync belongs to a single partition
+                resume_key = window_resume_key
+                if resume_key is not None and cursor.get("account_brand_id", str(account_brand_id)) != str(account_brand_id):
+                    resume_key = None
+                partition_start = max(start_date, wave_range["from"])
+                if resume_key is not None:
+                    partition_start = max(partition_start, resume_key[0])
+                partition_end = min(end_date, wave_range["to"])
+                if partition_start > partition_end:
+                    continue
+
+                waves = waves_between(partition_start, partition_end)
+                units.append(WorkUnit(key, account_brand_id, partition_start, partition_end, waves,
+                                      *estimate(sizes, account_brand_id, waves), resume_key))
+
+            if len(units) == 0:
+                print(f"Skipping window {key}, it has nothing left to sync")
+                continue
+
+            windows.append((key, largest_first(units)))
+
+        return SyncPlan(windows, self.concurrent_requests)
+
+    def fetch_windows(self, wave_ranges, filter_type, synced_windows=None, cursor=None, fingerprints=None,
+                      sizes=None):
+        """Yields a Window per wave window for the account brands and wave
+        ranges in `wave_ranges`, selected by `filter_type`, a MetricFilter or
+        a filter type,
+        skipping the (account brand, window) pairs already recorded in
+        `synced_windows`. Windows are laid out from the earliest wave of any
+        account brand and each account brand is only fetched for the waves in
+        its own range.
+
+        A `cursor` checkpointed part way through a window resumes that window
+        from the cursor's wave and skips every metric up to its (wave_date, id)
+        key. A cursor for a window that is no longer part of the sync is
+        ignored and the window is synced from its start.
+
+        When `fingerprints` of the synced waves are passed in, keyed by
+        account brand id and then wave date, every fetched wave is
+        fingerprinted and the waves whose fingerprint is unchanged are left
+        out of the metrics. With a `wave_index`, a changed wave only keeps
+        the metrics that are new since it was synced, along with a
+        DeletedFunnelMetrics for each synced id that has gone.
+
+        Each (account brand, window) partition is fetched and sorted on its
+        own and the partitions of a window are merged into (wave_date, id)
+        order once they have all arrived, so only the windows in flight are
+        ever held in memory. The partitions of each window are started
+        largest first, estimated from the per wave `sizes` of earlier syncs,
+        see `plan`."""
+        account_brand_ids = list(wave_ranges)
+        from_date = min(wave_range["from"] for wave_range in wave_ranges.values())
+        to_date = max(wave_range["to"] for wave_range in wave_ranges.values())
         print(
-            f"Fetching account brands {account_brand_ids} between {from_date}--{to_date}, filtered by {filter_type}")
-
-        results = []
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = {
-                executor.submit(
-                    self.repo.fetch_funnel_data,
-                    account_brand_id,
-                    from_date,
-                    to_date,
-                    filter_type
-                ): account_brand_id
-                for account_brand_id in account_brand_ids}
-
-            for future in concurrent.futures.as_completed(futures):
-                result = future.result()
-                results.append(result)
-
-        print("metrics fetched")
-        metrics = [
-            metric for result in results
-            if result is not None
-            for metric in result
-        ]
+            f"Fetching account brands {account_brand_ids} between {from_date}--{to_date} in windows of {self.window_months} month(s), filtered by {MetricFilter.of(filter_type).key}")
+
+        plan = self.plan(wave_ranges, synced_windows, cursor, sizes)
+        print(f"Sync plan: {plan.describe()}")
+
+        # keep every worker busy when there are fewer account brands than workers
+        windows_in_flight = max(
+            WINDOWS_IN_FLIGHT, -(-self.concurrent_requests // max(len(account_brand_ids), 1)))
+        pending = iter(plan.windows)
+        in_flight = deque()
 
+        def fetch_next_window():
+            window = next(pending, None)
+            if window is None:
+                return
+
+            # the executor starts tasks in the order they are submitted, so the largest unit starts first
+            key, units = window
+            in_flight.append((key, [unit.account_brand_id for unit in units], [
+                self.__submit(unit, filter_type, fingerprints) for unit in units
+            ]))
+
+        try:
+            for _ in range(windows_in_flight):
+                fetch_next_window()
+
+            while in_flight:
+                key, account_brand_ids_fetched, futures = in_flight.popleft()
+                results = [future.result() for future in futures]
+                fetch_next_window()
+
+                partitions = [metrics for metrics, _, _ in results]
+                print(
+                    f"Window {key} fetched. {sum(len(partition) for partition in partitions)} records found.")
+                yield Window(key, account_brand_ids_fetched, heapq.merge(*partitions, key=self.sort_key), {
+                    account_brand_id: window_fingerprints
+                    for account_brand_id, (_, window_fingerprints, _) in zip(account_brand_ids_fetched, results)
+                    if len(window_fingerprints) > 0
+                }, {
+                    account_brand_id: size
+                    for account_brand_id, (_, _, size) in zip(account_brand_ids_fetched, results)
+                    if size is not None
+                })
+        finally:
+            for _, _, futures in in_flight:
+                for future in futures:
+                    future.cancel()
+
+        print("All data fetched successfully.")
+
+    def __submit(self, unit, filter_type, fingerprints):
+        return self.executor.submit(self.__fetch_partition,
+                                    unit.account_brand_id, unit.start_date, unit.end_date, filter_type,
+                                    unit.resume_key,
+                                    None if fingerprints is None else fingerprints.get(str(unit.account_brand_id), {}))
+
+    def fetch_partitions(self, wave_ranges, filter_type, synced_windows=None, cursor=None, fingerprints=None,
+                         sizes=None):
+        """Yields a Window for each (account brand, window) partition as soon
+        as it has been fetched, in whatever order they arrive. Takes the same
+        arguments as `fetch_windows`.
+
+        A partition's metrics are still sorted into (wave_date, id) order so
+        a cursor part way through it can be resumed, but partitions are never
+        merged, so the first records are emitted once the quickest partition
+        has arrived rather than once every partition of a window has. The
+        units of the whole sync are started largest first and as many
+        partitions are held in memory as `fetch_windows` holds for its
+        windows in flight."""
+        account_brand_ids = list(wave_ranges)
         print(
-            f"All data fetched successfully. {len(metrics)} records found."
-        )
+            f"Fetching account brands {account_brand_ids} in windows of {self.window_months} month(s) as they arrive, filtered by {MetricFilter.of(filter_type).key}")
+
+        plan = self.plan(wave_ranges, synced_windows, cursor, sizes)
+        print(f"Sync plan: {plan.describe()}")
+
+        partitions_in_flight = max(len(account_brand_ids), 1) * max(
+            WINDOWS_IN_FLIGHT, -(-self.concurrent_requests // max(len(account_brand_ids), 1)))
+        pending = iter(largest_first(plan.units))
+        in_flight = {}
 
-        return sorted(metrics, key=lambda x: (x.wave_date, x.id))
+        def fetch_next_partition():
+            unit = next(pending, None)
+            if unit is not None:
+                in_flight[self.__submit(unit, filter_type, fingerprints)] = unit
+
+        try:
+            for _ in range(partitions_in_flight):
+                fetch_next_partition()
+
+            while in_flight:
+                done, _ = concurrent.futures.wait(
+                    in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    unit = in_flight.pop(future)
+                    metrics, partition_fingerprints, size = future.result()
+                    fetch_next_partition()
+
+                    print(
+                        f"Partition {unit.window} of {unit.account_brand_id} fetched. {len(metrics)} records found.")
+                    yield Window(unit.window, [unit.account_brand_id], metrics,
+                                 {unit.account_brand_id: partition_fingerprints} if len(
+                                     partition_fingerprints) > 0 else {},
+                                 {unit.account_brand_id: size} if size is not None else {})
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+        print("All data fetched successfully.")
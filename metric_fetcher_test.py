@@ -1,78 +1,96 @@
 import pytest
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import Mock
-from metric_fetcher import MetricFetcherRepo, MetricFetcher
-from data_classes import mock_funnel_metric
-
-
-class TestWaveRangeToSync:
-    def test_returns_the_earliest_and_latest_wave_dates_for_all_accounts_if_no_last_synced_date_is_passed_in(self):
+from metric_fetcher import WAVE_DATES, MetricFetcherRepo, MetricFetcher
+from request_scheduler import RequestFailed
+from benchmarks.fake_api import FakeTracksuitApi, fake_jwt
+from data_classes import DeletedFunnelMetrics, MetricFilter, mock_funnel_metric, wave_fingerprint
+from response_cache import ResponseCache
+from json_decoders import DECODER_STDLIB, DECODER_STREAM
+from sync_stats import SyncStats
+from wave_index import WaveIndex
+
+
+class TestWaveRangesToSync:
+    def test_returns_every_wave_for_account_brands_that_have_not_been_synced(self):
         mock_repo = Mock(spec=MetricFetcherRepo)
-        mock_repo.fetch_account_brand_ids_for_client.return_value = [1, 2]
         mock_repo.fetch_available_dates.side_effect = [
             ["2020-02-01"],
-            ["2020-01-01", "2020-02-01", "2020-03-01"]
+            ["2020-03-01", "2020-01-01", "2020-02-01"]
         ]
 
-        result = MetricFetcher(repo=mock_repo).wave_range_to_sync([1, 2], None)
+        result = MetricFetcher(repo=mock_repo).wave_ranges_to_sync([1, 2], {})
 
-        assert result == {"from": "2020-01-01", "to": "2020-03-01"}
+        assert result == {1: {"from": "2020-02-01", "to": "2020-02-01"},
+                          2: {"from": "2020-01-01", "to": "2020-03-01"}}
 
-    def test_returns_the_earliest_and_latest_wave_dates_for_all_accounts_past_the_last_synced_date(self):
+    def test_returns_the_waves_since_each_account_brands_last_synced_wave(self):
         mock_repo = Mock(spec=MetricFetcherRepo)
-        mock_repo.fetch_account_brand_ids_for_client.return_value = [1, 2]
         mock_repo.fetch_available_dates.side_effect = [
-            ["2020-05-01"],
+            ["2020-01-01", "2020-02-01", "2020-05-01"],
             ["2020-01-01", "2020-02-01", "2020-03-01"]
         ]
 
-        result = MetricFetcher(repo=mock_repo).wave_range_to_sync(
-            [1, 2], "2020-02-01")
+        result = MetricFetcher(repo=mock_repo).wave_ranges_to_sync(
+            [1, 2], {"1": "2020-02-01", "2": "2020-01-01"})
 
-        assert result == {"from": "2020-03-01", "to": "2020-05-01"}
+        assert result == {1: {"from": "2020-05-01", "to": "2020-05-01"},
+                          2: {"from": "2020-02-01", "to": "2020-03-01"}}
 
-    def test_returns_the_same_from_and_to_date_if_only_one_month_has_passed_since_the_last_synced_date(self):
+    def test_backfills_account_brands_that_are_new_without_refetching_the_others(self):
         mock_repo = Mock(spec=MetricFetcherRepo)
-        mock_repo.fetch_account_brand_ids_for_client.return_value = [1, 2]
         mock_repo.fetch_available_dates.return_value = [
             "2020-01-01", "2020-02-01"]
 
-        result = MetricFetcher(repo=mock_repo).wave_range_to_sync(
-            [1, 2], "2020-01-01")
+        result = MetricFetcher(repo=mock_repo).wave_ranges_to_sync(
+            [1, 2], {"1": "2020-02-01"})
 
-        assert result == {"from": "2020-02-01", "to": "2020-02-01"}
+        assert result == {2: {"from": "2020-01-01", "to": "2020-02-01"}}
 
-    def test_returns_none_if_no_wave_dates_for_any_accounts_past_the_last_synced_date(self):
+    def test_picks_up_an_account_brand_that_published_late(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        mock_repo.fetch_available_dates.side_effect = [
+            ["2020-03-01"],
+            ["2020-02-01", "2020-03-01"]
+        ]
+
+        result = MetricFetcher(repo=mock_repo).wave_ranges_to_sync(
+            [1, 2], {"1": "2020-03-01", "2": "2020-01-01"})
+
+        assert result == {2: {"from": "2020-02-01", "to": "2020-03-01"}}
+
+    def test_looks_back_over_the_most_recent_synced_waves(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        mock_repo.fetch_available_dates.side_effect = [
+            ["2020-01-01", "2020-02-01", "2020-03-01", "2020-04-01"],
+            ["2020-01-01", "2020-02-01", "2020-03-01"],
+        ]
+
+        result = MetricFetcher(repo=mock_repo, lookback_waves=2).wave_ranges_to_sync(
+            [1, 2], {"1": "2020-03-01", "2": "2020-03-01"})
+
+        assert result == {1: {"from": "2020-02-01", "to": "2020-04-01"},
+                          2: {"from": "2020-02-01", "to": "2020-03-01"}}
+
+    def test_returns_none_if_there_are_no_wave_dates_for_any_accounts(self):
         mock_repo = Mock(spec=MetricFetcherRepo)
-        mock_repo.fetch_account_brand_ids_for_client.return_value = [1, 2]
         mock_repo.fetch_available_dates.return_value = []
 
         results = MetricFetcher(
-            repo=mock_repo).wave_range_to_sync([1, 2], None)
+            repo=mock_repo).wave_ranges_to_sync([1, 2], {})
 
         assert results is None
 
-    def test_returns_none_if_there_is_no_data_since_the_last_synced_date_for_any_of_the_accounts(self):
+    def test_returns_none_if_there_is_no_data_since_the_last_synced_wave_for_any_of_the_accounts(self):
         mock_repo = Mock(spec=MetricFetcherRepo)
-        mock_repo.fetch_account_brand_ids_for_client.return_value = [1, 2]
         mock_repo.fetch_available_dates.return_value = ["2020-02-01"]
 
-        result = MetricFetcher(repo=mock_repo).wave_range_to_sync(
-            [1, 2], "2020-02-01")
+        result = MetricFetcher(repo=mock_repo).wave_ranges_to_sync(
+            [1, 2], {"1": "2020-02-01", "2": "2020-02-01"})
 
         assert result is None
 
-    def test_filters_out_empty_wave_dates(self):
-        mock_repo = Mock(spec=MetricFetcherRepo)
-        mock_repo.fetch_account_brand_ids_for_client.return_value = [1, 2]
-        mock_repo.fetch_available_dates.side_effect = [
-            ["2020-02-01"],
-            []
-        ]
-
-        result = MetricFetcher(repo=mock_repo).wave_range_to_sync([1, 2], None)
-
-        assert result == {"from": "2020-02-01", "to": "2020-02-01"}
-
 
 class TestAccountBrandIdsToSync:
     def test_returns_all_account_brand_ids_if_no_account_brand_ids_are_passed_in(self):
@@ -109,62 +127,591 @@ class TestAccountBrandIdsToSync:
         assert result == [1, 2]
 
 
-class TestFetchFor:
-    def test_fetchs_data_for_all_accounts_wave_range_and_filter_passed_in(self):
+def wave_ranges(account_brand_ids, from_date, to_date):
+    return {account_brand_id: {"from": from_date, "to": to_date}
+            for account_brand_id in account_brand_ids}
+
+
+def window_metrics(windows):
+    return [metric for window in windows for metric in window.metrics]
+
+
+class TestWaveWindows:
+    def test_splits_the_range_into_windows_of_the_configured_number_of_months(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+
+        result = MetricFetcher(repo=mock_repo, window_months=3).wave_windows(
+            "2020-01-01", "2020-08-01")
+
+        assert result == [("2020-01-01", "2020-03-01"),
+                          ("2020-04-01", "2020-06-01"),
+                          ("2020-07-01", "2020-08-01")]
+
+    def test_returns_a_window_per_wave_by_default(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+
+        result = MetricFetcher(repo=mock_repo).wave_windows(
+            "2020-01-01", "2020-02-01")
+
+        assert result == [("2020-01-01", "2020-01-01"),
+                          ("2020-02-01", "2020-02-01")]
+
+    def test_raises_if_the_window_is_less_than_a_month(self):
+        with pytest.raises(ValueError):
+            MetricFetcher(repo=Mock(spec=MetricFetcherRepo), window_months=0)
+
+
+class TestFetchWindows:
+    def test_fetches_the_metrics_of_every_account_brand_for_the_filter_passed_in(self):
         mock_repo = Mock(spec=MetricFetcherRepo)
         mock_funnel_metric_acc_1 = mock_funnel_metric(account_brand_id=1)
         mock_funnel_metric_acc_2 = mock_funnel_metric(account_brand_id=2)
 
-        mock_repo.fetch_account_brand_ids_for_client.return_value = [1, 2]
         mock_repo.fetch_funnel_data.side_effect = [
             [mock_funnel_metric_acc_1], [mock_funnel_metric_acc_2]]
 
-        result = MetricFetcher(repo=mock_repo).fetch_for(
-            [1, 2], "2020-02-01", "2020-03-01", "Total")
+        result = window_metrics(MetricFetcher(repo=mock_repo).fetch_windows(
+            wave_ranges([1, 2], "2020-02-01", "2020-02-01"), "Total"))
 
         mock_repo.fetch_funnel_data.assert_any_call(
-            1, "2020-02-01", "2020-03-01", "Total")
+            1, "2020-02-01", "2020-02-01", "Total")
         mock_repo.fetch_funnel_data.assert_any_call(
-            2, "2020-02-01", "2020-03-01", "Total")
+            2, "2020-02-01", "2020-02-01", "Total")
 
         assert mock_funnel_metric_acc_1 in result
         assert mock_funnel_metric_acc_2 in result
         assert len(result) == 2
 
-    def test_skips_accounts_if_they_fail_without_a_timeout(self):
+    def test_fetches_each_wave_in_the_range_separately(self):
         mock_repo = Mock(spec=MetricFetcherRepo)
-        mock_funnel_metric_1 = mock_funnel_metric(account_brand_id=1)
-        mock_funnel_metric_2 = mock_funnel_metric(account_brand_id=2)
+        mock_repo.fetch_funnel_data.return_value = []
 
-        mock_repo.fetch_funnel_data.side_effect = [
-            [mock_funnel_metric_1], []]
+        list(MetricFetcher(repo=mock_repo).fetch_windows(
+            wave_ranges([1], "2020-01-01", "2020-03-01"), "Total"))
 
-        result = MetricFetcher(repo=mock_repo).fetch_for(
-            [1, 2], "2020-02-01", "2020-03-01", "Total")
+        assert mock_repo.fetch_funnel_data.call_count == 3
+        mock_repo.fetch_funnel_data.assert_any_call(
+            1, "2020-01-01", "2020-01-01", "Total")
+        mock_repo.fetch_funnel_data.assert_any_call(
+            1, "2020-02-01", "2020-02-01", "Total")
+        mock_repo.fetch_funnel_data.assert_any_call(
+            1, "2020-03-01", "2020-03-01", "Total")
 
-        assert mock_funnel_metric_1 in result
-        assert mock_funnel_metric_2 not in result
-        assert len(result) == 1
+    def test_raises_if_an_account_brand_cannot_be_fetched(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        mock_repo.fetch_funnel_data.side_effect = [
+            [mock_funnel_metric(account_brand_id=1)], RequestFailed("failed to retrieve data for 2")]
+
+        with pytest.raises(RequestFailed, match="failed to retrieve data for 2"):
+            list(MetricFetcher(repo=mock_repo).fetch_windows(
+                wave_ranges([1, 2], "2020-02-01", "2020-02-01"), "Total"))
 
     def test_orders_returned_metrics_by_date_and_then_their_id(self):
         mock_repo = Mock(spec=MetricFetcherRepo)
         mock_funnel_metric_1 = mock_funnel_metric(
-            id="xtsraw", wave_date="2020/01/02")
+            id="xtsraw", wave_date="2020-01-01")
         mock_funnel_metric_2 = mock_funnel_metric(
-            id="aatxststst", wave_date="2921/02/01")
+            id="aatxststst", wave_date="2020-02-01")
         mock_funnel_metric_3 = mock_funnel_metric(
-            id="stxststst", wave_date="2020/01/01")
+            id="stxststst", wave_date="2020-01-01")
         mock_funnel_metric_4 = mock_funnel_metric(
-            id="atxststst", wave_date="2020/01/01")
+            id="atxststst", wave_date="2020-01-01")
 
-        mock_repo.fetch_account_brand_ids_for_client.return_value = [1]
-        mock_repo.fetch_funnel_data.return_value = [
-            mock_funnel_metric_2, mock_funnel_metric_3, mock_funnel_metric_1, mock_funnel_metric_4]
+        waves = {
+            (1, "2020-01-01"): [mock_funnel_metric_3, mock_funnel_metric_1],
+            (2, "2020-01-01"): [mock_funnel_metric_4],
+            (1, "2020-02-01"): [mock_funnel_metric_2],
+            (2, "2020-02-01"): [],
+        }
+        mock_repo.fetch_funnel_data.side_effect = lambda account_brand_id, start_date, end_date, filter_type: iter(
+            waves[(account_brand_id, start_date)])
 
-        result = MetricFetcher(repo=mock_repo).fetch_for(
-            [1], "2020-01-01", "2020-02-01", "Total")
+        result = window_metrics(MetricFetcher(repo=mock_repo).fetch_windows(
+            wave_ranges([1, 2], "2020-01-01", "2020-02-01"), "Total"))
 
         assert result == [mock_funnel_metric_4,
                           mock_funnel_metric_3,
                           mock_funnel_metric_1,
                           mock_funnel_metric_2]
+
+    def test_yields_the_first_wave_before_later_waves_are_consumed(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        first_wave_metric = mock_funnel_metric(wave_date="2020-01-01")
+        mock_repo.fetch_funnel_data.side_effect = lambda account_brand_id, start_date, end_date, filter_type: [
+            mock_funnel_metric(wave_date=start_date)]
+
+        windows = MetricFetcher(repo=mock_repo).fetch_windows(
+            wave_ranges([1], "2020-01-01", "2021-12-01"), "Total")
+
+        assert next(next(windows).metrics) == first_wave_metric
+        assert mock_repo.fetch_funnel_data.call_count < 24
+        windows.close()
+
+    def test_fetches_each_window_for_every_account(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        mock_repo.fetch_funnel_data.return_value = []
+
+        result = [
+            (key, account_brand_ids) for key, account_brand_ids, *_ in
+            MetricFetcher(repo=mock_repo, window_months=2).fetch_windows(
+                wave_ranges([1, 2], "2020-01-01", "2020-03-01"), "Total")
+        ]
+
+        assert result == [("2020-01-01:2020-02-01", [1, 2]),
+                          ("2020-03-01:2020-03-01", [1, 2])]
+        mock_repo.fetch_funnel_data.assert_any_call(
+            1, "2020-01-01", "2020-02-01", "Total")
+        mock_repo.fetch_funnel_data.assert_any_call(
+            2, "2020-03-01", "2020-03-01", "Total")
+
+    def test_skips_account_brands_that_have_already_synced_a_window(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        mock_repo.fetch_funnel_data.return_value = []
+
+        result = [
+            (key, account_brand_ids) for key, account_brand_ids, *_ in
+            MetricFetcher(repo=mock_repo).fetch_windows(
+                wave_ranges([1, 2], "2020-01-01", "2020-03-01"), "Total",
+                {"2020-01-01:2020-01-01": ["1", "2"], "2020-02-01:2020-02-01": ["1"]})
+        ]
+
+        assert result == [("2020-02-01:2020-02-01", [2]),
+                          ("2020-03-01:2020-03-01", [1, 2])]
+        assert mock_repo.fetch_funnel_data.call_count == 3
+
+    def test_only_fetches_each_account_brand_for_its_own_wave_range(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        mock_repo.fetch_funnel_data.return_value = []
+
+        result = [
+            (key, account_brand_ids) for key, account_brand_ids, *_ in
+            MetricFetcher(repo=mock_repo, window_months=3).fetch_windows(
+                {1: {"from": "2020-01-01", "to": "2020-06-01"},
+                 2: {"from": "2020-05-01", "to": "2020-05-01"}}, "Total")
+        ]
+
+        assert result == [("2020-01-01:2020-03-01", [1]),
+                          ("2020-04-01:2020-06-01", [1, 2])]
+        mock_repo.fetch_funnel_data.assert_any_call(
+            1, "2020-01-01", "2020-03-01", "Total")
+        mock_repo.fetch_funnel_data.assert_any_call(
+            1, "2020-04-01", "2020-06-01", "Total")
+        mock_repo.fetch_funnel_data.assert_any_call(
+            2, "2020-05-01", "2020-05-01", "Total")
+        assert mock_repo.fetch_funnel_data.call_count == 3
+
+    def test_fetches_the_largest_partition_of_each_window_first(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        mock_repo.fetch_funnel_data.return_value = []
+
+        windows = list(MetricFetcher(repo=mock_repo, concurrent_requests=1).fetch_windows(
+            wave_ranges([1, 2, 3], "2020-01-01", "2020-01-01"), "Total",
+            sizes={"1": {"rows": 10, "seconds": 1.0}, "2": {"rows": 900, "seconds": 9.0}}))
+
+        assert [call.args[0] for call in mock_repo.fetch_funnel_data.call_args_list] == [2, 3, 1]
+        assert windows[0].account_brand_ids == [2, 3, 1]
+        assert set(windows[0].sizes) == {1, 2, 3}
+
+    def test_plans_a_work_unit_per_account_brand_and_window(self):
+        fetcher = MetricFetcher(repo=Mock(spec=MetricFetcherRepo), window_months=2, concurrent_requests=4)
+
+        plan = fetcher.plan({1: {"from": "2020-01-01", "to": "2020-03-01"},
+                             2: {"from": "2020-02-01", "to": "2020-02-01"}},
+                            sizes={"1": {"rows": 100, "seconds": 1.0}, "2": {"rows": 400, "seconds": 4.0}})
+
+        assert [(key, [(unit.account_brand_id, unit.waves, unit.seconds) for unit in units])
+                for key, units in plan.windows] == [
+            ("2020-01-01:2020-02-01", [(2, 1, 4.0), (1, 2, 2.0)]),
+            ("2020-03-01:2020-03-01", [(1, 1, 1.0)])]
+        assert plan.estimated_seconds == 4.0
+
+    def test_only_resumes_the_account_brand_of_an_unordered_cursor(self):
+        fetcher = MetricFetcher(repo=Mock(spec=MetricFetcherRepo), window_months=3)
+
+        plan = fetcher.plan(wave_ranges([1, 2], "2020-01-01", "2020-03-01"), cursor={
+            "window": "2020-01-01:2020-03-01", "wave_date": "2020-02-01", "id": "b", "account_brand_id": "2"})
+
+        assert sorted((unit.account_brand_id, unit.start_date, unit.resume_key) for unit in plan.units) == [
+            (1, "2020-01-01", None), (2, "2020-02-01", ("2020-02-01", "b"))]
+
+    def test_syncs_a_correction_found_by_a_lookback_with_the_response_cache_on(self, tmp_path):
+        cache = ResponseCache(str(tmp_path / "cache"))
+        index = WaveIndex(str(tmp_path / "index"))
+        ranges = wave_ranges([7], "2023-01-01", "2023-01-01")
+        with FakeTracksuitApi(account_brand_ids=[7], rows_per_wave=5) as api:
+            def sync(fingerprints):
+                repo = MetricFetcherRepo(api.token, base_url=api.base_url, response_cache=cache)
+                with MetricFetcher(repo, lookback_waves=1, wave_index=index) as fetcher:
+                    return list(fetcher.fetch_windows(ranges, "All", fingerprints=fingerprints))
+
+            first = sync({})
+            wave = api.metrics(7, "2023-01-01")
+            wave[0] = dict(wave[0], percentage=wave[0]["percentage"] + 1)
+            del wave[1]
+            corrected = [metric for window in sync(
+                {"7": first[0].fingerprints[7]}) for metric in window.metrics]
+
+        assert len([metric for metric in corrected if isinstance(metric, DeletedFunnelMetrics)]) == 2
+        assert len([metric for metric in corrected if not isinstance(metric, DeletedFunnelMetrics)]) == 1
+
+    def test_does_not_record_the_size_of_a_replayed_partition(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+        with FakeTracksuitApi(account_brand_ids=[7], rows_per_wave=3) as api:
+            repo = MetricFetcherRepo(api.token, base_url=api.base_url, response_cache=cache)
+            with MetricFetcher(repo) as fetcher:
+                fetched = list(fetcher.fetch_windows(wave_ranges([7], "2023-01-01", "2023-01-01"), "All"))
+                repo.resume({})
+                replayed = list(fetcher.fetch_windows(wave_ranges([7], "2023-01-01", "2023-01-01"), "All"))
+
+        assert set(fetched[0].sizes) == {7}
+        assert replayed[0].sizes == {}
+
+    def test_resumes_the_cursor_window_from_the_cursor_wave(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        mock_repo.fetch_funnel_data.return_value = []
+
+        list(MetricFetcher(repo=mock_repo, window_months=3).fetch_windows(
+            wave_ranges([1], "2020-01-01", "2020-03-01"), "Total", None,
+            {"window": "2020-01-01:2020-03-01", "wave_date": "2020-02-01", "id": "b"}))
+
+        mock_repo.fetch_funnel_data.assert_called_once_with(
+            1, "2020-02-01", "2020-03-01", "Total")
+
+    def test_skips_the_metrics_up_to_and_including_the_cursor(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        metrics = {
+            1: [mock_funnel_metric(id="a", wave_date="2020-02-01"),
+                mock_funnel_metric(id="c", wave_date="2020-02-01"),
+                mock_funnel_metric(id="a", wave_date="2020-03-01")],
+            2: [mock_funnel_metric(id="b", wave_date="2020-02-01"),
+                mock_funnel_metric(id="d", wave_date="2020-02-01")],
+        }
+        mock_repo.fetch_funnel_data.side_effect = lambda account_brand_id, start_date, end_date, filter_type: metrics[
+            account_brand_id]
+
+        windows = list(MetricFetcher(repo=mock_repo, window_months=3).fetch_windows(
+            wave_ranges([1, 2], "2020-01-01", "2020-03-01"), "Total", None,
+            {"window": "2020-01-01:2020-03-01", "wave_date": "2020-02-01", "id": "b"}))
+
+        result = [(metric.wave_date, metric.id)
+                  for metric in windows[0][2]]
+        assert result == [("2020-02-01", "c"),
+                          ("2020-02-01", "d"),
+                          ("2020-03-01", "a")]
+
+    def test_resumes_after_the_cursor_even_if_its_record_no_longer_exists(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        mock_repo.fetch_funnel_data.return_value = [
+            mock_funnel_metric(id="a", wave_date="2020-01-01"),
+            mock_funnel_metric(id="c", wave_date="2020-01-01")]
+
+        windows = list(MetricFetcher(repo=mock_repo).fetch_windows(
+            wave_ranges([1], "2020-01-01", "2020-01-01"), "Total", None,
+            {"window": "2020-01-01:2020-01-01", "wave_date": "2020-01-01", "id": "b"}))
+
+        assert [metric.id for metric in windows[0][2]] == ["c"]
+
+    def test_ignores_a_cursor_for_a_window_that_is_not_being_synced(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        mock_repo.fetch_funnel_data.return_value = [
+            mock_funnel_metric(id="a", wave_date="2020-01-01")]
+
+        windows = list(MetricFetcher(repo=mock_repo).fetch_windows(
+            wave_ranges([1], "2020-01-01", "2020-01-01"), "Total", None,
+            {"window": "2019-12-01:2019-12-01", "wave_date": "2019-12-01", "id": "b"}))
+
+        assert [metric.id for metric in windows[0][2]] == ["a"]
+
+
+class TestFingerprints:
+    def test_leaves_out_waves_whose_fingerprint_has_not_changed(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        unchanged = [mock_funnel_metric(id="a", wave_date="2020-01-01"),
+                     mock_funnel_metric(id="b", wave_date="2020-01-01")]
+        changed = [mock_funnel_metric(id="c", wave_date="2020-02-01")]
+        mock_repo.fetch_funnel_data.return_value = unchanged + changed
+
+        windows = list(MetricFetcher(repo=mock_repo, window_months=2).fetch_windows(
+            wave_ranges([1], "2020-01-01", "2020-02-01"), "Total",
+            fingerprints={"1": {"2020-01-01": wave_fingerprint(["b", "a"]),
+                                "2020-02-01": wave_fingerprint(["d"])}}))
+
+        assert list(windows[0].metrics) == changed
+        assert windows[0].fingerprints == {1: {"2020-01-01": wave_fingerprint(["a", "b"]),
+                                               "2020-02-01": wave_fingerprint(["c"])}}
+
+    def test_does_not_fingerprint_waves_unless_asked_to(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        mock_repo.fetch_funnel_data.return_value = [
+            mock_funnel_metric(id="a", wave_date="2020-01-01")]
+
+        windows = list(MetricFetcher(repo=mock_repo).fetch_windows(
+            wave_ranges([1], "2020-01-01", "2020-01-01"), "Total"))
+
+        assert windows[0].fingerprints == {}
+
+
+    def test_syncs_the_ids_added_and_deleted_since_a_changed_wave_was_indexed(self, tmp_path):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        kept = mock_funnel_metric(id="0b", wave_date="2020-01-01")
+        added = mock_funnel_metric(id="0c", wave_date="2020-01-01")
+        mock_repo.fetch_funnel_data.return_value = [added, kept]
+        index = WaveIndex(str(tmp_path))
+        index.write("Total", 1, "2020-01-01",
+                    wave_fingerprint(["0a", "0b"]), ["0a", "0b"])
+
+        windows = list(MetricFetcher(repo=mock_repo, wave_index=index).fetch_windows(
+            wave_ranges([1], "2020-01-01", "2020-01-01"), "Total",
+            fingerprints={"1": {"2020-01-01": wave_fingerprint(["0a", "0b"])}}))
+
+        assert list(windows[0].metrics) == [
+            DeletedFunnelMetrics("0a", 1, "2020-01-01"), added]
+        assert list(index.ids("Total", 1, "2020-01-01",
+                    wave_fingerprint(["0b", "0c"]))) == ["0b", "0c"]
+
+    def test_syncs_all_of_a_changed_wave_that_was_not_indexed(self, tmp_path):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        metrics = [mock_funnel_metric(id="0b", wave_date="2020-01-01")]
+        mock_repo.fetch_funnel_data.return_value = metrics
+
+        windows = list(MetricFetcher(repo=mock_repo, wave_index=WaveIndex(str(tmp_path))).fetch_windows(
+            wave_ranges([1], "2020-01-01", "2020-01-01"), "Total",
+            fingerprints={"1": {"2020-01-01": wave_fingerprint(["0a"])}}))
+
+        assert list(windows[0].metrics) == metrics
+
+
+class TestConcurrency:
+    def test_shares_one_worker_pool_between_requests(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        mock_repo.fetch_available_dates.return_value = ["2020-01-01"]
+        mock_repo.fetch_funnel_data.return_value = []
+        fetcher = MetricFetcher(repo=mock_repo, concurrent_requests=3)
+
+        fetcher.wave_ranges_to_sync([1, 2], {})
+        executor = fetcher.executor
+        list(fetcher.fetch_windows(wave_ranges([1, 2], "2020-01-01", "2020-01-01"), "Total"))
+
+        assert fetcher.executor is executor
+        assert executor._max_workers == 3
+        fetcher.close()
+
+    def test_closing_shuts_the_worker_pool_down(self):
+        with MetricFetcher(repo=Mock(spec=MetricFetcherRepo)) as fetcher:
+            executor = fetcher.executor
+
+        assert executor._shutdown
+
+    def test_raises_if_there_are_less_than_1_concurrent_requests(self):
+        with pytest.raises(ValueError):
+            MetricFetcher(repo=Mock(spec=MetricFetcherRepo),
+                          concurrent_requests=0)
+
+
+class TestMetricFetcherRepo:
+    def test_fetches_wave_dates_and_funnel_data_from_the_api(self):
+        with FakeTracksuitApi(account_brand_ids=[7], wave_dates=["2023-01-01", "2023-02-01"], rows_per_wave=3) as api:
+            repo = MetricFetcherRepo(api.token, base_url=api.base_url)
+
+            wave_dates = repo.fetch_available_dates(7)
+            metrics = list(repo.fetch_funnel_data(
+                7, "2023-02-01", "2023-02-01", "All"))
+
+        assert repo.fetch_account_brand_ids_for_client() == [7]
+        assert wave_dates == ["2023-01-01", "2023-02-01"]
+        assert len(metrics) == 3
+        assert all(metric.account_brand_id == 7 and metric.wave_date == "2023-02-01"
+                   for metric in metrics)
+
+    def test_counts_the_bytes_downloaded_and_rows_parsed_of_each_account_brand(self):
+        stats = SyncStats()
+        with FakeTracksuitApi(account_brand_ids=[7], rows_per_wave=3) as api:
+            repo = MetricFetcherRepo(api.token, base_url=api.base_url, stats=stats)
+            with MetricFetcher(repo, stats=stats) as fetcher:
+                window_metrics(fetcher.fetch_windows(wave_ranges([7], "2023-01-01", "2023-01-01"), "All"))
+
+        assert stats.total("bytes_downloaded") > 0
+        assert stats.total("rows_parsed") == 3
+        assert list(stats.by_label("fetch_seconds", "account_brand_id")) == ["7"]
+        assert stats.total("ids_seconds") > 0
+
+    def test_parses_funnel_data_in_the_parse_pool(self):
+        with FakeTracksuitApi(account_brand_ids=[7], rows_per_wave=3) as api, ThreadPoolExecutor(1) as parse_pool:
+            streamed = list(MetricFetcherRepo(api.token, base_url=api.base_url).fetch_funnel_data(
+                7, "2023-01-01", "2023-01-01", "All"))
+            parsed = list(MetricFetcherRepo(api.token, base_url=api.base_url, parse_pool=parse_pool).fetch_funnel_data(
+                7, "2023-01-01", "2023-01-01", "All"))
+
+        assert parsed == streamed
+
+    def test_decodes_whole_funnel_data_bodies_with_another_decoder(self):
+        stats = SyncStats()
+        with FakeTracksuitApi(account_brand_ids=[7], rows_per_wave=3) as api:
+            streamed = list(MetricFetcherRepo(api.token, base_url=api.base_url).fetch_funnel_data(
+                7, "2023-01-01", "2023-01-01", "All"))
+            decoded = list(MetricFetcherRepo(api.token, base_url=api.base_url, stats=stats,
+                                             decoder=DECODER_STDLIB).fetch_funnel_data(
+                7, "2023-01-01", "2023-01-01", "All"))
+
+        assert decoded == streamed
+        assert stats.total("decode_seconds") > 0
+
+    def test_requests_each_filter_type_and_filters_the_other_selections_while_parsing(self):
+        with FakeTracksuitApi(account_brand_ids=[7], rows_per_wave=200) as api:
+            repo = MetricFetcherRepo(api.token, base_url=api.base_url)
+            metrics = list(repo.fetch_funnel_data(7, "2023-01-01", "2023-01-01", MetricFilter(
+                filter_types=("Age", "Gender"), geographies=("Australia",))))
+
+        assert [path.split("?", 1)[1] for path in api.requests] == [
+            "waveStartDate=2023-01-01&waveEndDate=2023-01-01&filterType=Age&geography=Australia",
+            "waveStartDate=2023-01-01&waveEndDate=2023-01-01&filterType=Gender&geography=Australia"]
+        assert len(metrics) > 0
+        assert {metric.filter_type for metric in metrics} == {"Age", "Gender"}
+        assert {metric.geography_name for metric in metrics} == {"Australia"}
+
+    def test_replays_funnel_data_from_the_response_cache_when_resuming(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+        with FakeTracksuitApi(account_brand_ids=[7], rows_per_wave=3) as api:
+            repo = MetricFetcherRepo(api.token, base_url=api.base_url, response_cache=cache)
+            fetched = list(repo.fetch_funnel_data(7, "2023-01-01", "2023-01-01", "All"))
+            repo.resume({})
+            replayed = repo.fetch_funnel_data(7, "2023-01-01", "2023-01-01", "All")
+            list(repo.fetch_funnel_data(7, "2023-01-01", "2023-01-01", "Total"))
+
+            assert list(replayed) == fetched
+            assert replayed.replayed
+
+        assert len(api.requests) == 2
+        assert cache.stats()["hits"] == 1
+
+    def test_downloads_cached_funnel_data_unless_resuming(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+        with FakeTracksuitApi(account_brand_ids=[7], rows_per_wave=3) as api:
+            repo = MetricFetcherRepo(api.token, base_url=api.base_url, response_cache=cache)
+            list(repo.fetch_funnel_data(7, "2023-01-01", "2023-01-01", "All"))
+            fetched = repo.fetch_funnel_data(7, "2023-01-01", "2023-01-01", "All")
+            list(fetched)
+
+        assert not fetched.replayed
+        assert len(api.requests) == 2
+        assert cache.stats()["hits"] == 0
+
+    def test_downloads_the_waves_a_resumed_sync_re_checks(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+        with FakeTracksuitApi(account_brand_ids=[7], rows_per_wave=3) as api:
+            repo = MetricFetcherRepo(api.token, base_url=api.base_url, response_cache=cache)
+            list(repo.fetch_funnel_data(7, "2023-01-01", "2023-01-01", "All"))
+            repo.resume({"7": "2023-01-01"})
+            list(repo.fetch_funnel_data(7, "2023-01-01", "2023-01-01", "All"))
+
+        assert len(api.requests) == 2
+        assert cache.stats()["hits"] == 0
+
+    def test_does_not_cache_funnel_data_that_was_not_read_in_full(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+        with FakeTracksuitApi(account_brand_ids=[7], rows_per_wave=3) as api:
+            repo = MetricFetcherRepo(api.token, base_url=api.base_url, response_cache=cache)
+            metrics = repo.fetch_funnel_data(7, "2023-01-01", "2023-01-01", "All")
+            next(metrics)
+            metrics.close()
+
+        assert cache.stats()["entries"] == 0
+
+    def test_raises_if_funnel_data_cannot_be_fetched(self):
+        with FakeTracksuitApi(account_brand_ids=[7]) as api:
+            repo = MetricFetcherRepo(api.token, base_url=api.base_url)
+            repo.scheduler.sleep = lambda seconds: None
+            api.inject(status=502, count=repo.scheduler.max_attempts)
+
+            with pytest.raises(RequestFailed, match="failed to retrieve data for 7"):
+                repo.fetch_funnel_data(7, "2023-01-01", "2023-01-01", "All")
+
+    @pytest.mark.parametrize("decoder", [DECODER_STREAM, DECODER_STDLIB])
+    def test_requests_a_body_again_if_its_connection_breaks_part_way_through(self, decoder):
+        # large enough that the batches of metrics before the middle of the body are read before it breaks
+        with FakeTracksuitApi(account_brand_ids=[7], rows_per_wave=5000) as api:
+            repo = MetricFetcherRepo(api.token, base_url=api.base_url, decoder=decoder)
+            repo.scheduler.sleep = lambda seconds: None
+            expected = list(repo.fetch_funnel_data(7, "2023-01-01", "2023-01-01", "All"))
+            api.inject(truncate=True)
+
+            metrics = list(repo.fetch_funnel_data(7, "2023-01-01", "2023-01-01", "All"))
+
+            assert metrics == expected
+            assert len([path for path in api.requests if "/bulk/funnel/7" in path]) == 3
+
+    def test_raises_if_a_body_keeps_breaking_part_way_through(self):
+        with FakeTracksuitApi(account_brand_ids=[7], rows_per_wave=200) as api:
+            repo = MetricFetcherRepo(api.token, base_url=api.base_url)
+            repo.scheduler.sleep = lambda seconds: None
+            api.inject(truncate=True, count=repo.scheduler.max_attempts)
+
+            with pytest.raises(RequestFailed, match="failed to read data for 7"):
+                list(repo.fetch_funnel_data(7, "2023-01-01", "2023-01-01", "All"))
+
+    def test_caches_wave_dates_between_repos_for_the_same_token(self):
+        with FakeTracksuitApi(account_brand_ids=[7]) as api:
+            first = MetricFetcherRepo(api.token, base_url=api.base_url)
+            second = MetricFetcherRepo(api.token, base_url=api.base_url)
+
+            assert first.fetch_available_dates(7) == ["2023-01-01"]
+            assert second.fetch_available_dates(7) == ["2023-01-01"]
+
+        assert len(api.requests) == 1
+
+    def test_revalidates_stale_wave_dates_with_their_etag(self):
+        with FakeTracksuitApi(account_brand_ids=[7]) as api:
+            repo = MetricFetcherRepo(api.token, base_url=api.base_url)
+            repo.fetch_available_dates(7)
+            key = (api.base_url, repo.subject, "7")
+            WAVE_DATES.entries[key].expires_at = 0
+            revalidations = WAVE_DATES.stats()["revalidations"]
+
+            assert repo.fetch_available_dates(7) == ["2023-01-01"]
+
+        assert len(api.requests) == 2
+        assert WAVE_DATES.stats()["revalidations"] == revalidations + 1
+
+    def test_shares_a_rate_limiter_between_repos_for_the_same_token(self):
+        first = MetricFetcherRepo(fake_jwt([7]), base_url="http://localhost/v1")
+        second = MetricFetcherRepo(fake_jwt([7]), base_url="http://localhost/v1")
+        other = MetricFetcherRepo(fake_jwt([8]), base_url="http://localhost/v1")
+
+        assert first.scheduler.rate_limiter is second.scheduler.rate_limiter
+        assert first.scheduler.rate_limiter is not other.scheduler.rate_limiter
+
+
+class TestFetchPartitions:
+    def test_yields_each_partition_as_soon_as_it_has_been_fetched(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        release = threading.Event()
+
+        def fetch_funnel_data(account_brand_id, start_date, end_date, filter_type):
+            if account_brand_id == 1:
+                release.wait(5)
+            return [mock_funnel_metric(id="b", account_brand_id=account_brand_id, wave_date=start_date),
+                    mock_funnel_metric(id="a", account_brand_id=account_brand_id, wave_date=start_date)]
+        mock_repo.fetch_funnel_data.side_effect = fetch_funnel_data
+
+        with MetricFetcher(repo=mock_repo, concurrent_requests=2) as fetcher:
+            partitions = fetcher.fetch_partitions(
+                wave_ranges([1, 2], "2020-01-01", "2020-01-01"), "Total")
+            first = next(partitions)
+            release.set()
+            rest = list(partitions)
+
+        assert (first.key, first.account_brand_ids) == ("2020-01-01:2020-01-01", [2])
+        assert [metric.id for metric in first.metrics] == ["a", "b"]
+        assert set(first.sizes) == {2}
+        assert [window.account_brand_ids for window in rest] == [[1]]
+
+    def test_skips_the_partitions_already_synced(self):
+        mock_repo = Mock(spec=MetricFetcherRepo)
+        mock_repo.fetch_funnel_data.return_value = []
+
+        with MetricFetcher(repo=mock_repo) as fetcher:
+            partitions = sorted((window.key, window.account_brand_ids) for window in fetcher.fetch_partitions(
+                wave_ranges([1, 2], "2020-01-01", "2020-02-01"), "Total",
+                {"2020-01-01:2020-01-01": ["1", "2"], "2020-02-01:2020-02-01": ["1"]}))
+
+        assert partitions == [("2020-02-01:2020-02-01", [2])]
@@ -1,4 +1,19 @@
 import json
+import time
+from sync_stats import SyncStats
+from data_classes import FUNNEL_METRICS_COLUMNS, FUNNEL_METRICS_PRIMARY_KEY, FUNNEL_METRICS_TABLE, DeletedFunnelMetrics
+
+# the ValueType field each fivetran data type is written to
+VALUE_FIELDS = {
+    "STRING": "string",
+    "INT": "int",
+    "DOUBLE": "double",
+}
+
+# the checkpoint limits of a sync whose configuration doesn't set them
+DEFAULT_CHECKPOINT_RECORDS = 5000
+DEFAULT_CHECKPOINT_BYTES = 2 * 1024 * 1024
+DEFAULT_CHECKPOINT_SECONDS = 30
 
 
 class MetricSyncerRepo:
@@ -6,71 +21,28 @@ class MetricSyncerRepo:
         self.common = common
         self.sdk = sdk
         self.operation = operation
+        self.columns = [(name, VALUE_FIELDS[data_type])
+                        for name, data_type in FUNNEL_METRICS_COLUMNS]
 
     def get_syncable_metric(self, metric):
-        self.operation = self.sdk.Operation()
-        record = self.sdk.Record()
+        # values are written in place rather than built and copied into the response
+        response = self.sdk.UpdateResponse()
+        record = response.operation.record
         record.type = self.common.OpType.UPSERT
-        record.table_name = "funnel_metrics"
-
-        val_id = self.common.ValueType()
-        val_id.string = metric.id
-        record.data["id"].CopyFrom(val_id)
-
-        val_account_brand_id = self.common.ValueType()
-        val_account_brand_id.int = metric.account_brand_id
-        record.data["account_brand_id"].CopyFrom(val_account_brand_id)
-
-        val_brand_id = self.common.ValueType()
-        val_brand_id.int = metric.brand_id
-        record.data["brand_id"].CopyFrom(val_brand_id)
-
-        val_brand_name = self.common.ValueType()
-        val_brand_name.string = metric.brand_name
-        record.data["brand_name"].CopyFrom(val_brand_name)
-
-        val_filter = self.common.ValueType()
-        val_filter.string = metric.filter
-        record.data["filter"].CopyFrom(val_filter)
-
-        val_filter_type = self.common.ValueType()
-        val_filter_type.string = metric.filter_type
-        record.data["filter_type"].CopyFrom(val_filter_type)
-
-        val_wave_date = self.common.ValueType()
-        val_wave_date.string = metric.wave_date
-        record.data["wave_date"].CopyFrom(val_wave_date)
-
-        val_category = self.common.ValueType()
-        val_category.string = metric.category_name
-        record.data["category_name"].CopyFrom(val_category)
-
-        val_geography = self.common.ValueType()
-        val_geography.string = metric.geography_name
-        record.data["geography_name"].CopyFrom(val_geography)
-
-        val_base = self.common.ValueType()
-        val_base.int = metric.base
-        record.data["base"].CopyFrom(val_base)
-
-        val_weight = self.common.ValueType()
-        val_weight.double = metric.weight
-        record.data["weight"].CopyFrom(val_weight)
+        record.table_name = FUNNEL_METRICS_TABLE
+        data = record.data
+        for name, value_field in self.columns:
+            setattr(data[name], value_field, getattr(metric, name))
 
-        val_base_weight = self.common.ValueType()
-        val_base_weight.double = metric.base_weight
-        record.data["base_weight"].CopyFrom(val_base_weight)
+        return response
 
-        val_percentage = self.common.ValueType()
-        val_percentage.double = metric.percentage
-        record.data["percentage"].CopyFrom(val_percentage)
-
-        val_question_type = self.common.ValueType()
-        val_question_type.string = metric.question_type
-        record.data["question_type"].CopyFrom(val_question_type)
-
-        self.operation.record.CopyFrom(record)
-        return self.sdk.UpdateResponse(operation=self.operation)
+    def get_deleted_metric(self, metric):
+        response = self.sdk.UpdateResponse()
+        record = response.operation.record
+        record.type = self.common.OpType.DELETE
+        record.table_name = FUNNEL_METRICS_TABLE
+        record.data[FUNNEL_METRICS_PRIMARY_KEY].string = metric.id
+        return response
 
     def get_checkpoint(self, state):
         checkpoint = self.sdk.Checkpoint()
@@ -79,6 +51,9 @@ class MetricSyncerRepo:
         checkpoint_operation.checkpoint.CopyFrom(checkpoint)
         return self.sdk.UpdateResponse(operation=checkpoint_operation)
 
+    def size_of(self, response):
+        return response.ByteSize()
+
     def log(self, message):
         log = self.sdk.LogEntry()
         log.level = self.sdk.LogLevel.INFO
@@ -86,35 +61,180 @@ class MetricSyncerRepo:
         return self.sdk.UpdateResponse(log_entry=log)
 
 
+class CheckpointPolicy:
+    """Decides when the syncer checkpoints: after `max_records` records,
+    `max_bytes` bytes of encoded records or `max_seconds` since the last
+    checkpoint, whichever comes first. A limit of None is never reached.
+
+    Also counts the checkpoints taken and the time spent taking them."""
+
+    def __init__(self, max_records=100, max_bytes=None, max_seconds=None, clock=time.monotonic):
+        for name, limit in [("max_records", max_records), ("max_bytes", max_bytes), ("max_seconds", max_seconds)]:
+            if limit is not None and limit <= 0:
+                raise ValueError(f"{name} must be greater than 0")
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.clock = clock
+        self.checkpoints = 0
+        self.checkpoint_seconds = 0.0
+        self.reset()
+
+    @property
+    def counts_bytes(self):
+        return self.max_bytes is not None
+
+    def reset(self):
+        self.records = 0
+        self.bytes = 0
+        self.last_checkpoint_at = self.clock()
+
+    def record_synced(self, size=0):
+        self.records += 1
+        self.bytes += size
+
+    def should_checkpoint(self):
+        return ((self.max_records is not None and self.records >= self.max_records)
+                or (self.max_bytes is not None and self.bytes >= self.max_bytes)
+                or (self.max_seconds is not None and self.clock() - self.last_checkpoint_at >= self.max_seconds))
+
+    def checkpointed(self, started_at):
+        self.checkpoints += 1
+        self.checkpoint_seconds += self.clock() - started_at
+        self.reset()
+
+
 class MetricSyncer:
-    def __init__(self, repo: MetricSyncerRepo):
+    def __init__(self, repo: MetricSyncerRepo, checkpoint_policy=None, wave_index=None, stats=None):
         self.repo = repo
-
-    def sync_metrics(self, funnel_metrics, state, last_known_synced_record):
-        sync = True
-        if last_known_synced_record:
-            sync = False
-
-        metrics_since_checkpoint = 0
-        for metric in funnel_metrics:
-            if not sync:
-                if metric.id == last_known_synced_record:
-                    print("Resuming sync")
-                    sync = True
-                continue
-
-            yield self.repo.get_syncable_metric(metric)
-            metrics_since_checkpoint += 1
-            if metrics_since_checkpoint >= 100:
-                state["last_known_synced_record"] = metric.id
-                yield self.repo.get_checkpoint(state)
-                metrics_since_checkpoint = 0
-
-    def sync(self, funnel_metrics, state, last_known_synced_record, to_sync):
-        yield from self.sync_metrics(funnel_metrics, state, last_known_synced_record)
-
-        state["last_known_synced_record"] = None
-        state["last_date_synced_to"] = to_sync
-        yield self.repo.get_checkpoint(state)
-
-        yield self.repo.log("Sync completed")
+        self.checkpoint_policy = checkpoint_policy or CheckpointPolicy()
+        self.wave_index = wave_index
+        self.stats = stats or SyncStats()
+
+    def checkpoint(self, state):
+        started_at = self.checkpoint_policy.clock()
+        checkpoint = self.repo.get_checkpoint(state)
+        self.checkpoint_policy.checkpointed(started_at)
+        self.stats.add("checkpoints")
+        self.stats.add("checkpoint_seconds",
+                       self.checkpoint_policy.clock() - started_at)
+        return checkpoint
+
+    def sync_metrics(self, funnel_metrics, state, window=None, account_brand_id=None):
+        policy = self.checkpoint_policy
+        clock = self.stats.clock
+        # added to the stats a checkpoint at a time rather than locking them for every record
+        emitted, deleted, encode_seconds = 0, 0, 0.0
+        try:
+            for metric in funnel_metrics:
+                started_at = clock()
+                if isinstance(metric, DeletedFunnelMetrics):
+                    response = self.repo.get_deleted_metric(metric)
+                    deleted += 1
+                else:
+                    response = self.repo.get_syncable_metric(metric)
+                encode_seconds += clock() - started_at
+                emitted += 1
+                yield response
+                policy.record_synced(
+                    self.repo.size_of(response) if policy.counts_bytes else 0)
+                if policy.should_checkpoint():
+                    state["cursor"] = {"window": window,
+                                       "wave_date": metric.wave_date, "id": metric.id}
+                    if account_brand_id is not None:
+                        state["cursor"]["account_brand_id"] = str(account_brand_id)
+                    self.__add_synced(emitted, deleted, encode_seconds)
+                    emitted, deleted, encode_seconds = 0, 0, 0.0
+                    yield self.checkpoint(state)
+        finally:
+            self.__add_synced(emitted, deleted, encode_seconds)
+
+    def __add_synced(self, emitted, deleted, encode_seconds):
+        self.stats.add("rows_emitted", emitted)
+        self.stats.add("rows_deleted", deleted)
+        self.stats.add("encode_seconds", encode_seconds)
+
+    @staticmethod
+    def synced_to(state, filter_type, account_brand_ids):
+        """Returns the last wave synced for each account brand with
+        `filter_type`, keyed by account brand id."""
+        if "synced_to" in state:
+            return state["synced_to"].get(filter_type, {})
+
+        # syncs from before the per account brand waves recorded a single date for every account brand
+        last_date_synced_to = state.get("last_date_synced_to")
+        if last_date_synced_to is None:
+            return {}
+
+        return {str(account_brand_id): last_date_synced_to for account_brand_id in account_brand_ids}
+
+    @staticmethod
+    def fingerprints(state, filter_type):
+        """Returns the fingerprints of the synced waves with `filter_type`,
+        keyed by account brand id and then wave date."""
+        return state.get("fingerprints", {}).get(filter_type, {})
+
+    @staticmethod
+    def partition_sizes(state, filter_type):
+        """Returns the per wave sizes of the partitions last fetched with
+        `filter_type`, keyed by account brand id, see sync_planner."""
+        return state.get("partition_sizes", {}).get(filter_type, {})
+
+    def sync_windows(self, windows, state, wave_ranges, filter_type, unordered=False):
+        """Syncs the Windows from `MetricFetcher.fetch_windows`, checkpointing
+        each window, the fingerprints of its waves and the sizes of its
+        partitions once all of its metrics have been synced so a resumed sync
+        can skip it and the next sync can plan with them.
+
+        With `unordered`, each Window is a single partition from
+        `MetricFetcher.fetch_partitions`. The synced windows then record the
+        set of partitions synced so far, and the cursor is kept for the
+        account brand of the partition being synced."""
+        synced_windows = state.setdefault("synced_windows", {})
+        for window in windows:
+            yield from self.sync_metrics(window.metrics, state, window.key,
+                                         window.account_brand_ids[0] if unordered else None)
+
+            synced_windows.setdefault(window.key, []).extend(
+                str(account_brand_id) for account_brand_id in window.account_brand_ids)
+            for account_brand_id, fingerprints in window.fingerprints.items():
+                state.setdefault("fingerprints", {}).setdefault(filter_type, {}).setdefault(
+                    str(account_brand_id), {}).update(fingerprints)
+            for account_brand_id, size in window.sizes.items():
+                state.setdefault("partition_sizes", {}).setdefault(
+                    filter_type, {})[str(account_brand_id)] = size
+            state.pop("cursor", None)
+            yield self.checkpoint(state)
+
+        state.pop("synced_windows")
+        yield from self.complete(state, wave_ranges, filter_type)
+
+    def sync(self, funnel_metrics, state, wave_ranges, filter_type):
+        yield from self.sync_metrics(funnel_metrics, state)
+        yield from self.complete(state, wave_ranges, filter_type)
+
+    def complete(self, state, wave_ranges, filter_type):
+        """Records the last wave synced for each account brand and filter,
+        the next sync starts from the wave after it."""
+        state.pop("cursor", None)
+        # written by syncs from before the positional cursor and the per account brand waves
+        state.pop("last_known_synced_record", None)
+        state.pop("last_date_synced_to", None)
+        synced_to = state.setdefault("synced_to", {}).setdefault(filter_type, {})
+        fingerprints = self.fingerprints(state, filter_type)
+        for account_brand_id, wave_range in wave_ranges.items():
+            synced_to[str(account_brand_id)] = wave_range["to"]
+            # waves before this sync's range are older than the lookback and won't be compared again
+            if str(account_brand_id) in fingerprints:
+                fingerprints[str(account_brand_id)] = {
+                    wave_date: fingerprint for wave_date, fingerprint in fingerprints[str(account_brand_id)].items()
+                    if wave_date >= wave_range["from"]
+                }
+                if self.wave_index is not None:
+                    self.wave_index.prune(
+                        filter_type, account_brand_id, fingerprints[str(account_brand_id)])
+        yield self.checkpoint(state)
+
+        yield self.repo.log(
+            f"Sync completed, {self.checkpoint_policy.checkpoints} checkpoints took {self.checkpoint_policy.checkpoint_seconds:.3f}s")
+        yield self.repo.log(f"Sync stats: {self.stats.summary()}")
@@ -1,7 +1,11 @@
+import json
 import pytest
 from unittest.mock import Mock
-from data_classes import mock_funnel_metric
-from metric_syncer import MetricSyncer, MetricSyncerRepo
+from data_classes import DeletedFunnelMetrics, mock_funnel_metric
+from metric_fetcher import Window
+from metric_syncer import CheckpointPolicy, MetricSyncer, MetricSyncerRepo
+from sync_stats import SyncStats
+from wave_index import WaveIndex
 
 
 def test_syncs_all_metrics():
@@ -10,11 +14,8 @@ def test_syncs_all_metrics():
     metrics = [mock_funnel_metric(id=str(i+1)) for i in range(10)]
 
     state = {}
-    last_known_synced_record = None
-    to_sync = "2020-12-01"
 
-    list(syncer.sync_metrics(
-        metrics, state, last_known_synced_record))
+    list(syncer.sync_metrics(metrics, state))
 
     assert mock_repo.get_syncable_metric.call_count == 10
 
@@ -25,14 +26,11 @@ def test_creates_a_checkpoint_every_100_metric():
     metrics = [mock_funnel_metric(id=str(i+1)) for i in range(100)]
 
     state = {}
-    last_known_synced_record = None
-    to_sync = "2020-12-01"
 
-    list(syncer.sync_metrics(
-        metrics, state, last_known_synced_record))
+    list(syncer.sync_metrics(metrics, state, "2020-01-01:2020-01-01"))
 
     mock_repo.get_checkpoint.assert_called_once_with(
-        {"last_known_synced_record": "100"})
+        {"cursor": {"window": "2020-01-01:2020-01-01", "wave_date": "10/10/2020", "id": "100"}})
 
 
 def test_will_not_create_a_checkpoint_if_there_are_less_than_100_metrics():
@@ -41,58 +39,52 @@ def test_will_not_create_a_checkpoint_if_there_are_less_than_100_metrics():
     metrics = [mock_funnel_metric(id=str(i+1)) for i in range(99)]
 
     state = {}
-    last_known_synced_record = None
 
-    list(syncer.sync_metrics(
-        metrics, state, last_known_synced_record))
+    list(syncer.sync_metrics(metrics, state))
 
     mock_repo.get_checkpoint.assert_not_called()
 
 
-def test_continues_from_last_known_synced_record_if_one_exists():
+def test_saves_the_last_synced_wave_of_each_account_brand_when_the_sync_is_successful():
     mock_repo = Mock(spec=MetricSyncerRepo)
     syncer = MetricSyncer(mock_repo)
-    metrics = [mock_funnel_metric(id=str(i+1)) for i in range(10)]
+    metrics = [mock_funnel_metric(id=str(i+1)) for i in range(2)]
 
-    state = {"last_known_synced_record": "5"}
-    last_known_synced_record = "5"
+    state = {"synced_to": {"Total": {"3": "2020-01-01"}, "Age": {"1": "2019-01-01"}}}
+    wave_ranges = {1: {"from": "2020-01-01", "to": "2020-12-01"},
+                   2: {"from": "2020-11-01", "to": "2020-11-01"}}
 
-    list(syncer.sync_metrics(
-        metrics, state, last_known_synced_record))
+    list(syncer.sync(metrics, state, wave_ranges, "Total"))
 
-    mock_repo.get_syncable_metric.assert_any_call(metrics[5])
-    assert mock_repo.get_syncable_metric.call_count == 5
+    mock_repo.get_checkpoint.assert_called_once_with(
+        {"synced_to": {"Total": {"1": "2020-12-01", "2": "2020-11-01", "3": "2020-01-01"},
+                       "Age": {"1": "2019-01-01"}}})
 
 
-def test_starts_from_the_beginning_if_last_known_synced_record_is_not_found():
+def test_replaces_the_last_synced_date_of_older_syncs():
     mock_repo = Mock(spec=MetricSyncerRepo)
     syncer = MetricSyncer(mock_repo)
-    metrics = [mock_funnel_metric(id=str(i+1)) for i in range(10)]
 
-    state = {"last_known_synced_record": None}
-    last_known_synced_record = None
+    state = {"last_date_synced_to": "2020-01-01"}
 
-    list(syncer.sync_metrics(
-        metrics, state, last_known_synced_record))
+    list(syncer.sync([], state, {1: {"from": "2020-02-01", "to": "2020-02-01"}}, "All"))
 
-    mock_repo.get_syncable_metric.assert_any_call(metrics[0])
-    assert mock_repo.get_syncable_metric.call_count == 10
+    assert state == {"synced_to": {"All": {"1": "2020-02-01"}}}
 
 
-def test_saves_the_last_synced_date_when_the_sync_is_successful():
-    mock_repo = Mock(spec=MetricSyncerRepo)
-    syncer = MetricSyncer(mock_repo)
-    metrics = [mock_funnel_metric(id=str(i+1)) for i in range(2)]
+def test_synced_to_returns_the_last_synced_waves_for_the_filter():
+    state = {"synced_to": {"Total": {"1": "2020-01-01"}}}
 
-    state = {"last_known_synced_record": None}
-    last_known_synced_record = None
-    to_sync = "2020-12-01"
+    assert MetricSyncer.synced_to(state, "Total", [1, 2]) == {"1": "2020-01-01"}
+    assert MetricSyncer.synced_to(state, "Age", [1, 2]) == {}
 
-    list(syncer.sync(
-        metrics, state, last_known_synced_record, to_sync))
 
-    mock_repo.get_checkpoint.assert_called_once_with(
-        {"last_known_synced_record": None, "last_date_synced_to": to_sync})
+def test_synced_to_applies_the_last_synced_date_of_older_syncs_to_every_account_brand():
+    state = {"last_date_synced_to": "2020-01-01"}
+
+    assert MetricSyncer.synced_to(state, "Total", [1, "2"]) == {
+        "1": "2020-01-01", "2": "2020-01-01"}
+    assert MetricSyncer.synced_to({}, "Total", [1]) == {}
 
 
 def test_does_not_save_the_last_synced_date_when_the_sync_is_not_successful():
@@ -102,27 +94,237 @@ def test_does_not_save_the_last_synced_date_when_the_sync_is_not_successful():
 
     mock_repo.get_syncable_metric.side_effect = [ValueError("error")]
 
-    state = {"last_known_synced_record": None}
-    last_known_synced_record = None
-    to_sync = "2020-12-01"
+    state = {}
+    wave_ranges = {1: {"from": "2020-01-01", "to": "2020-12-01"}}
 
     with pytest.raises(ValueError):
-        list(syncer.sync(
-            metrics, state, last_known_synced_record, to_sync))
+        list(syncer.sync(metrics, state, wave_ranges, "Total"))
 
     mock_repo.get_checkpoint.assert_not_called()
 
 
-def test_sets_the_last_known_synced_record_to_none_when_the_sync_is_successful():
+def test_clears_the_cursor_when_the_sync_is_successful():
     mock_repo = Mock(spec=MetricSyncerRepo)
     syncer = MetricSyncer(mock_repo)
     metrics = [mock_funnel_metric(id=str(i+1)) for i in range(2)]
 
-    state = {"last_known_synced_record": "1"}
-    last_known_synced_record = "1"
-    to_sync = "2020-12-01"
+    state = {"cursor": {"window": None, "wave_date": "10/10/2020", "id": "1"},
+             "last_known_synced_record": "1"}
+    wave_ranges = {1: {"from": "2020-01-01", "to": "2020-12-01"}}
+
+    list(syncer.sync(metrics, state, wave_ranges, "Total"))
+
+    assert "cursor" not in state
+    assert "last_known_synced_record" not in state
+
+
+def test_checkpoints_each_window_once_it_has_been_synced():
+    mock_repo = Mock(spec=MetricSyncerRepo)
+    syncer = MetricSyncer(mock_repo)
+    checkpoints = []
+    mock_repo.get_checkpoint.side_effect = lambda state: checkpoints.append(
+        json.loads(json.dumps(state)))
+    windows = [
+        Window("2020-01-01:2020-01-01", [1, 2], [mock_funnel_metric(id="1")], {}),
+        Window("2020-02-01:2020-02-01", [2], [mock_funnel_metric(id="2")], {}),
+    ]
+
+    wave_ranges = {1: {"from": "2020-01-01", "to": "2020-01-01"},
+                   2: {"from": "2020-01-01", "to": "2020-02-01"}}
+
+    list(syncer.sync_windows(windows, {}, wave_ranges, "Total"))
+
+    assert checkpoints == [
+        {"synced_windows": {"2020-01-01:2020-01-01": ["1", "2"]}},
+        {"synced_windows": {"2020-01-01:2020-01-01": ["1", "2"], "2020-02-01:2020-02-01": ["2"]}},
+        {"synced_to": {"Total": {"1": "2020-01-01", "2": "2020-02-01"}}},
+    ]
+    assert mock_repo.get_syncable_metric.call_count == 2
+
 
-    list(syncer.sync(
-        metrics, state, last_known_synced_record, to_sync))
+def test_clears_the_cursor_once_its_window_has_been_synced():
+    mock_repo = Mock(spec=MetricSyncerRepo)
+    syncer = MetricSyncer(mock_repo)
+    state = {"cursor": {"window": "2020-01-01:2020-01-01",
+                        "wave_date": "2020-01-01", "id": "5"}}
+    windows = [Window("2020-01-01:2020-01-01", [1], [mock_funnel_metric(id="6")], {})]
+    checkpoints = []
+    mock_repo.get_checkpoint.side_effect = lambda state: checkpoints.append(
+        json.loads(json.dumps(state)))
+
+    list(syncer.sync_windows(windows, state, {
+         1: {"from": "2020-01-01", "to": "2020-01-01"}}, "Total"))
+
+    assert checkpoints[0] == {
+        "synced_windows": {"2020-01-01:2020-01-01": ["1"]}}
+
+
+def test_adds_to_the_synced_windows_of_a_resumed_sync():
+    mock_repo = Mock(spec=MetricSyncerRepo)
+    syncer = MetricSyncer(mock_repo)
+    state = {"synced_windows": {"2020-01-01:2020-01-01": ["1"]}}
+    windows = [Window("2020-01-01:2020-01-01", [2], [], {})]
+    checkpoints = []
+    mock_repo.get_checkpoint.side_effect = lambda state: checkpoints.append(
+        json.loads(json.dumps(state)))
+
+    list(syncer.sync_windows(windows, state, {
+         1: {"from": "2020-01-01", "to": "2020-01-01"}}, "Total"))
+
+    assert checkpoints[0]["synced_windows"] == {
+        "2020-01-01:2020-01-01": ["1", "2"]}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_creates_a_checkpoint_once_the_bytes_limit_is_reached():
+    mock_repo = Mock(spec=MetricSyncerRepo)
+    mock_repo.size_of.return_value = 300
+    syncer = MetricSyncer(mock_repo, CheckpointPolicy(
+        max_records=None, max_bytes=1000))
+    metrics = [mock_funnel_metric(id=str(i+1)) for i in range(8)]
+
+    list(syncer.sync_metrics(metrics, {}))
+
+    assert mock_repo.get_checkpoint.call_count == 2
+
+
+def test_creates_a_checkpoint_once_the_time_limit_is_reached():
+    mock_repo = Mock(spec=MetricSyncerRepo)
+    clock = FakeClock()
 
-    assert state["last_known_synced_record"] is None
+    def slow_metric(metric):
+        clock.now += 4
+    mock_repo.get_syncable_metric.side_effect = slow_metric
+    syncer = MetricSyncer(mock_repo, CheckpointPolicy(
+        max_records=None, max_seconds=10, clock=clock))
+    metrics = [mock_funnel_metric(id=str(i+1)) for i in range(7)]
+
+    list(syncer.sync_metrics(metrics, {}))
+
+    assert mock_repo.get_checkpoint.call_count == 2
+    mock_repo.size_of.assert_not_called()
+
+
+def test_counts_the_checkpoints_and_the_time_spent_taking_them():
+    mock_repo = Mock(spec=MetricSyncerRepo)
+    clock = FakeClock()
+
+    def slow_checkpoint(state):
+        clock.now += 0.5
+    mock_repo.get_checkpoint.side_effect = slow_checkpoint
+    policy = CheckpointPolicy(max_records=2, clock=clock)
+    syncer = MetricSyncer(mock_repo, policy)
+    metrics = [mock_funnel_metric(id=str(i+1)) for i in range(4)]
+
+    list(syncer.sync(metrics, {}, {1: {"from": "2020-12-01", "to": "2020-12-01"}}, "Total"))
+
+    assert policy.checkpoints == 3
+    assert policy.checkpoint_seconds == 1.5
+
+
+def test_raises_for_a_checkpoint_limit_that_is_never_positive():
+    with pytest.raises(ValueError, match="max_bytes must be greater than 0"):
+        CheckpointPolicy(max_records=10, max_bytes=0)
+
+
+def test_records_the_fingerprints_of_each_synced_window():
+    mock_repo = Mock(spec=MetricSyncerRepo)
+    syncer = MetricSyncer(mock_repo)
+    state = {"fingerprints": {"Total": {"1": {"2020-01-01": "old", "2019-01-01": "expired"}}}}
+    windows = [
+        Window("2020-01-01:2020-01-01", [1], [], {1: {"2020-01-01": "new"}}),
+        Window("2020-02-01:2020-02-01", [1, 2], [], {2: {"2020-02-01": "other"}}),
+    ]
+    wave_ranges = {1: {"from": "2020-01-01", "to": "2020-02-01"},
+                   2: {"from": "2020-02-01", "to": "2020-02-01"}}
+
+    list(syncer.sync_windows(windows, state, wave_ranges, "Total"))
+
+    assert MetricSyncer.fingerprints(state, "Total") == {
+        "1": {"2020-01-01": "new"}, "2": {"2020-02-01": "other"}}
+    assert MetricSyncer.fingerprints(state, "Age") == {}
+
+
+def test_syncs_deleted_metrics_as_deletes():
+    mock_repo = Mock(spec=MetricSyncerRepo)
+    syncer = MetricSyncer(mock_repo)
+    added = mock_funnel_metric(id="0b")
+    deleted = DeletedFunnelMetrics("0a", 2, "10/10/2020")
+
+    list(syncer.sync_metrics([deleted, added], {}))
+
+    mock_repo.get_deleted_metric.assert_called_once_with(deleted)
+    mock_repo.get_syncable_metric.assert_called_once_with(added)
+
+
+def test_prunes_the_wave_index_to_the_fingerprints_kept():
+    mock_repo = Mock(spec=MetricSyncerRepo)
+    mock_index = Mock(spec=WaveIndex)
+    syncer = MetricSyncer(mock_repo, wave_index=mock_index)
+    state = {"fingerprints": {"Total": {"1": {"2020-01-01": "new", "2019-01-01": "expired"}}}}
+
+    list(syncer.sync([], state, {1: {"from": "2020-01-01", "to": "2020-01-01"}}, "Total"))
+
+    mock_index.prune.assert_called_once_with("Total", 1, {"2020-01-01": "new"})
+
+
+def test_counts_the_rows_emitted_and_checkpoints_taken():
+    mock_repo = Mock(spec=MetricSyncerRepo)
+    stats = SyncStats()
+    syncer = MetricSyncer(mock_repo, CheckpointPolicy(max_records=2), stats=stats)
+    metrics = [mock_funnel_metric(id=str(i)) for i in range(3)] + \
+        [DeletedFunnelMetrics("9", 2, "10/10/2020")]
+
+    responses = list(syncer.sync(metrics, {}, {1: {"from": "2020-01-01", "to": "2020-01-01"}}, "Total"))
+
+    assert stats.total("rows_emitted") == 4
+    assert stats.total("rows_deleted") == 1
+    assert stats.total("checkpoints") == 3
+    mock_repo.log.assert_called_with(f"Sync stats: {stats.summary()}")
+    assert responses[-1] == mock_repo.log.return_value
+
+
+def test_records_the_partition_sizes_of_each_synced_window():
+    mock_repo = Mock(spec=MetricSyncerRepo)
+    syncer = MetricSyncer(mock_repo)
+    state = {"partition_sizes": {"Total": {"1": {"rows": 5.0, "seconds": 0.5}}}}
+    windows = [Window("2020-01-01:2020-01-01", [1, 2], [], {},
+                      {1: {"rows": 10.0, "seconds": 1.0}, 2: {"rows": 20.0, "seconds": 2.0}})]
+
+    list(syncer.sync_windows(windows, state, {
+         1: {"from": "2020-01-01", "to": "2020-01-01"}}, "Total"))
+
+    assert MetricSyncer.partition_sizes(state, "Total") == {
+        "1": {"rows": 10.0, "seconds": 1.0}, "2": {"rows": 20.0, "seconds": 2.0}}
+    assert MetricSyncer.partition_sizes(state, "Age") == {}
+
+
+def test_checkpoints_each_partition_of_an_unordered_sync_with_its_own_cursor():
+    mock_repo = Mock(spec=MetricSyncerRepo)
+    syncer = MetricSyncer(mock_repo, CheckpointPolicy(max_records=1))
+    checkpoints = []
+    mock_repo.get_checkpoint.side_effect = lambda state: checkpoints.append(
+        json.loads(json.dumps(state)))
+    windows = [
+        Window("2020-01-01:2020-01-01", [2], [mock_funnel_metric(id="1", account_brand_id=2)], {}),
+        Window("2020-01-01:2020-01-01", [1], [mock_funnel_metric(id="2", account_brand_id=1)], {}),
+    ]
+
+    list(syncer.sync_windows(windows, {}, {1: {"from": "2020-01-01", "to": "2020-01-01"},
+                                           2: {"from": "2020-01-01", "to": "2020-01-01"}}, "Total", unordered=True))
+
+    assert checkpoints[:4] == [
+        {"synced_windows": {}, "cursor": {"window": "2020-01-01:2020-01-01", "wave_date": "10/10/2020", "id": "1",
+                                          "account_brand_id": "2"}},
+        {"synced_windows": {"2020-01-01:2020-01-01": ["2"]}},
+        {"synced_windows": {"2020-01-01:2020-01-01": ["2"]}, "cursor": {
+            "window": "2020-01-01:2020-01-01", "wave_date": "10/10/2020", "id": "2", "account_brand_id": "1"}},
+        {"synced_windows": {"2020-01-01:2020-01-01": ["2", "1"]}},
+    ]
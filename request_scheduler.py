@@ -0,0 +1,135 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RequestFailed(Exception):
+    pass
+
+
+class TokenBucket:
+    """Allows `rate` requests a second on average with bursts of up to
+    `capacity`, shared by every thread that acquires from it."""
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be greater than 0")
+
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.capacity
+        self.updated_at = clock()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        """Stops handing out tokens for `seconds`, used when the API asks us to back off."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = max(self.paused_until - now,
+                           (1 - self.tokens) / self.rate)
+
+            self.sleep(wait)
+
+
+class RequestScheduler:
+    """Makes GET requests through `session` with connect and read timeouts,
+    retrying connection errors, timeouts, 429s and 5xx responses with
+    jittered exponential backoff or the delay the API asks for in
+    Retry-After. Raises RequestFailed once `max_attempts` have failed, or
+    straight away if Retry-After asks for longer than `max_backoff`, as the
+    rate limiter shared with other syncs would be paused for as long."""
+
+    def __init__(self, session, rate_limiter=None, max_attempts=5, backoff=0.5, max_backoff=30.0,
+                 timeout=(5.0, 60.0), sleep=time.sleep, random=random.random):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+
+        self.session = session
+        self.rate_limiter = rate_limiter
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.sleep = sleep
+        self.random = random
+
+    def backoff_for(self, attempt):
+        return self.random() * min(self.max_backoff, self.backoff * 2 ** attempt)
+
+    @staticmethod
+    def retry_after(response):
+        value = response.headers.get("Retry-After")
+        if value is None:
+            return None
+
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.max_attempts):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            delay = None
+            try:
+                response = self.session.get(url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                reason = str(e)
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    response.raise_for_status()
+                    return response
+
+                reason = f"{response.status_code} {response.reason}"
+                delay = self.retry_after(response)
+                response.close()
+                if delay is not None and delay > self.max_backoff:
+                    raise RequestFailed(
+                        f"request to {url} failed ({reason}) and asked to be retried in {delay:.0f}s, "
+                        f"longer than the {self.max_backoff:.0f}s the connector waits")
+                if delay is not None and self.rate_limiter is not None:
+                    self.rate_limiter.pause(delay)
+
+            self.wait_to_retry(url, attempt, reason, delay)
+
+    def wait_to_retry(self, url, attempt, reason, delay=None):
+        """Waits `delay`, or the backoff of `attempt`, before the request to
+        `url` is retried. Raises RequestFailed instead once `max_attempts`
+        have failed."""
+        if attempt == self.max_attempts - 1:
+            raise RequestFailed(
+                f"request to {url} failed after {self.max_attempts} attempts: {reason}")
+
+        if delay is None:
+            delay = self.backoff_for(attempt)
+        print(
+            f"request to {url} failed ({reason}), retrying in {delay:.2f}s")
+        self.sleep(delay)
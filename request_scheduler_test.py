@@ -0,0 +1,122 @@
+import pytest
+import requests
+from benchmarks.fake_api import FakeTracksuitApi
+from request_scheduler import RequestFailed, RequestScheduler, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def scheduler_for(sleeps, **kwargs):
+    return RequestScheduler(requests.Session(), sleep=sleeps.append, random=lambda: 1.0, **kwargs)
+
+
+def test_retries_server_errors_and_rate_limits_until_the_request_succeeds():
+    sleeps = []
+    with FakeTracksuitApi() as api:
+        api.inject(status=503)
+        api.inject(status=429)
+
+        response = scheduler_for(sleeps, backoff=0.5).get(
+            f"{api.base_url}/funnel/filters?accountBrandId=1")
+
+    assert response.json() == {"waveDates": ["2023-01-01"]}
+    assert len(api.requests) == 3
+    assert sleeps == [0.5, 1.0]
+
+
+def test_waits_for_the_delay_in_retry_after():
+    sleeps = []
+    with FakeTracksuitApi() as api:
+        api.inject(status=429, headers={"Retry-After": "7"})
+
+        scheduler_for(sleeps).get(f"{api.base_url}/funnel/filters")
+
+    assert sleeps == [7.0]
+
+
+def test_raises_instead_of_waiting_longer_than_the_max_backoff_for_retry_after():
+    sleeps = []
+    clock = FakeClock()
+    rate_limiter = TokenBucket(10, clock=clock, sleep=clock.sleep)
+    with FakeTracksuitApi() as api:
+        api.inject(status=429, headers={"Retry-After": "86400"})
+
+        with pytest.raises(RequestFailed, match="asked to be retried in 86400s"):
+            scheduler_for(sleeps, rate_limiter=rate_limiter, max_backoff=30).get(
+                f"{api.base_url}/funnel/filters")
+
+    assert sleeps == []
+    assert rate_limiter.paused_until == 0.0
+
+
+def test_retries_requests_that_time_out():
+    sleeps = []
+    with FakeTracksuitApi() as api:
+        api.inject(delay=0.5)
+
+        response = scheduler_for(sleeps, timeout=(1, 0.1)).get(
+            f"{api.base_url}/funnel/filters")
+
+    assert response.status_code == 200
+    assert len(sleeps) == 1
+
+
+def test_raises_once_every_attempt_has_failed():
+    sleeps = []
+    with FakeTracksuitApi() as api:
+        api.inject(status=500, count=3)
+
+        with pytest.raises(RequestFailed, match="after 3 attempts: 500"):
+            scheduler_for(sleeps, max_attempts=3).get(
+                f"{api.base_url}/funnel/filters")
+
+    assert len(api.requests) == 3
+
+
+def test_does_not_retry_client_errors():
+    sleeps = []
+    with FakeTracksuitApi() as api:
+        api.inject(status=403)
+
+        with pytest.raises(requests.exceptions.HTTPError):
+            scheduler_for(sleeps).get(f"{api.base_url}/funnel/filters")
+
+    assert len(api.requests) == 1
+    assert sleeps == []
+
+
+def test_backoff_grows_exponentially_up_to_the_limit():
+    scheduler = RequestScheduler(
+        requests.Session(), backoff=1, max_backoff=5, random=lambda: 1.0)
+
+    assert [scheduler.backoff_for(attempt) for attempt in range(5)] == [
+        1, 2, 4, 5, 5]
+
+
+def test_token_bucket_allows_a_burst_then_the_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock, sleep=clock.sleep)
+
+    for _ in range(5):
+        bucket.acquire()
+
+    assert clock.now == 1.0
+
+
+def test_token_bucket_hands_out_no_tokens_while_paused():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=10, clock=clock, sleep=clock.sleep)
+
+    bucket.pause(4)
+    bucket.acquire()
+
+    assert clock.now == 4.0
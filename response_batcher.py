@@ -0,0 +1,85 @@
+import queue
+import threading
+from sync_stats import SyncStats
+
+_DONE = object()
+
+
+class _Failed:
+    def __init__(self, error):
+        self.error = error
+
+
+class ResponseBatcher:
+    """Produces the responses of a sync on a background thread and hands them
+    to the Update stream a batch at a time.
+
+    Fetching and encoding run ahead of the stream while gRPC writes, the
+    bounded queue stops the producer once `batches_in_flight` batches are
+    waiting, and responses keep their order so a checkpoint always follows
+    the records before it."""
+
+    def __init__(self, batch_size=500, batches_in_flight=4, stats=None):
+        if batch_size < 1 or batches_in_flight < 1:
+            raise ValueError(
+                "batch_size and batches_in_flight must be at least 1")
+
+        self.batch_size = batch_size
+        self.batches_in_flight = batches_in_flight
+        # counts the time the producer waits on a full queue, which is gRPC holding the stream back
+        self.stats = stats or SyncStats()
+
+    def stream(self, responses):
+        batches = queue.Queue(maxsize=self.batches_in_flight)
+        stopped = threading.Event()
+
+        def put(item):
+            try:
+                batches.put_nowait(item)
+                return True
+            except queue.Full:
+                pass
+
+            with self.stats.timed("stream_wait"):
+                while not stopped.is_set():
+                    try:
+                        batches.put(item, timeout=0.1)
+                        return True
+                    except queue.Full:
+                        continue
+            return False
+
+        def produce():
+            try:
+                batch = []
+                for response in responses:
+                    batch.append(response)
+                    if len(batch) >= self.batch_size:
+                        if not put(batch):
+                            return
+                        batch = []
+
+                if len(batch) > 0 and not put(batch):
+                    return
+                put(_DONE)
+            except BaseException as e:
+                put(_Failed(e))
+            finally:
+                if hasattr(responses, "close"):
+                    responses.close()
+
+        producer = threading.Thread(
+            target=produce, name="response-batcher", daemon=True)
+        producer.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is _DONE:
+                    return
+                if isinstance(batch, _Failed):
+                    raise batch.error
+
+                yield from batch
+        finally:
+            stopped.set()
+            producer.join()
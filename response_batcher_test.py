@@ -0,0 +1,84 @@
+import threading
+import pytest
+from response_batcher import ResponseBatcher
+from sync_stats import SyncStats
+
+
+def test_streams_every_response_in_order():
+    responses = list(range(1234))
+
+    result = list(ResponseBatcher(batch_size=100).stream(iter(responses)))
+
+    assert result == responses
+
+
+def test_keeps_checkpoints_after_the_records_before_them():
+    responses = ["record 1", "record 2", "checkpoint", "record 3", "checkpoint"]
+
+    result = list(ResponseBatcher(batch_size=2).stream(iter(responses)))
+
+    assert result == responses
+
+
+def test_raises_the_error_of_the_sync_after_the_responses_before_it():
+    def responses():
+        yield 1
+        yield 2
+        raise ValueError("sync failed")
+
+    result = []
+    with pytest.raises(ValueError, match="sync failed"):
+        for response in ResponseBatcher(batch_size=1).stream(responses()):
+            result.append(response)
+
+    assert result == [1, 2]
+
+
+def test_stops_producing_once_the_queue_is_full():
+    produced = []
+
+    def responses():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    stream = ResponseBatcher(batch_size=10, batches_in_flight=2).stream(responses())
+    next(stream)
+    threading.Event().wait(0.2)
+
+    # the batch being streamed, the queued batches and the batch being filled
+    assert len(produced) <= 10 * 4 + 1
+    stream.close()
+
+
+def test_closes_the_sync_when_the_stream_is_closed():
+    closed = threading.Event()
+
+    def responses():
+        try:
+            while True:
+                yield 1
+        finally:
+            closed.set()
+
+    stream = ResponseBatcher(batch_size=10).stream(responses())
+    next(stream)
+    stream.close()
+
+    assert closed.wait(1)
+
+
+def test_raises_if_the_batch_size_is_less_than_1():
+    with pytest.raises(ValueError):
+        ResponseBatcher(batch_size=0)
+
+
+def test_counts_the_time_spent_waiting_on_a_slow_stream():
+    stats = SyncStats()
+    stream = ResponseBatcher(batch_size=1, batches_in_flight=1, stats=stats).stream(iter(range(3)))
+
+    next(stream)
+    threading.Event().wait(0.05)
+    list(stream)
+
+    assert stats.total("stream_wait_seconds") > 0
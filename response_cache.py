@@ -0,0 +1,256 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+DEFAULT_DIRECTORY = os.path.join(
+    tempfile.gettempdir(), "tracksuit-response-cache")
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# a retried or resumed sync replays its responses, see MetricFetcherRepo.resume
+DEFAULT_TTL = 24 * 60 * 60
+# compressed bytes decompressed at a time when an entry is replayed
+REPLAY_CHUNK_SIZE = 256 * 1024
+
+# magic, crc32 of the compressed body, time stored, length of the body
+_HEADER = struct.Struct("<4sIdQ")
+_MAGIC = b"TSR1"
+_SUFFIX = ".z"
+
+
+def cache_key(*parts):
+    """Returns a file name safe key for the JSON serialisable `parts`."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class ResponseCache:
+    """A size bounded cache of raw response bodies on disk, compressed with
+    zlib. Entries are replayed from memory mapped files, a chunk at a time,
+    after the checksum of their compressed bytes has been verified.
+
+    The least recently used entries are evicted once the cache holds more
+    than `max_bytes` of compressed bodies, and entries older than `ttl`
+    seconds are treated as missing. Safe to share between threads."""
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL, clock=time.time):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        # key: compressed size, least recently used first
+        self.entries = OrderedDict()
+        for name, size, _ in sorted(self.__stored(), key=lambda entry: entry[2]):
+            self.entries[name[:-len(_SUFFIX)]] = size
+        self.bytes = sum(self.entries.values())
+
+    def __stored(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(_SUFFIX):
+                stat = os.stat(os.path.join(self.directory, name))
+                yield name, stat.st_size, stat.st_mtime
+
+    def path(self, key):
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def open(self, key):
+        """Yields the chunks of the body cached for `key`, or returns None if
+        it isn't cached, has expired or fails its integrity check."""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+
+        try:
+            file = open(self.path(key), "rb")
+        except FileNotFoundError:
+            self.__discard(key)
+            return None
+
+        try:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            file.close()
+            self.__discard(key, "it is empty")
+            return None
+
+        problem = self.__check(mapped)
+        if problem is not None:
+            mapped.close()
+            file.close()
+            self.__discard(key, problem)
+            return None
+
+        with self.lock:
+            self.hits += 1
+        # marks the entry as recently used for the next process that loads the cache, through the file that is
+        # already open as another process may have evicted its path since
+        try:
+            os.utime(file.fileno())
+        except OSError as e:
+            print(f"Could not mark cached response {key} as recently used: {e}")
+        return self.__replay(file, mapped)
+
+    def __check(self, mapped):
+        if len(mapped) < _HEADER.size:
+            return "it is truncated"
+
+        magic, checksum, stored_at, _ = _HEADER.unpack_from(mapped)
+        if magic != _MAGIC:
+            return "it is not a cached response"
+        if self.clock() - stored_at > self.ttl:
+            return "it has expired"
+        with memoryview(mapped) as view:
+            if zlib.crc32(view[_HEADER.size:]) != checksum:
+                return "its checksum does not match"
+        return None
+
+    @staticmethod
+    def __replay(file, mapped):
+        try:
+            length = _HEADER.unpack_from(mapped)[3]
+            decompressor = zlib.decompressobj()
+            replayed = 0
+            for offset in range(_HEADER.size, len(mapped), REPLAY_CHUNK_SIZE):
+                chunk = decompressor.decompress(
+                    mapped[offset:offset + REPLAY_CHUNK_SIZE])
+                replayed += len(chunk)
+                yield chunk
+            chunk = decompressor.flush()
+            replayed += len(chunk)
+            yield chunk
+            if replayed != length:
+                raise ValueError(
+                    f"cached response replayed {replayed} of {length} bytes")
+        finally:
+            mapped.close()
+            file.close()
+
+    def __discard(self, key, problem=None):
+        if problem is not None:
+            print(f"Discarding cached response {key}, {problem}")
+        with self.lock:
+            self.misses += 1
+            self.bytes -= self.entries.pop(key, 0)
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def put(self, key, body):
+        writer = self.writer(key)
+        for _ in writer.tee([body]):
+            pass
+        writer.commit()
+
+    def writer(self, key):
+        """Returns a CacheWriter that stores a body for `key` as it is read."""
+        return CacheWriter(self, key)
+
+    def stored(self, key, path, size):
+        os.replace(path, self.path(key))
+        with self.lock:
+            self.bytes += size - self.entries.get(key, 0)
+            self.entries[key] = size
+            self.entries.move_to_end(key)
+            evicted = []
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                evicted_key, evicted_size = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+                evicted.append(evicted_key)
+
+        for evicted_key in evicted:
+            try:
+                os.remove(self.path(evicted_key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class CacheWriter:
+    """Compresses the chunks of a body into a temporary file as they pass
+    through `tee`. The entry is only stored once `commit` is called after
+    the whole body has been read, so a failed download is never cached."""
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.file = tempfile.NamedTemporaryFile(
+            dir=cache.directory, suffix=".tmp", delete=False)
+        self.file.write(b"\0" * _HEADER.size)
+        self.compressor = zlib.compressobj(level=1)
+        self.checksum = 0
+        self.length = 0
+        self.chunks = None
+
+    def tee(self, chunks):
+        self.chunks = iter(chunks)
+        return self.__tee()
+
+    def __tee(self):
+        for chunk in self.chunks:
+            self.__write(chunk)
+            yield chunk
+
+    def __write(self, chunk):
+        self.length += len(chunk)
+        compressed = self.compressor.compress(chunk)
+        self.checksum = zlib.crc32(compressed, self.checksum)
+        self.file.write(compressed)
+
+    def commit(self):
+        # the reader may stop before the end of the body, the rest is still part of it
+        for chunk in self.chunks or []:
+            self.__write(chunk)
+        compressed = self.compressor.flush()
+        self.checksum = zlib.crc32(compressed, self.checksum)
+        self.file.write(compressed)
+        self.file.seek(0)
+        self.file.write(_HEADER.pack(_MAGIC, self.checksum,
+                        self.cache.clock(), self.length))
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        self.file.close()
+        self.cache.stored(self.key, self.file.name, size)
+        self.file = None
+
+    def close(self):
+        """Throws the body away unless it was committed."""
+        if self.file is None:
+            return
+
+        self.file.close()
+        os.remove(self.file.name)
+        self.file = None
+
+
+# keyed by directory, shared by every sync in the process that uses the cache
+RESPONSE_CACHES = {}
+RESPONSE_CACHES_LOCK = threading.Lock()
+
+
+def shared_response_cache(directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES):
+    with RESPONSE_CACHES_LOCK:
+        if directory not in RESPONSE_CACHES:
+            RESPONSE_CACHES[directory] = ResponseCache(directory, max_bytes)
+        return RESPONSE_CACHES[directory]
@@ -0,0 +1,113 @@
+import os
+import zlib
+from response_cache import ResponseCache, cache_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def replayed(cache, key):
+    chunks = cache.open(key)
+    return None if chunks is None else b"".join(chunks)
+
+
+class TestResponseCache:
+    def test_replays_a_stored_body(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+
+        cache.put("a", b'{"metrics": []}' * 1000)
+
+        assert replayed(cache, "a") == b'{"metrics": []}' * 1000
+        assert os.path.getsize(cache.path("a")) < 1000
+        assert cache.stats()["hits"] == 1
+
+    def test_misses_a_body_that_was_never_stored(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+
+        assert cache.open("a") is None
+        assert cache.stats()["misses"] == 1
+
+    def test_stores_a_body_as_it_is_read_including_what_the_reader_left(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+        writer = cache.writer("a")
+
+        chunks = writer.tee([b"first ", b"second ", b"rest"])
+        assert next(chunks) == b"first "
+        writer.commit()
+        writer.close()
+
+        assert replayed(cache, "a") == b"first second rest"
+
+    def test_does_not_store_a_body_that_was_not_committed(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+        writer = cache.writer("a")
+
+        list(writer.tee([b"partial"]))
+        writer.close()
+
+        assert cache.open("a") is None
+        assert os.listdir(tmp_path) == []
+
+    def test_discards_a_body_that_fails_its_integrity_check(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+        cache.put("a", b"body" * 100)
+        with open(cache.path("a"), "r+b") as file:
+            file.seek(-2, os.SEEK_END)
+            file.write(b"xx")
+
+        assert cache.open("a") is None
+        assert not os.path.exists(cache.path("a"))
+
+    def test_discards_a_body_older_than_the_ttl(self, tmp_path):
+        clock = FakeClock()
+        cache = ResponseCache(str(tmp_path), ttl=60, clock=clock)
+        cache.put("a", b"body")
+
+        clock.now += 61
+
+        assert cache.open("a") is None
+
+    def test_evicts_the_least_recently_used_bodies_over_the_byte_limit(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+        cache.put("a", os.urandom(1000))
+        cache.max_bytes = cache.bytes * 2
+        cache.put("b", os.urandom(1000))
+        replayed(cache, "a")
+
+        cache.put("c", os.urandom(1000))
+
+        assert replayed(cache, "b") is None
+        assert replayed(cache, "a") is not None
+        assert replayed(cache, "c") is not None
+        assert cache.stats()["evictions"] == 1
+
+    def test_replays_a_body_another_process_evicts_while_it_is_opened(self, tmp_path, monkeypatch):
+        cache = ResponseCache(str(tmp_path))
+        cache.put("a", b"body")
+        crc32 = zlib.crc32
+
+        def evicted_while_checked(data):
+            if os.path.exists(cache.path("a")):
+                os.remove(cache.path("a"))
+            return crc32(data)
+        monkeypatch.setattr(zlib, "crc32", evicted_while_checked)
+
+        assert replayed(cache, "a") == b"body"
+
+    def test_loads_the_bodies_stored_by_an_earlier_process(self, tmp_path):
+        ResponseCache(str(tmp_path)).put("a", b"body")
+
+        cache = ResponseCache(str(tmp_path))
+
+        assert replayed(cache, "a") == b"body"
+        assert cache.stats()["bytes"] == os.path.getsize(cache.path("a"))
+
+
+def test_cache_keys_depend_on_every_part():
+    assert cache_key("url", 1, {"a": "1"}) == cache_key("url", 1, {"a": "1"})
+    assert cache_key("url", 1, {"a": "1"}) != cache_key("url", 1, {"a": "2"})
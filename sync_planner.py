@@ -0,0 +1,93 @@
+import heapq
+from datetime import datetime
+from typing import NamedTuple
+
+
+class WorkUnit(NamedTuple):
+    """The waves of one account brand in one wave window, fetched as a single
+    task for the sync's filter."""
+    window: str
+    account_brand_id: object
+    start_date: str
+    end_date: str
+    waves: int
+    # estimated from the sizes recorded by earlier syncs, None when nothing has been recorded
+    rows: float
+    seconds: float
+    # the (wave_date, id) of the cursor the unit resumes after, if any
+    resume_key: tuple = None
+
+
+def waves_between(start_date, end_date):
+    """The number of monthly waves from `start_date` to `end_date`, inclusive."""
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.strptime(end_date, "%Y-%m-%d")
+    return max(1, (end.year - start.year) * 12 + end.month - start.month + 1)
+
+
+def partition_size(rows, seconds, waves):
+    """The size of a fetched partition per wave, as it is kept in the state."""
+    return {"rows": round(rows / waves, 1), "seconds": round(seconds / waves, 3)}
+
+
+def estimate(sizes, account_brand_id, waves):
+    """Returns the (rows, seconds) estimated for `waves` of an account brand
+    from `sizes`, the per wave sizes recorded by earlier syncs keyed by
+    account brand id. An account brand that has never been synced is
+    estimated at the average of the others."""
+    size = sizes.get(str(account_brand_id))
+    if size is None and len(sizes) > 0:
+        size = {name: sum(known[name] for known in sizes.values()) / len(sizes)
+                for name in ["rows", "seconds"]}
+    if size is None:
+        return None, None
+
+    return size["rows"] * waves, size["seconds"] * waves
+
+
+def largest_first(units):
+    """Orders `units` longest processing time first, by their estimated
+    seconds or, without estimates, by their number of waves. Units of the
+    same size keep their order."""
+    return sorted(units, key=lambda unit: (unit.seconds or 0, unit.waves), reverse=True)
+
+
+class SyncPlan(NamedTuple):
+    # (window key, work units largest first) in the order the windows are synced
+    windows: list
+    # the tasks the units are fetched on at once
+    workers: int
+
+    @property
+    def units(self):
+        return [unit for _, units in self.windows for unit in units]
+
+    @property
+    def estimated_rows(self):
+        rows = [unit.rows for unit in self.units]
+        return None if None in rows else sum(rows)
+
+    @property
+    def estimated_seconds(self):
+        """How long fetching every unit is estimated to take when each is
+        started on the first free worker in plan order, or None without
+        estimates. Waiting on the destination is not included."""
+        if any(unit.seconds is None for unit in self.units):
+            return None
+
+        workers = [0.0] * max(self.workers, 1)
+        for unit in self.units:
+            heapq.heappush(workers, heapq.heappop(workers) + unit.seconds)
+        return max(workers)
+
+    def describe(self):
+        seconds = self.estimated_seconds
+        lines = [f"{len(self.units)} work units in {len(self.windows)} windows on {self.workers} workers, "
+                 + ("no earlier sync to estimate from" if seconds is None else
+                    f"estimated {self.estimated_rows:,.0f} rows in {seconds:.1f}s")]
+        for key, units in self.windows:
+            lines.append(f"{key}: " + ", ".join(
+                f"{unit.account_brand_id} ({unit.waves} waves" +
+                ("" if unit.seconds is None else f", ~{unit.rows:,.0f} rows, ~{unit.seconds:.1f}s") + ")"
+                for unit in units))
+        return "\n".join(lines)
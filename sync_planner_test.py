@@ -0,0 +1,48 @@
+from sync_planner import SyncPlan, WorkUnit, estimate, largest_first, partition_size, waves_between
+
+
+def unit(account_brand_id, seconds, waves=1, window="2020-01-01:2020-01-01"):
+    return WorkUnit(window, account_brand_id, "2020-01-01", "2020-01-01", waves,
+                    None if seconds is None else seconds * 100, seconds)
+
+
+def test_counts_the_monthly_waves_of_a_range():
+    assert waves_between("2020-01-01", "2020-01-01") == 1
+    assert waves_between("2020-11-01", "2021-02-01") == 4
+
+
+def test_estimates_from_the_per_wave_size_of_each_account_brand():
+    sizes = {"1": partition_size(300, 6.0, 3), "2": {"rows": 300.0, "seconds": 4.0}}
+
+    assert estimate(sizes, 1, 2) == (200.0, 4.0)
+    # never synced, the average of the others
+    assert estimate(sizes, 3, 1) == (200.0, 3.0)
+    assert estimate({}, 1, 2) == (None, None)
+
+
+def test_orders_units_longest_processing_time_first():
+    units = [unit(1, 1.0), unit(2, 5.0), unit(3, 1.0), unit(4, 3.0)]
+
+    assert [unit.account_brand_id for unit in largest_first(units)] == [2, 4, 1, 3]
+
+
+def test_orders_units_without_estimates_by_their_waves():
+    units = [unit(1, None, waves=1), unit(2, None, waves=3), unit(3, None, waves=1)]
+
+    assert [unit.account_brand_id for unit in largest_first(units)] == [2, 1, 3]
+
+
+def test_estimates_the_time_to_fetch_every_unit_on_the_workers():
+    units = [unit(1, 5.0), unit(2, 3.0), unit(3, 2.0), unit(4, 2.0)]
+
+    assert SyncPlan([("2020-01-01:2020-01-01", units)], 2).estimated_seconds == 7.0
+    assert SyncPlan([("2020-01-01:2020-01-01", units)], 1).estimated_seconds == 12.0
+    assert SyncPlan([("2020-01-01:2020-01-01", units)], 2).estimated_rows == 1200.0
+
+
+def test_describes_a_plan_without_estimates():
+    plan = SyncPlan([("2020-01-01:2020-01-01", [unit(1, None)])], 4)
+
+    assert plan.estimated_seconds is None
+    assert plan.describe() == ("1 work units in 1 windows on 4 workers, no earlier sync to estimate from\n"
+                               "2020-01-01:2020-01-01: 1 (1 waves)")
@@ -0,0 +1,110 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PROMETHEUS_PREFIX = "tracksuit_connector"
+
+
+class SyncStats:
+    """Counts and times the stages of a sync, optionally labelled (for
+    example by account brand id).
+
+    Every value added is also added to `parent`, so the stats of each sync
+    roll up into the totals of the process."""
+
+    def __init__(self, parent=None, clock=time.perf_counter):
+        self.parent = parent
+        self.clock = clock
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+        if self.parent is not None:
+            self.parent.add(name, value, **labels)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """Adds the seconds spent in the block to `{name}_seconds`."""
+        started_at = self.clock()
+        try:
+            yield
+        finally:
+            self.add(f"{name}_seconds", self.clock() - started_at, **labels)
+
+    def total(self, name):
+        with self.lock:
+            return sum(value for (value_name, _), value in self.values.items() if value_name == name)
+
+    def by_label(self, name, label):
+        with self.lock:
+            return {dict(labels)[label]: value for (value_name, labels), value in self.values.items()
+                    if value_name == name and label in dict(labels)}
+
+    def summary(self):
+        fetch_seconds = self.by_label("fetch_seconds", "account_brand_id")
+        slowest = max(fetch_seconds.items(), key=lambda item: item[1],
+                      default=(None, 0.0))
+        rows_parsed = self.total("rows_parsed")
+        parse_rate = rows_parsed / self.total("fetch_seconds") \
+            if self.total("fetch_seconds") > 0 else 0.0
+        return (f"fetched {len(fetch_seconds)} account brand(s) in {self.total('fetch_seconds'):.3f}s"
+                f" (slowest {slowest[0]} {slowest[1]:.3f}s),"
+                f" {self.total('bytes_downloaded') / 1024 / 1024:.1f} MiB downloaded,"
+                f" {rows_parsed:.0f} rows parsed at {parse_rate:,.0f} rows/sec,"
+                f" ids {self.total('ids_seconds'):.3f}s, sort {self.total('sort_seconds'):.3f}s,"
+                f" encode {self.total('encode_seconds'):.3f}s,"
+                f" {self.total('rows_emitted'):.0f} rows emitted ({self.total('rows_deleted'):.0f} deletes),"
+                f" {self.total('checkpoints'):.0f} checkpoints,"
+                f" {self.total('stream_wait_seconds'):.3f}s waiting on the stream")
+
+    def prometheus(self):
+        """Returns every value as a Prometheus counter in the text exposition format."""
+        with self.lock:
+            values = sorted(self.values.items())
+
+        lines = []
+        previous_name = None
+        for (name, labels), value in values:
+            metric = f"{PROMETHEUS_PREFIX}_{name}_total"
+            if name != previous_name:
+                lines.append(f"# TYPE {metric} counter")
+                previous_name = name
+            label_text = ",".join(
+                f'{label}="{label_value}"' for label, label_value in labels)
+            lines.append(
+                f"{metric}{{{label_text}}} {value}" if label_text else f"{metric} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+# the totals of every sync run by this process
+PROCESS_STATS = SyncStats()
+
+
+def serve_prometheus(stats, port, host="127.0.0.1"):
+    """Serves `stats` at /metrics on a background thread, returns the server."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+
+            body = stats.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever,
+                     name="prometheus", daemon=True).start()
+    return server
@@ -0,0 +1,86 @@
+import requests
+from sync_stats import SyncStats, serve_prometheus
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_adds_up_values_by_name_and_label():
+    stats = SyncStats()
+
+    stats.add("rows_parsed", 10)
+    stats.add("fetch_seconds", 1.5, account_brand_id="1")
+    stats.add("fetch_seconds", 0.5, account_brand_id="2")
+    stats.add("fetch_seconds", 1.0, account_brand_id="1")
+
+    assert stats.total("rows_parsed") == 10
+    assert stats.total("fetch_seconds") == 3.0
+    assert stats.by_label("fetch_seconds", "account_brand_id") == {"1": 2.5, "2": 0.5}
+
+
+def test_times_a_block_in_seconds():
+    clock = FakeClock()
+    stats = SyncStats(clock=clock)
+
+    with stats.timed("sort"):
+        clock.now += 2.5
+
+    assert stats.total("sort_seconds") == 2.5
+
+
+def test_rolls_values_up_into_the_parent():
+    parent = SyncStats()
+    first, second = SyncStats(parent), SyncStats(parent)
+
+    first.add("rows_emitted", 2)
+    second.add("rows_emitted", 3)
+
+    assert first.total("rows_emitted") == 2
+    assert parent.total("rows_emitted") == 5
+
+
+def test_summarises_every_stage():
+    stats = SyncStats()
+    stats.add("fetch_seconds", 2.0, account_brand_id="7")
+    stats.add("rows_parsed", 1000)
+    stats.add("rows_emitted", 900)
+    stats.add("checkpoints", 3)
+
+    summary = stats.summary()
+
+    assert "fetched 1 account brand(s) in 2.000s (slowest 7 2.000s)" in summary
+    assert "1000 rows parsed at 500 rows/sec" in summary
+    assert "900 rows emitted" in summary
+    assert "3 checkpoints" in summary
+
+
+def test_formats_values_as_prometheus_counters():
+    stats = SyncStats()
+    stats.add("rows_emitted", 5)
+    stats.add("fetch_seconds", 1.5, account_brand_id="1")
+
+    assert stats.prometheus() == (
+        "# TYPE tracksuit_connector_fetch_seconds_total counter\n"
+        'tracksuit_connector_fetch_seconds_total{account_brand_id="1"} 1.5\n'
+        "# TYPE tracksuit_connector_rows_emitted_total counter\n"
+        "tracksuit_connector_rows_emitted_total 5\n")
+
+
+def test_serves_prometheus_text_on_a_local_port():
+    stats = SyncStats()
+    stats.add("rows_emitted", 5)
+    server = serve_prometheus(stats, 0)
+    try:
+        response = requests.get(
+            f"http://127.0.0.1:{server.server_address[1]}/metrics", timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert response.status_code == 200
+    assert "tracksuit_connector_rows_emitted_total 5" in response.text
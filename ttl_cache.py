@@ -0,0 +1,97 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheEntry:
+    __slots__ = ('value', 'etag', 'expires_at')
+
+    def __init__(self, value, etag, expires_at):
+        self.value = value
+        self.etag = etag
+        self.expires_at = expires_at
+
+
+class TTLCache:
+    """A thread safe, in process LRU cache whose entries go stale `ttl`
+    seconds after they were stored or revalidated.
+
+    Stale entries are kept, along with the ETag they were served with, until
+    they are evicted so the caller can revalidate them with the server
+    instead of downloading them again."""
+
+    def __init__(self, max_entries=1024, ttl=900, clock=time.monotonic):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        """Returns (value, etag, fresh) for `key`, or None if it isn't cached.
+        Only fresh entries count as a hit."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            fresh = self.clock() < entry.expires_at
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry.value, entry.etag, fresh
+
+    def get(self, key, load):
+        """Returns the fresh value cached for `key`, storing the result of
+        `load()` when there isn't one."""
+        cached = self.lookup(key)
+        if cached is not None and cached[2]:
+            return cached[0]
+
+        value = load()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value, etag=None):
+        with self.lock:
+            self.entries[key] = CacheEntry(
+                value, etag, self.clock() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def revalidated(self, key):
+        """Marks the stale entry for `key` as fresh again, after the server
+        confirmed it hasn't changed."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+
+            entry.expires_at = self.clock() + self.ttl
+            self.revalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,77 @@
+import pytest
+from ttl_cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_returns_fresh_entries_and_counts_hits_and_misses():
+    cache = TTLCache(ttl=10, clock=FakeClock())
+
+    assert cache.lookup("a") is None
+    cache.put("a", 1, '"etag"')
+
+    assert cache.lookup("a") == (1, '"etag"', True)
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_entries_go_stale_after_the_ttl_but_keep_their_etag():
+    clock = FakeClock()
+    cache = TTLCache(ttl=10, clock=clock)
+    cache.put("a", 1, '"etag"')
+
+    clock.now = 10
+
+    assert cache.lookup("a") == (1, '"etag"', False)
+    assert cache.stats()["misses"] == 1
+
+
+def test_revalidated_entries_are_fresh_again():
+    clock = FakeClock()
+    cache = TTLCache(ttl=10, clock=clock)
+    cache.put("a", 1, '"etag"')
+
+    clock.now = 15
+    cache.revalidated("a")
+
+    assert cache.lookup("a") == (1, '"etag"', True)
+    assert cache.stats()["revalidations"] == 1
+
+
+def test_evicts_the_least_recently_used_entry():
+    cache = TTLCache(max_entries=2, clock=FakeClock())
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.lookup("a")
+
+    cache.put("c", 3)
+
+    assert cache.lookup("b") is None
+    assert cache.lookup("a")[0] == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_get_only_loads_values_that_are_not_fresh():
+    clock = FakeClock()
+    cache = TTLCache(ttl=10, clock=clock)
+    loads = []
+
+    def load():
+        loads.append(1)
+        return len(loads)
+
+    assert cache.get("a", load) == 1
+    assert cache.get("a", load) == 1
+    clock.now = 10
+    assert cache.get("a", load) == 2
+
+
+def test_raises_if_it_cannot_hold_any_entries():
+    with pytest.raises(ValueError):
+        TTLCache(max_entries=0)
@@ -0,0 +1,132 @@
+import os
+import shutil
+import tempfile
+from heapq import merge
+from urllib.parse import quote
+from data_classes import DeletedFunnelMetrics
+
+DEFAULT_DIRECTORY = os.path.join(
+    tempfile.gettempdir(), "tracksuit-wave-index")
+# ids read from an index file at a time
+BLOCK_IDS = 4096
+
+
+class WaveIndex:
+    """Keeps the record ids of each synced wave on disk, so a wave synced
+    again can be compared against the ids the destination already has.
+
+    Each (filter, account brand, wave) gets one file per fingerprint
+    holding its ids as sorted, fixed width binary digests. The fingerprint
+    in the state decides which file is current, so an index written for a
+    window that never got checkpointed is simply not used. Files are read a
+    block at a time and only the waves being synced are ever in memory."""
+
+    def __init__(self, directory=DEFAULT_DIRECTORY):
+        self.directory = directory
+
+    def path(self, filter_type, account_brand_id, wave_date, fingerprint):
+        return os.path.join(self.directory, self.__directory_name(filter_type), str(account_brand_id), wave_date,
+                            f"{fingerprint}.ids")
+
+    @staticmethod
+    def __directory_name(filter_type):
+        # filter keys may hold any geography or category name
+        return quote(filter_type, safe="")
+
+    def has(self, filter_type, account_brand_id, wave_date, fingerprint):
+        return os.path.exists(self.path(filter_type, account_brand_id, wave_date, fingerprint))
+
+    def write(self, filter_type, account_brand_id, wave_date, fingerprint, ids):
+        """Stores the hex `ids` of a wave, which must be sorted, under its
+        fingerprint."""
+        path = self.path(filter_type, account_brand_id, wave_date, fingerprint)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        digests = [bytes.fromhex(id) for id in ids]
+        width = len(digests[0]) if len(digests) > 0 else 0
+        if any(len(digest) != width for digest in digests):
+            raise ValueError(
+                f"ids of wave {wave_date} for {account_brand_id} are not all the same length")
+
+        # written next to the index and renamed over it so a reader never sees a partial file
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as file:
+            file.write(bytes([width]))
+            file.write(b"".join(digests))
+        os.replace(file.name, path)
+
+    def ids(self, filter_type, account_brand_id, wave_date, fingerprint):
+        """Yields the ids stored for a wave in sorted order, or returns None
+        if there is no index for the fingerprint."""
+        path = self.path(filter_type, account_brand_id, wave_date, fingerprint)
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            return None
+
+        return self.__read(file)
+
+    @staticmethod
+    def __read(file):
+        with file:
+            header = file.read(1)
+            width = header[0] if len(header) > 0 else 0
+            if width == 0:
+                return
+
+            while True:
+                block = file.read(width * BLOCK_IDS)
+                if len(block) == 0:
+                    return
+
+                for start in range(0, len(block), width):
+                    yield block[start:start + width].hex()
+
+    def diff(self, filter_type, account_brand_id, wave_date, synced_fingerprint, metrics):
+        """Compares the `metrics` of a wave, sorted by id, with the ids
+        indexed under `synced_fingerprint`. Returns the metrics that are new
+        and a DeletedFunnelMetrics for every indexed id that is gone, merged
+        into id order, or None if there is no index to compare against."""
+        synced_ids = self.ids(
+            filter_type, account_brand_id, wave_date, synced_fingerprint)
+        if synced_ids is None:
+            return None
+
+        added = []
+        deleted = []
+        synced_id = next(synced_ids, None)
+        for metric in metrics:
+            while synced_id is not None and synced_id < metric.id:
+                deleted.append(DeletedFunnelMetrics(
+                    synced_id, account_brand_id, wave_date))
+                synced_id = next(synced_ids, None)
+
+            if synced_id == metric.id:
+                synced_id = next(synced_ids, None)
+            else:
+                added.append(metric)
+
+        while synced_id is not None:
+            deleted.append(DeletedFunnelMetrics(
+                synced_id, account_brand_id, wave_date))
+            synced_id = next(synced_ids, None)
+
+        return list(merge(added, deleted, key=lambda metric: metric.id))
+
+    def prune(self, filter_type, account_brand_id, fingerprints):
+        """Removes the indexes of an account brand's waves that are not in
+        `fingerprints`, keyed by wave date, or are indexed under a different
+        fingerprint."""
+        directory = os.path.join(
+            self.directory, self.__directory_name(filter_type), str(account_brand_id))
+        if not os.path.isdir(directory):
+            return
+
+        for wave_date in os.listdir(directory):
+            if wave_date not in fingerprints:
+                shutil.rmtree(os.path.join(directory, wave_date),
+                              ignore_errors=True)
+                continue
+
+            current = f"{fingerprints[wave_date]}.ids"
+            for name in os.listdir(os.path.join(directory, wave_date)):
+                if name != current:
+                    os.remove(os.path.join(directory, wave_date, name))
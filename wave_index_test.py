@@ -0,0 +1,74 @@
+import os
+import pytest
+from data_classes import DeletedFunnelMetrics, mock_funnel_metric
+from wave_index import WaveIndex
+
+
+class TestWaveIndex:
+    def test_returns_the_ids_written_for_a_wave_fingerprint(self, tmp_path):
+        index = WaveIndex(str(tmp_path))
+
+        index.write("Total", 1, "2020-01-01", "2-ab", ["0a0b", "ff00"])
+
+        assert list(index.ids("Total", 1, "2020-01-01", "2-ab")) == ["0a0b", "ff00"]
+        assert index.has("Total", 1, "2020-01-01", "2-ab")
+
+    def test_returns_none_for_a_fingerprint_that_was_never_indexed(self, tmp_path):
+        index = WaveIndex(str(tmp_path))
+
+        index.write("Total", 1, "2020-01-01", "2-ab", ["0a0b", "ff00"])
+
+        assert index.ids("Total", 1, "2020-01-01", "1-cd") is None
+        assert not index.has("Total", 2, "2020-01-01", "2-ab")
+
+    def test_raises_if_the_ids_are_not_all_the_same_length(self, tmp_path):
+        with pytest.raises(ValueError):
+            WaveIndex(str(tmp_path)).write(
+                "Total", 1, "2020-01-01", "2-ab", ["0a0b", "ff0000"])
+
+    def test_diffs_a_wave_into_its_new_and_deleted_ids(self, tmp_path):
+        index = WaveIndex(str(tmp_path))
+        index.write("Total", 1, "2020-01-01", "3-ab", ["01", "03", "05"])
+        metrics = [mock_funnel_metric(id=id, account_brand_id=1, wave_date="2020-01-01")
+                   for id in ["02", "03", "06"]]
+
+        diff = index.diff("Total", 1, "2020-01-01", "3-ab", metrics)
+
+        assert diff == [DeletedFunnelMetrics("01", 1, "2020-01-01"), metrics[0],
+                        DeletedFunnelMetrics("05", 1, "2020-01-01"), metrics[2]]
+
+    def test_diffs_nothing_without_an_index_for_the_synced_fingerprint(self, tmp_path):
+        metrics = [mock_funnel_metric(id="01", wave_date="2020-01-01")]
+
+        assert WaveIndex(str(tmp_path)).diff(
+            "Total", 1, "2020-01-01", "3-ab", metrics) is None
+
+    def test_reads_indexes_larger_than_a_block(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("wave_index.BLOCK_IDS", 2)
+        index = WaveIndex(str(tmp_path))
+        ids = [f"{i:04x}" for i in range(5)]
+
+        index.write("Total", 1, "2020-01-01", "5-ab", ids)
+
+        assert list(index.ids("Total", 1, "2020-01-01", "5-ab")) == ids
+
+    def test_prunes_waves_and_fingerprints_that_are_no_longer_current(self, tmp_path):
+        index = WaveIndex(str(tmp_path))
+        index.write("Total", 1, "2020-01-01", "1-aa", ["01"])
+        index.write("Total", 1, "2020-02-01", "1-bb", ["02"])
+        index.write("Total", 1, "2020-02-01", "1-cc", ["03"])
+        index.write("Total", 2, "2020-01-01", "1-dd", ["04"])
+
+        index.prune("Total", 1, {"2020-02-01": "1-cc"})
+
+        assert os.listdir(tmp_path / "Total" / "1") == ["2020-02-01"]
+        assert os.listdir(tmp_path / "Total" / "1" / "2020-02-01") == ["1-cc.ids"]
+        assert index.has("Total", 2, "2020-01-01", "1-dd")
+
+    def test_keeps_filter_keys_with_any_characters_inside_the_directory(self, tmp_path):
+        index = WaveIndex(str(tmp_path))
+
+        index.write("Age;geography=../NZ", 1, "2020-01-01", "1-aa", ["01"])
+
+        assert os.listdir(tmp_path) == ["Age%3Bgeography%3D..%2FNZ"]
+        assert list(index.ids("Age;geography=../NZ", 1, "2020-01-01", "1-aa")) == ["01"]